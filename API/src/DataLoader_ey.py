@@ -1,5 +1,5 @@
 import pandas as pd
-from tensorflow.keras.models import load_model
+from inference import load_engine
 import numpy as np
 from constants import *
 
@@ -53,12 +53,14 @@ def preprocessX(df):
     X = preprocessor.transform(X)
     return X
 
-def createDataframeForDB(deleteLabel=True):
-    """This method prepares the data to be added to the database. It determines the model prediction and confidence and adds it to the dataframe."""
+def createDataframeForDB(deleteLabel=True, model=None):
+    """This method prepares the data to be added to the database. It determines the model prediction and confidence and adds it to the dataframe.
+    The inference engine of the model can be passed, otherwise it is loaded."""
     df = data_loader()
     data = preprocessX(df)
-    model = load_model('smote_ey.tf')
-    results = model.predict(data)
+    if model is None:
+        model = load_engine()
+    results = model.predict(data.toarray() if hasattr(data, "toarray") else data)
     recommendation = []
 
     for i in range(results.size):
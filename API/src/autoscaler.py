@@ -0,0 +1,186 @@
+import math
+import time
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Callable, Optional
+import psutil
+from job_transport import JobTransport, pool_names
+
+"""Supervisor of the explainer processes. The workers of the initial layout are started at startup and never retired,
+further workers are added to a pool when its queued jobs would wait longer than the target and are retired again once the pool
+has been idle for a while. The memory of the running workers is measured with psutil, a worker is only added if enough RAM stays
+available, under memory pressure idle workers above the initial layout are retired. A worker that steals a job of the other pool
+loads the second explainer (see job_transport.py), so the memory of the second explainer is kept free for every worker that has
+only loaded one, including the new one. A new worker loads its explainer before it
+gets jobs from the JobTransport. A worker that exits without being retired (e.g. it crashed) is replaced as long as its pool is
+below the initial layout, also without autoscaling. The decisions are reported on `/processes`.
+"""
+
+
+class WorkerSupervisor:
+    """Starts, grows and shrinks the explainer processes of a JobTransport, owned by the API process"""
+
+    def __init__(self, transport: JobTransport, start_worker: Callable, max_workers: int, interval: float = 2,
+                 target_wait: float = 10, idle_seconds: float = 120, min_free_memory_mb: int = 1024, worker_memory_mb: int = 1500,
+                 on_exit: Optional[Callable] = None, explainer_memory_mb: int = 500):
+        """
+        :param transport: the JobTransport, its workers at the time of `start` are the minimum layout
+        :param start_worker: starts the explainer process with the given worker id and returns the `multiprocessing.Process`
+        :param max_workers: max. number of workers of all pools, the minimum layout is never exceeded if it is larger
+        :param target_wait: a worker is added to a pool if its queued jobs are expected to wait longer (seconds)
+        :param idle_seconds: a worker is retired if its pool had no jobs for this long
+        :param min_free_memory_mb: available RAM that has to remain after a worker is added
+        :param worker_memory_mb: estimated memory of a worker, until the running workers have been measured
+        :param on_exit: called with the worker id once the explainer process has exited
+        :param explainer_memory_mb: memory a worker gains when it loads the explainer of the other pool to steal a job
+        """
+        self.transport = transport
+        self.start_worker = start_worker
+        self.floor = {pool: transport.pools.count(pool) for pool in pool_names}
+        self.max_workers = max(max_workers, len(transport.pools))
+        self.interval = interval
+        self.target_wait = target_wait
+        self.idle_seconds = idle_seconds
+        self.min_free_memory_mb = min_free_memory_mb
+        self.worker_memory_mb = worker_memory_mb
+        self.on_exit = on_exit
+        self.explainer_memory_mb = explainer_memory_mb
+        self.processes = {}  # worker id -> multiprocessing.Process
+        self.decisions = deque(maxlen=50)
+        self._retiring = set()
+        self._holding = set()  # pools that can't grow because of the memory, the decision is only reported once
+        self._last_busy = {pool: time.monotonic() for pool in pool_names}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the processes of the minimum layout and the supervisor thread"""
+        for worker_id in range(len(self.transport.pools)):
+            self.processes[worker_id] = self.start_worker(worker_id)
+        self._thread = threading.Thread(target=self._run, name="worker-supervisor", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def pids(self):
+        return [process.pid for process in list(self.processes.values())]
+
+    def report(self):
+        """Returns the bounds, the current memory figures and the last scale decisions"""
+        return {
+            "min_workers": sum(self.floor.values()),
+            "max_workers": self.max_workers,
+            "available_memory_mb": round(psutil.virtual_memory().available / 2 ** 20),
+            "worker_memory_mb": round(self.measured_worker_memory()),
+            "decisions": list(self.decisions)
+        }
+
+    def measured_worker_memory(self):
+        """Largest resident memory of the running workers (MB), the configured estimate if none could be measured"""
+        sizes = []
+        for process in list(self.processes.values()):
+            try:
+                sizes.append(psutil.Process(process.pid).memory_info().rss / 2 ** 20)
+            except (psutil.Error, TypeError):
+                continue
+        return max(sizes) if sizes else self.worker_memory_mb
+
+    def step(self):
+        """Makes the scale decisions of all pools once"""
+        self._reap()
+        now = time.monotonic()
+        pools = self.transport.metrics()["pools"]
+        available_mb = psutil.virtual_memory().available / 2 ** 20
+        worker_mb = self.measured_worker_memory()
+        total = sum(metrics["workers"] for metrics in pools.values())
+        # the workers with one explainer can still load the other one when they steal a job
+        growth_mb = self.explainer_memory_mb * sum(metrics["workers"] - metrics["both_explainers"] for metrics in pools.values())
+        for pool in pool_names:
+            metrics = pools[pool]
+            queued = sum(metrics["queued"].values())
+            if queued or metrics["running"]:
+                self._last_busy[pool] = now
+            if not queued:
+                self._holding.discard(pool)
+            wait = expected_wait(metrics, queued)
+            if queued and not metrics["starting_workers"] and wait > self.target_wait and total < self.max_workers:
+                needed_mb = worker_mb + self.explainer_memory_mb + growth_mb
+                if available_mb - needed_mb < self.min_free_memory_mb:
+                    if pool not in self._holding:
+                        self._holding.add(pool)
+                        self._decide("hold", pool, f"only {available_mb:.0f} MB available, a worker needs {worker_mb:.0f} MB "
+                                                   f"and {growth_mb + self.explainer_memory_mb:.0f} MB are kept for second explainers", total)
+                    continue
+                self._holding.discard(pool)
+                total += 1
+                self._add(pool, f"{queued} queued jobs, expected wait {wait:.1f} s", total)
+                available_mb -= worker_mb
+                growth_mb += self.explainer_memory_mb
+            elif (metrics["workers"] > self.floor[pool] and metrics["idle_workers"]
+                  and now - self._last_busy[pool] > self.idle_seconds):
+                if self._retire(pool, f"idle for {now - self._last_busy[pool]:.0f} s", total - 1):
+                    total -= 1
+        if available_mb < self.min_free_memory_mb:
+            for pool in pool_names:
+                if pools[pool]["workers"] > self.floor[pool] and pools[pool]["idle_workers"]:
+                    if self._retire(pool, f"only {available_mb:.0f} MB available", total - 1):
+                        break
+
+    def _add(self, pool: str, reason: str, total: int):
+        worker_id = self.transport.add_worker(pool)
+        self.processes[worker_id] = self.start_worker(worker_id)
+        self._decide("start", pool, reason, total)
+
+    def _retire(self, pool: str, reason: str, total: int):
+        worker_id = self.transport.retire_worker(pool)
+        if worker_id is None:
+            return False
+        self._retiring.add(worker_id)
+        self._last_busy[pool] = time.monotonic()  # at most one worker per pool and idle period
+        self._decide("retire", pool, reason, total)
+        return True
+
+    def _reap(self):
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.processes[worker_id]
+            if self.on_exit is not None:
+                self.on_exit(worker_id)
+            if worker_id in self._retiring:
+                self._retiring.discard(worker_id)
+                continue
+            # the process has crashed (or was killed), its running job fails and the minimum layout is restored
+            pool = self.transport.pools[worker_id]
+            uid = self.transport.worker_exited(worker_id)
+            reason = f"exit code {process.exitcode}" + (f", explanation {uid} failed" if uid is not None else "")
+            self._decide("exited", pool, reason, len(self.processes))
+            if self.transport.metrics()["pools"][pool]["workers"] < self.floor[pool]:
+                self._add(pool, f"replaces worker {worker_id}", len(self.processes) + 1)
+
+    def _decide(self, action: str, pool: str, reason: str, total: int):
+        print(f"\033[92mINFO:\033[0m Explainer pool \033[1m{pool}\033[0m: {action} ({reason}), {total} workers.")
+        self.decisions.append({"time": datetime.now().isoformat(timespec="seconds"), "action": action, "pool": pool,
+                               "reason": reason, "workers": total})
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.step()
+            except Exception as e:
+                print(f"\033[93mWARNING:\033[0m Scaling the explainer processes failed: {e!r}")
+
+
+def expected_wait(metrics: dict, queued: int):
+    """Estimated time (seconds) until the queued jobs of a pool are started, based on the duration of its last jobs.
+    Before a job has finished, only the queue depth counts."""
+    workers = max(metrics["workers"], 1)
+    if metrics["service_seconds"] is None:
+        return math.inf if queued >= workers else 0.0
+    return queued * metrics["service_seconds"] / workers
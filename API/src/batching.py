@@ -0,0 +1,119 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class StackedPredictor:
+    """Stacks the model calls of several explanation threads into one model call.
+    Every participating thread calls `predict` with its perturbation matrix and blocks until all active participants
+    have submitted their matrix. The matrices are then evaluated with a single call of the wrapped prediction function and
+    the predictions are split up again. Threads that are finished must call `leave`, so the remaining ones do not wait for them.
+    """
+
+    def __init__(self, predict_fn, participants: int):
+        """
+        :param predict_fn: the prediction function, takes a 2d array and returns an array with one row per input row
+        :param participants: the number of threads that use this predictor
+        """
+        self.predict_fn = predict_fn
+        self._active = participants
+        self._pending = {}  # thread id -> submitted matrix
+        self._results = {}  # thread id -> predictions or exception
+        self._cond = threading.Condition()
+        self.num_model_calls = 0
+
+    def predict(self, X):
+        key = threading.get_ident()
+        with self._cond:
+            self._pending[key] = np.asarray(X)
+            if len(self._pending) >= self._active:
+                self._flush()
+            else:
+                self._cond.wait_for(lambda: key in self._results)
+            result = self._results.pop(key)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def leave(self):
+        """Removes the calling thread from the participants."""
+        with self._cond:
+            self._active -= 1
+            if self._pending and len(self._pending) >= self._active:
+                self._flush()
+
+    def _flush(self):
+        # is only called while holding the lock, the other participants are waiting anyway
+        keys = list(self._pending.keys())
+        matrices = [self._pending[k] for k in keys]
+        self._pending = {}
+        try:
+            predictions = self.predict_fn(np.concatenate(matrices, axis=0))
+            self.num_model_calls += 1
+            splits = np.cumsum([len(m) for m in matrices])[:-1]
+            for k, part in zip(keys, np.split(predictions, splits, axis=0)):
+                self._results[k] = part
+        except Exception as e:
+            for k in keys:
+                self._results[k] = e
+        self._cond.notify_all()
+
+
+class PredictionBatcher:
+    """Coalesces concurrent single-row predictions of the API handlers into one model call.
+    Rows that arrive within `window` seconds after the first waiting row (or until `max_batch_size` rows are waiting)
+    are predicted together in an executor thread, so the event loop is never blocked by the model.
+    Must only be used from the event loop.
+    """
+
+    def __init__(self, predict_fn, window: float, max_batch_size: int, executor=None):
+        """
+        :param predict_fn: takes a 2d array with one row per request and returns one prediction per row
+        :param window: max. time in seconds a row waits for other rows
+        :param executor: executor for the model calls, by default a single dedicated thread
+        """
+        self.predict_fn = predict_fn
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="predict")
+        self._pending = []  # (row, future)
+        self._timer = None
+        self.num_model_calls = 0
+        self.num_rows = 0
+
+    async def predict(self, row):
+        """Returns the prediction for one row (1d array)"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((row, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush(loop)
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush, loop)
+        return await future
+
+    def _flush(self, loop):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        matrix = np.stack([row for row, _ in batch])
+        self.num_model_calls += 1
+        self.num_rows += len(batch)
+        task = loop.run_in_executor(self.executor, self.predict_fn, matrix)
+        task.add_done_callback(lambda done: self._fan_out(batch, done))
+
+    @staticmethod
+    def _fan_out(batch, done):
+        exception = done.exception()
+        predictions = None if exception else done.result()
+        for i, (_, future) in enumerate(batch):
+            if future.done():  # the request has been cancelled in the meantime
+                continue
+            if exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(predictions[i])
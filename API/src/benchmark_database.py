@@ -0,0 +1,126 @@
+# This script is not necessary for the application
+# It measures the throughput of the database work of /instance/{id} and /table with a new connection per request
+# (rollback journal, as before the connection pools) and with the connection pools (WAL, read-only connections).
+# Every workload also runs with a concurrent writer, that creates and deletes experiments like the experiment endpoints.
+# Usage (from API/src): python benchmark_database.py [seconds per run] [number of client threads]
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import numpy as np
+from constants import db_path, number_of_applications
+from database_req import ConnectionPool, create_connection, get_application, get_applications_keyset, exp_creation, delete_exp
+from models import TableRequest
+
+duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+table_request = TableRequest.parse_obj({
+    "filter": [{"attribute": "assets", "values": ["car", "real estate"]},
+               {"attribute": "amount", "lower_bound": 1140, "upper_bound": 8612}],
+    "attributes": ["balance", "duration", "amount", "age", "savings"],
+    "sort_by": "balance",
+    "limit": 20
+})
+table_attributes = [attr.value for attr in table_request.attributes] + ["NN_recommendation", "NN_confidence"]
+
+
+def instance_request(con, rng):
+    get_application(con, int(rng.integers(number_of_applications)), json_str=True)
+
+
+def table_request_page(con, rng):
+    get_applications_keyset(con, table_attributes, table_request.limit, table_request.filter, table_request.sort_by,
+                            start=int(rng.integers(0, 400)))
+
+
+class PerRequestConnections:
+    """Connects for every request and closes the connection afterwards (the behaviour before the connection pools)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        con = create_connection(path)
+        con.execute("PRAGMA journal_mode = DELETE")
+        con.close()
+
+    def reader(self):
+        return create_connection(self.path)
+
+    def writer(self):
+        return create_connection(self.path)
+
+    @staticmethod
+    def release(con):
+        con.close()
+
+
+class Pools:
+    def __init__(self, path: str):
+        con = create_connection(path)
+        con.execute("PRAGMA journal_mode = WAL")  # like database_creation.py
+        con.close()
+        self.write_pool = ConnectionPool(path)
+        self.read_pool = ConnectionPool(path, read_only=True)
+
+    def reader(self):
+        return self.read_pool.connection()
+
+    def writer(self):
+        return self.write_pool.connection()
+
+    @staticmethod
+    def release(con):
+        pass
+
+
+def run(strategy, workload, with_writer: bool):
+    """Returns the number of requests per second of all client threads"""
+    deadline = time.time() + duration
+    counts = [0] * num_threads
+    stop_writer = threading.Event()
+
+    def client(i):
+        rng = np.random.default_rng(i)
+        while time.time() < deadline:
+            con = strategy.reader()
+            workload(con, rng)
+            strategy.release(con)
+            counts[i] += 1
+
+    def writer():
+        i = 0
+        while not stop_writer.is_set():
+            con = strategy.writer()
+            exp_creation(con, f"benchmark_{i}", "{}")
+            delete_exp(con, f"benchmark_{i}")
+            strategy.release(con)
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(num_threads)]
+    writer_thread = threading.Thread(target=writer)
+    if with_writer:
+        writer_thread.start()
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    stop_writer.set()
+    if with_writer:
+        writer_thread.join()
+    return sum(counts) / elapsed
+
+
+print(f"{num_threads} client threads, {duration:.0f} s per run, database copied from {db_path}\n")
+for name, workload in [("/instance/{id}", instance_request), ("/table", table_request_page)]:
+    for with_writer in [False, True]:
+        line = f"{name:>15} {'with writer' if with_writer else 'read only':>12}:"
+        for label, strategy_class in [("per-request connections", PerRequestConnections), ("connection pools", Pools)]:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "benchmark.db")
+                shutil.copy(db_path, path)
+                line += f" {label} {run(strategy_class(path), workload, with_writer):8.0f} req/s |"
+        print(line)
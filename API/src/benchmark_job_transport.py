@@ -0,0 +1,126 @@
+# This script is not necessary for the application
+# It measures the overhead per explanation job of the transport between the API process and the explainer processes:
+# the Manager queue and dict used before and the JobTransport (pipes, results in a local dict of the API process).
+# The explainers are replaced by echo workers that return a SHAP response immediately, so only the transport is measured.
+# While the jobs are running, hundreds of threads poll the status of the jobs like the front-ends do.
+# Usage (from API/src): python benchmark_job_transport.py [number of jobs] [number of polling threads] [number of workers]
+import sys
+import time
+import random
+import threading
+import multiprocessing as mp
+import numpy as np
+from constants import ResponseStatus, ExplanationType, rename_dict
+from models import ShapResponse
+from task_gen import Job
+from job_transport import JobTransport
+
+num_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+num_pollers = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+
+response = ShapResponse(status=ResponseStatus.terminated, base_value=0.3,
+                        values=[{"attribute": attr, "influence": 0.01 * i} for i, attr in enumerate(rename_dict.values())])
+
+
+def manager_worker(in_queue, res_out):
+    while True:
+        job = in_queue.get()
+        if job is None:
+            return
+        res_out[job.uid] = response
+
+
+def transport_worker(in_queue, out_queue, abort, worker_id, pool):
+    out_queue.put((worker_id, None, None, None))
+    while True:
+        job = in_queue.get()
+        if job is None:
+            return
+        out_queue.put((worker_id, job.uid, response, job.cache_key))
+
+
+class ManagerSetup:
+    def __init__(self):
+        self.manager = mp.Manager()
+        self.results = self.manager.dict()
+        self.queue = self.manager.Queue()
+        self.workers = [mp.Process(target=manager_worker, args=(self.queue, self.results)) for _ in range(num_workers)]
+
+    def submit(self, job):
+        self.queue.put(job)
+
+    def poll(self, uid):
+        # like the handlers before the JobTransport
+        if uid in self.results.keys():
+            return self.results[uid]
+        return None
+
+    def stop(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.manager.shutdown()
+
+
+class TransportSetup:
+    def __init__(self):
+        self.results = {}
+        self.transport = JobTransport(self.results, None, ["shap"] * num_workers)
+        self.workers = [mp.Process(target=transport_worker, args=self.transport.worker_args(i)) for i in range(num_workers)]
+        self.transport.start()
+
+    def submit(self, job):
+        self.transport.submit(job)
+
+    def poll(self, uid):
+        return self.results.get(uid)
+
+    def stop(self):
+        for jobs in self.transport.jobs:
+            jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.transport.stop()
+
+
+def run(setup):
+    """Returns the mean time per job until its result can be polled, the mean and 99th percentile duration of a poll (ms)"""
+    for worker in setup.workers:
+        worker.start()
+    jobs = [Job(exp_type=ExplanationType.shap, status=ResponseStatus.in_prog) for _ in range(num_jobs)]
+    uids = [job.uid for job in jobs]
+    stop = threading.Event()
+    poll_times = [[] for _ in range(num_pollers)]
+
+    def poller(i):
+        rng = random.Random(i)
+        while not stop.is_set():
+            start = time.perf_counter()
+            setup.poll(uids[rng.randrange(num_jobs)])
+            poll_times[i].append(time.perf_counter() - start)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=poller, args=(i,)) for i in range(num_pollers)]
+    for t in threads:
+        t.start()
+    start = time.perf_counter()
+    for job in jobs:
+        setup.submit(job)
+    for uid in uids:
+        while setup.poll(uid) is None:
+            time.sleep(0.0005)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for t in threads:
+        t.join()
+    setup.stop()
+    poll_times = np.concatenate([np.array(times) for times in poll_times]) * 1000
+    return elapsed / num_jobs * 1000, np.mean(poll_times), np.percentile(poll_times, 99)
+
+
+print(f"{num_jobs} jobs, {num_pollers} polling threads, {num_workers} echo workers\n")
+for label, setup_class in [("Manager queue and dict", ManagerSetup), ("JobTransport", TransportSetup)]:
+    per_job, poll_mean, poll_p99 = run(setup_class())
+    print(f"{label:>22}: {per_job:7.3f} ms per job | poll {poll_mean:7.3f} ms mean, {poll_p99:7.3f} ms p99")
@@ -0,0 +1,49 @@
+# This script is not necessary for the application
+# It measures the latency and the accuracy loss of the summarized SHAP backgrounds compared to the full training split.
+# Usage (from API/src): python benchmark_shap_background.py [num_instances]
+import sys
+import time
+import numpy as np
+import shap
+from shap_utils import ShapHelperV2, summarize_background, compute_response_shap
+from constants import shap_background_size
+from models import InstanceInfo
+
+num_instances = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+configurations = [("full", None), ("kmedoids", shap_background_size),
+                  ("stratified", shap_background_size), ("sample", shap_background_size)]
+
+sh = ShapHelperV2()
+sh.prepare_shap()
+cols = sh.X_train.columns.to_list()
+instances = [InstanceInfo.parse_obj({"id": -1, **row.to_dict()}) for _, row in sh.X_test.head(num_instances).iterrows()]
+
+
+def explain_all(explainer):
+    """Returns the base value, the shap values of all instances and the mean duration per explanation in seconds"""
+    values = []
+    start = time.time()
+    for instance in instances:
+        _, shap_vals = compute_response_shap(instance, explainer, cols)
+        values.append(shap_vals[0])
+    return explainer.expected_value, np.array(values), (time.time() - start) / len(instances)
+
+
+reference = None
+print(f"Explaining {len(instances)} test instances per configuration.\n")
+for mode, size in configurations:
+    background = summarize_background(sh, mode, size) if size else sh.X_train
+    explainer = shap.KernelExplainer(sh.predict_shap, background)
+    base_value, shap_vals, duration = explain_all(explainer)
+    line = f"{mode:>10} ({len(explainer.data.weights):>4} rows): {duration:6.2f} s per explanation"
+    if reference is None:
+        reference = (base_value, shap_vals, duration)
+    else:
+        ref_base, ref_vals, ref_duration = reference
+        abs_err = np.abs(shap_vals - ref_vals)
+        # share of instances where the most influential attribute is the same as with the full background
+        top_agreement = np.mean(np.argmax(np.abs(shap_vals), axis=1) == np.argmax(np.abs(ref_vals), axis=1))
+        line += f" | speedup {ref_duration / duration:5.1f}x | base value error {abs(base_value - ref_base):.4f}" \
+                f" | mean abs error {abs_err.mean():.4f} | max abs error {abs_err.max():.4f}" \
+                f" | top attribute agreement {top_agreement:.0%}"
+    print(line)
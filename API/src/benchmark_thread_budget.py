@@ -0,0 +1,73 @@
+# This script is not necessary for the application
+# It sweeps the combinations of explainer processes and threads per process (see resources.py) and measures the SHAP throughput
+# of each one on this machine. Every process limits its threads (and optionally its cores) like an explainer process of the API,
+# loads the SHAP explainer and explains its share of the instances, all processes start at the same time.
+# "default" runs the processes without limits, like before the thread budgets.
+# Usage (from API/src): python benchmark_thread_budget.py [instances per configuration] [max. processes] [pin: 0 or 1]
+import sys
+import time
+import multiprocessing as mp
+from resources import ResourceManager, available_cores
+
+num_instances = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+max_processes = int(sys.argv[2]) if len(sys.argv) > 2 else len(available_cores())
+pin = len(sys.argv) > 3 and sys.argv[3] == "1"
+
+
+def explain(resources, offset, count, ready, start, out):
+    """Explains `count` instances of the test split and sends the time the last one was finished"""
+    import os
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    from resources import apply_resources
+    if resources is not None:
+        apply_resources(resources)
+    from task_gen import load_shap_explainer, shap_response
+    from shap_utils import ShapHelperV2
+    from models import InstanceInfo
+    explainer, cols = load_shap_explainer()
+    sh = ShapHelperV2()
+    sh.prepare_shap()
+    X_test = sh.X_test
+    instances = [InstanceInfo.parse_obj({"id": -1, **X_test.iloc[(offset + i) % len(X_test)].to_dict()}) for i in range(count)]
+    ready.release()
+    start.wait()
+    for instance in instances:
+        shap_response(instance, explainer, cols)
+    out.put(time.time())
+
+
+def run(num_processes, threads):
+    """Returns the explanations per second of the configuration, threads=None runs the processes without limits"""
+    ctx = mp.get_context("spawn")  # fresh processes, TensorFlow must not be initialized before the limits are applied
+    manager = ResourceManager(num_processes, threads or 0, pin=pin, reserved_cores=0)
+    ready, start, out = ctx.Semaphore(0), ctx.Event(), ctx.Queue()
+    shares = [num_instances // num_processes + (i < num_instances % num_processes) for i in range(num_processes)]
+    processes = []
+    for i, count in enumerate(shares):
+        resources = manager.acquire(i) if threads is not None else None
+        process = ctx.Process(target=explain, args=(resources, sum(shares[:i]), count, ready, start, out))
+        process.start()
+        processes.append(process)
+    for _ in processes:
+        ready.acquire()  # the explainers are loaded
+    start_time = time.time()
+    start.set()
+    end_time = max(out.get() for _ in processes)
+    for process in processes:
+        process.join()
+    return num_instances / (end_time - start_time)
+
+
+cores = len(available_cores())
+process_counts = [p for p in [1, 2, 4, 8, 16, 32, 64] if p <= max_processes]
+configurations = [(p, None) for p in process_counts]
+configurations += [(p, t) for p in process_counts for t in [1, 2, 4, 8, 16, 32] if p * t <= cores]
+print(f"{cores} cores, {num_instances} SHAP explanations per configuration{', pinned' if pin else ''}\n")
+print(f"{'processes':>9} {'threads':>8} {'explanations/s':>15}")
+best = None
+for num_processes, threads in configurations:
+    throughput = run(num_processes, threads)
+    print(f"{num_processes:>9} {threads or 'default':>8} {throughput:>15.2f}")
+    if threads is not None and (best is None or throughput > best[2]):
+        best = (num_processes, threads, throughput)
+print(f"\nBest budget: MAX_WORKERS={best[0]} WORKER_THREADS={best[1]} ({best[2]:.2f} explanations/s)")
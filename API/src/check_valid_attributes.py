@@ -40,26 +40,23 @@ assert r.json()["NN_recommendation"] == "Reject" and r.json()["NN_confidence"] =
 
 faulty_values = {}
 
-# Check values for each categorical constraint
+# Check values for each categorical constraint. All variants are predicted with a single request
+variants = []
 for constraint in attribute_constraints:
     if constraint["type"] == "continuous" or "NN" in constraint["attribute"].value:
         continue # skip anything that isn't continuous or does not have anything to do with 
     attr_name = constraint["attribute"].value
-    attr_values = constraint["values"]
-    faulty_list = []
-    print(f"\033[92mINFO:\033[0m checking {attr_name} for model misbehaving.")
-    for val in attr_values: # check every specified value
-        print(f"    checking {val}")
+    for val in constraint["values"]: # check every specified value
         tmp = baseline_req_api.copy()
         tmp[attr_name] = val # only change one value, to see if the prediction changes. If it does, then the value is correctly specified
-        tmp_r = requests.post("http://localhost:8000/instance/predict", json=tmp)
-        try:
-            assert not (tmp_r.json()["NN_recommendation"] == "Reject" and tmp_r.json()["NN_confidence"] == baseline_value)
-        except AssertionError: 
-            # gets executed when the value didn't change the prediction, which means that the model does not know the value and has no encoding for it
-            print(f"    \033[91mWARNING\033[0m: {val} is wrongly specified for attribute {attr_name}")
-            faulty_list.append(val)
-    if len(faulty_list) > 0:
-        faulty_values[attr_name] = faulty_list
+        variants.append((attr_name, val, tmp))
+
+print(f"\033[92mINFO:\033[0m checking {len(variants)} attribute values for model misbehaving.")
+batch_r = requests.post("http://localhost:8000/instance/predict/batch", json=[tmp for _, _, tmp in variants])
+for (attr_name, val, _), prediction in zip(variants, batch_r.json()):
+    if prediction["NN_recommendation"] == "Reject" and prediction["NN_confidence"] == baseline_value:
+        # the value didn't change the prediction, which means that the model does not know the value and has no encoding for it
+        print(f"    \033[91mWARNING\033[0m: {val} is wrongly specified for attribute {attr_name}")
+        faulty_values.setdefault(attr_name, []).append(val)
 
 print(faulty_values)
\ No newline at end of file
@@ -0,0 +1,143 @@
+import numpy as np
+from typing import List
+from constants import *
+from database_req import table_column, categorical_constraint, filter_fingerprint, encode_cursor, decode_cursor
+
+
+class ColumnarStore:
+    """In-memory copy of the applicants table for the table view. Every column is kept as a NumPy array, the categorical
+    attributes are additionally dictionary-encoded in the order of `attribute_constraints` (like the ordinal columns of the database).
+    Filters are evaluated as vectorized masks and the pages are sliced from a precomputed (sort key, id) permutation per attribute.
+    The results (and cursors) are identical to `get_applications_keyset`. The applicants table is static after `database_creation.py`,
+    so the store is loaded once at startup.
+    """
+
+    def __init__(self, columns: dict):
+        """
+        :param columns: column name -> 1d array with the values of the applicants table, must contain the id column
+        """
+        self.columns = columns
+        self.ids = np.asarray(columns[AttributeNames.ident.value], dtype=np.int64)
+        self.size = len(self.ids)
+        self.sort_keys = {}  # column -> sort key of every row (ordinal codes for categorical attributes)
+        self.permutations = {}  # column -> row indices sorted ascending by (sort key, id)
+        for name, column in columns.items():
+            if name not in table_columns:
+                continue
+            constraint = categorical_constraint(name)
+            if constraint is not None:
+                codes = {value: i + 1 for i, value in enumerate(constraint[values])}
+                key = np.array([codes.get(value, 0) for value in column.tolist()], dtype=np.int64)
+            elif column.dtype.kind in "iuf":
+                key = column
+            else:
+                continue
+            self.sort_keys[name] = key
+            self.permutations[name] = np.lexsort((self.ids, key))
+
+    @classmethod
+    def from_database(cls, con):
+        """Loads the applicants table from the database that is connected via con."""
+        c = con.execute("SELECT * FROM applicants")
+        names = [description[0] for description in c.description]
+        rows = c.fetchall()
+        columns = {}
+        for i, name in enumerate(names):
+            column = [row[i] for row in rows]
+            numeric = all(isinstance(value, (int, float)) for value in column)
+            columns[name] = np.array(column) if numeric and len(column) > 0 else np.array(column, dtype=object)
+        return cls(columns)
+
+    def mask(self, filters=None):
+        """Returns the boolean mask of the rows that match all filters (list of ContinuousFilter and CategoricalFilter)."""
+        mask = np.ones(self.size, dtype=bool)
+        for filter_model in filters or []:
+            filter_dict = vars(filter_model)
+            column = self.columns[table_column(filter_dict[attr_name_abr])]
+            if (values in filter_dict):
+                mask &= self._is_in(column, filter_dict[values])
+            else:
+                mask &= self._between(column, filter_dict[lower_bound], filter_dict[upper_bound])
+        return mask
+
+    @staticmethod
+    def _is_in(column, selected: List[str]):
+        if column.dtype.kind in "iuf":
+            # like sqlite, the numeric affinity of the column is applied to the values
+            numbers = []
+            for value in selected:
+                try:
+                    numbers.append(float(value))
+                except ValueError:
+                    continue
+            return np.isin(column, numbers)
+        return np.isin(column, list(selected))
+
+    @staticmethod
+    def _between(column, lower: float, upper: float):
+        if column.dtype.kind not in "iuf":
+            # sqlite sorts text after all numbers, so a text value is never <= upper
+            return np.zeros(len(column), dtype=bool)
+        return (column >= lower) & (column <= upper)
+
+    def facets(self, filters=None, bins=10):
+        """Returns the facets of the rows that match the filters (see `facet_counts`)."""
+        mask = self.mask(filters)
+        return facet_counts({name: column[mask] for name, column in self.columns.items()}, bins)
+
+    def page(self, attributes: List[str], num=20, filters=None, sort="ident", sort_asc=True, start=0, cursor=None):
+        """Returns a page of application data in json format and the cursor of the next page, like `get_applications_keyset`."""
+        sort = table_column(sort)
+        filter_hash = filter_fingerprint(filters)
+        after = decode_cursor(cursor, sort, sort_asc, filter_hash) if cursor else None
+        permutation = self.permutations[sort]
+        ascending = permutation[self.mask(filters)[permutation]] if filters else permutation
+        key = self.sort_keys[sort]
+        end = None if num < 0 else num  # like LIMIT -1 in sqlite
+        if after is None:
+            order = ascending if sort_asc else ascending[::-1]
+            start = max(start, 0)
+            rows = order[start:start + end if end is not None else None]
+        else:
+            position = self._position(ascending, key, after, sort_asc)
+            rows = ascending[position:][:end] if sort_asc else ascending[:position][::-1][:end]
+        result = self._rows(rows, [AttributeNames.ident.value] + [table_column(attr) for attr in attributes])
+        next_cursor = None
+        if num > 0 and len(rows) == num:
+            last = rows[-1]
+            next_cursor = encode_cursor(sort, sort_asc, filter_hash, key[last].item(), int(self.ids[last]))
+        return result, next_cursor
+
+    def _position(self, ascending, key, after, sort_asc: bool):
+        """Returns the position in the ascending order of the first row after (ascending) or at (descending) the cursor."""
+        keys = key[ascending]
+        low = np.searchsorted(keys, after[0], side="left")
+        high = np.searchsorted(keys, after[0], side="right")
+        ids = self.ids[ascending[low:high]]
+        return low + int(np.searchsorted(ids, after[1], side="right" if sort_asc else "left"))
+
+    def _rows(self, indices, names: List[str]):
+        columns = [self.columns[name][indices].tolist() for name in names]
+        return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def facet_counts(columns: dict, bins=10):
+    """Returns the number of rows, the counts per value of every categorical attribute (in the order of the constraints,
+    followed by values that are not in the constraints) and a histogram with the given number of bins between the
+    lower and upper bound of every continuous attribute (values outside the bounds are not counted).
+    :param columns: column name -> 1d array with the values of the rows, must contain the id column
+    """
+    facets = {total_count: len(columns[AttributeNames.ident.value]), categorical: {}, histograms: {}}
+    for constraint in attribute_constraints:
+        name = constraint[attr_name].value
+        column = columns[name]
+        if constraint[const_type] == categorical:
+            counts = {value: 0 for value in constraint[values]}
+            found, found_counts = np.unique(column.astype(str), return_counts=True)
+            for value, count in zip(found.tolist(), found_counts.tolist()):
+                counts[value] = count
+            facets[categorical][name] = counts
+        else:
+            counts, edges = np.histogram(column.astype(float), bins=bins, range=(constraint[lower_bound], constraint[upper_bound]))
+            facets[histograms][name] = {bin_edges: edges.tolist(), bin_counts: counts.tolist()}
+    return facets
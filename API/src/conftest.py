@@ -0,0 +1,23 @@
+# Shared fixtures of the tests in this folder, pytest loads them automatically.
+
+import sqlite3 as sql
+import pytest
+
+from constants import AttributeNames, rename_dict
+from DataLoader_ey import data_loader
+from database_req import create_ordinal_columns, create_table_indexes
+
+
+@pytest.fixture(scope="module")
+def con():
+    """In-memory copy of the applicants table with the ordinal columns and indexes of database_creation.py and
+    deterministic AI predictions instead of the model's"""
+    df = data_loader().drop(columns="label").rename(columns=rename_dict)
+    df[AttributeNames.NN_recommendation.value] = ["Approve", "Reject"] * (len(df) // 2) + ["Approve"] * (len(df) % 2)
+    df[AttributeNames.NN_confidence.value] = [0.5 + (i % 50) / 100 for i in range(len(df))]
+    con = sql.connect(":memory:", check_same_thread=False)
+    df.to_sql("applicants", con, index_label="id")
+    create_ordinal_columns(con)
+    create_table_indexes(con)
+    yield con
+    con.close()
@@ -1,3 +1,4 @@
+import os
 from enum import Enum
 
 
@@ -10,6 +11,12 @@ class ExplanationType(str, Enum):
     none = "none"
 
 
+class JobPriority(str, Enum):
+    '''Priority classes of the explanation jobs, queued interactive jobs are always computed before background jobs'''
+    interactive = "interactive"
+    background = "background"
+
+
 class ExportFormat(str, Enum):
     comma_separated = "csv"
     js_object_notation = "json"
@@ -55,6 +62,7 @@ class ResponseStatus(str, Enum):
     terminated = "terminated"
     timeout = "timeout"
     error = "error"
+    cancelled = "cancelled"
     not_existing = "No explanation result with corresponding uuid"
     wrong_method = "Uuid corresponds to antoher explanation method"
 
@@ -71,6 +79,11 @@ standard_attributes = [
 # number definitions to re-use through the entire code
 row_limit = 20
 
+# columns of the applicants table, the only identifiers that are inserted into table queries
+table_columns = {attr.value for attr in AttributeNames}
+sort_key = "sort_key"  # name of the selected sort key column, used for the table cursors
+ordinal_suffix = "_ord"  # suffix of the precomputed ordinal sort columns of the categorical attributes
+
 # strings to use throughout the entire code (important for coherence in response-key names)
 original_instance = "original_instance"
 attr_name = "attribute"
@@ -96,6 +109,13 @@ attributes = "attributes"
 sort_by = "sort_by"
 limit = "limit"
 offset = "offset"
+cursor = "cursor"
+next_cursor_header = "X-Next-Cursor"
+num_bins = "bins"
+total_count = "total"
+histograms = "histograms"
+bin_edges = "bin_edges"
+bin_counts = "counts"
 num_features = "num_features"
 base_value = "base_value"
 counterfactuals = "counterfactuals"
@@ -109,6 +129,10 @@ counterfactuals = "counterfactuals"
 const_type = "type"
 values = "values"
 db_path = "database.db"
+model_path = "smote_ey.tf"
+numpy_weights_path = "smote_ey_weights.npz"
+shap_table = "shap"
+lime_table = "lime"
 csv_path = "results.csv"
 results_key = "results"
 loan_id = "loan_id"
@@ -118,8 +142,64 @@ choice = "choice"
 all_features = 18
 number_of_applications = 1000
 timeout_seconds = 180
+long_poll_seconds = 30  # max. waiting time of a long poll for an explanation result
+stream_heartbeat_seconds = 15  # an event stream of an explanation sends a comment if nothing happened for this long
+predict_batch_limit = 10000  # max. number of applications per /instance/predict/batch request
+batch_stack_size = 8  # max. number of instances of a batch job whose model calls are stacked together
+cancel_check_rows = 4096  # rows per model call of an explanation, a cancelled job is aborted between these calls
 timestamp = "timestamp"
 
+# deployment configuration, the defaults can be overwritten with environment variables
+# background summarization for the SHAP KernelExplainer: "full", "kmedoids", "stratified" or "sample". The summarized modes are
+# faster but change the SHAP values, measure the error with benchmark_shap_background.py before enabling one
+shap_background_mode = os.environ.get("SHAP_BACKGROUND_MODE", "full")
+shap_background_size = int(os.environ.get("SHAP_BACKGROUND_SIZE", 50))
+# explanation result cache: max. number of results in memory, optional SQLite file for the disk tier (empty = disabled)
+explanation_cache_size = int(os.environ.get("EXPLANATION_CACHE_SIZE", 512))
+explanation_cache_path = os.environ.get("EXPLANATION_CACHE_PATH", "")
+explanation_cache_disk_size = int(os.environ.get("EXPLANATION_CACHE_DISK_SIZE", 10000))
+# inference backend for the smote_ey model: "keras", "tf_function" or "numpy" (see inference.py)
+inference_backend = os.environ.get("INFERENCE_BACKEND", "keras")
+# micro-batching of /instance/predict: max. waiting time of a request (ms) and max. number of rows per model call
+predict_batch_window_ms = float(os.environ.get("PREDICT_BATCH_WINDOW_MS", 2))
+predict_max_batch_size = int(os.environ.get("PREDICT_MAX_BATCH_SIZE", 64))
+# query engine of /table: "sql" or "columnar" (applicants table in memory, see columnar_store.py)
+table_engine = os.environ.get("TABLE_ENGINE", "sql")
+# database connections: max. waiting time for locks (s), page cache per connection (KiB) and memory-mapped size (bytes)
+db_busy_timeout = float(os.environ.get("DB_BUSY_TIMEOUT", 10))
+db_cache_size_kib = int(os.environ.get("DB_CACHE_SIZE_KIB", 16384))
+db_mmap_size = int(os.environ.get("DB_MMAP_SIZE", 268435456))
+# threads of the executors for the blocking database and model work of the API handlers (see executors.py)
+db_threads = int(os.environ.get("DB_THREADS", 8))
+model_threads = int(os.environ.get("MODEL_THREADS", 1))
+# explainer pools: number of SHAP and LIME workers (empty = a third of the explainer processes for LIME, the rest for SHAP)
+# an idle pool takes over jobs of the other one, as long as STEAL_RESERVE of its workers stay idle for its own jobs
+shap_workers = int(os.environ["SHAP_WORKERS"]) if os.environ.get("SHAP_WORKERS") else None
+lime_workers = int(os.environ["LIME_WORKERS"]) if os.environ.get("LIME_WORKERS") else None
+steal_reserve = int(os.environ.get("STEAL_RESERVE", 1))
+# memory a worker gains when it steals its first job of the other pool and loads the second explainer, reserved by the autoscaler
+explainer_memory_mb = int(os.environ.get("EXPLAINER_MEMORY_MB", 500))
+# autoscaling of the explainer processes between MIN_WORKERS and MAX_WORKERS (0 = cpu count - 2), see autoscaler.py
+# with AUTOSCALE, SHAP_WORKERS and LIME_WORKERS set the minimum layout, AUTOSCALE=false starts a fixed number of explainer processes
+autoscale = os.environ.get("AUTOSCALE", "true").lower() in ("1", "true", "yes")
+min_workers = int(os.environ.get("MIN_WORKERS", 2))
+max_workers = int(os.environ.get("MAX_WORKERS", 0))
+autoscale_interval = float(os.environ.get("AUTOSCALE_INTERVAL", 2))  # seconds between two scale decisions
+autoscale_target_wait = float(os.environ.get("AUTOSCALE_TARGET_WAIT", 10))  # a worker is added if queued jobs would wait longer (s)
+autoscale_idle_seconds = float(os.environ.get("AUTOSCALE_IDLE_SECONDS", 120))  # a worker is retired if its pool had nothing to do for this long
+min_free_memory_mb = int(os.environ.get("MIN_FREE_MEMORY_MB", 1024))  # RAM that has to stay available after a worker is added
+worker_memory_mb = int(os.environ.get("WORKER_MEMORY_MB", 1500))  # memory of a worker until the running workers have been measured
+# CPU budget of every explainer process (see resources.py): threads of TensorFlow and the BLAS libraries, 0 = the cores that are not
+# reserved for the API process divided by the max. number of explainer processes. PIN_WORKERS gives every explainer its own cores.
+worker_threads = int(os.environ.get("WORKER_THREADS", 0))
+worker_inter_op_threads = int(os.environ.get("WORKER_INTER_OP_THREADS", 1))
+pin_workers = os.environ.get("PIN_WORKERS", "false").lower() in ("1", "true", "yes")
+api_reserved_cores = int(os.environ.get("API_RESERVED_CORES", 2))
+# finished explanation results are kept for timeout_seconds, with RESULT_TTL_EXTEND_ON_READ every poll restarts the timeout
+result_ttl_extend_on_read = os.environ.get("RESULT_TTL_EXTEND_ON_READ", "false").lower() in ("1", "true", "yes")
+# responses of /table, /table/facets and /instance/predict/batch are encoded directly (orjson if installed) without validating them again (see fast_json.py)
+fast_responses = os.environ.get("FAST_RESPONSES", "false").lower() in ("1", "true", "yes")
+
 # attribute constraints must exactly conform to the possible values accepted by the model!
 attribute_constraints = [
     {
@@ -296,6 +376,14 @@ rename_dict = {
 
 inv_rename = {v: k for k, v in rename_dict.items()}
 
+# tables with the pregenerated explanations of the dataset instances
+precomputed_tables = {
+    ExplanationType.shap: shap_table,
+    ExplanationType.shap_orig: shap_table,
+    ExplanationType.lime: lime_table,
+    ExplanationType.lime_orig: lime_table
+}
+
 # MUST STAY IN THIS ORDER!
 feature_names_model_ordered = [
     'balance_',
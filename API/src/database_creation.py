@@ -1,26 +1,38 @@
 from DataLoader_ey import createDataframeForDB
+import pickle
 import sqlite3 as sql
 from constants import *
-from database_req import cf_response_format_db 
+from database_req import bump_data_version, cf_response_format_db, create_explanation_tables, create_ordinal_columns, create_table_indexes
+from feature_encoder import FeatureEncoder
+from inference import load_engine, predict_records
 
 """This script can be run to create the database needed for the program.
-It creates the four tables applicants, dice, experiments and results.
-The applicants table is initialised with the loan applications from the german.csv data.
-The dice table is initialised with the pregenerated counterfactuals from cfs_response_format.json.
+It creates the six tables applicants, dice, shap, lime, experiments and results.
+The applicants table is initialised with the loan applications from the german.csv data and gets indexes and
+ordinal sort columns for the categorical attributes.
+The dice table is initialised with the pregenerated counterfactuals from cfs_response_format.json and their AI predictions.
+The shap and lime tables are filled by running explanation_precompute.py afterwards.
 The experiments table is used to store experiment information and the results table for the experiment results.
+The database uses the WAL journal.
 """
 
 con = sql.connect(db_path)
+# the journal mode is stored in the database file, with WAL the readers of the API don't block its writers (see ConnectionPool)
+con.execute("PRAGMA journal_mode = WAL")
 c = con.cursor()
 #the create_query is only needed for initialisation not when just wanting to reset
 create_query_appl ='CREATE TABLE IF NOT EXISTS applicants (id INT, balance TEXT,duration INT,history TEXT,purpose TEXT,amount REAL,savings TEXT,employment TEXT,available_income TEXT,other_debtors TEXT,residence TEXT,assets TEXT,age INT,other_loans TEXT,housing TEXT,previous_loans TEXT,job TEXT,people_liable TEXT,telephone TEXT, NN_recommendation TEXT, NN_confidence REAL)'
 c.execute(create_query_appl)
 con.commit()
-df = createDataframeForDB()
+engine = load_engine()
+df = createDataframeForDB(model=engine)
 df.to_sql('applicants', con, index_label = 'id', if_exists="replace")
 for key in rename_dict.keys():
     query = 'ALTER TABLE applicants RENAME COLUMN ' + key + ' TO ' + rename_dict[key] + ';'
     c.execute(query)
+# ordinal sort columns and indexes for the filters and sorting of the table view
+create_ordinal_columns(con)
+create_table_indexes(con)
 create_query_exp = 'CREATE TABLE IF NOT EXISTS experiments (name TEXT PRIMARY KEY, information TEXT);'
 c.execute(create_query_exp)
 con.commit()
@@ -29,5 +41,11 @@ c.execute(create_query_res)
 create_query_cf = 'CREATE TABLE IF NOT EXISTS dice (instance_id INT PRIMARY KEY REFERENCES applicants (id) ON DELETE CASCADE ON UPDATE CASCADE , counterfactuals JSON);'
 c.execute(create_query_cf)
 con.commit()
-cf_response_format_db(con, 'Data/cfs_response_format.json')
+# all counterfactuals are predicted with a single model call
+encoder = FeatureEncoder(pickle.load(open("preproc.pickle", "rb")), feature_names_model_ordered)
+model_attributes = [rename_dict[col] for col in feature_names_model_ordered]
+cf_response_format_db(con, 'Data/cfs_response_format.json', lambda records: predict_records(engine, encoder, records, model_attributes))
+create_explanation_tables(con)
+# a running API reloads its instance cache
+bump_data_version(con)
 con.close()
@@ -1,6 +1,13 @@
+import os
 import sqlite3 as sql
 import json
+import threading
+import base64
+import hashlib
+from functools import lru_cache
 from typing import List
+from urllib.request import pathname2url
+import numpy as np
 import pandas as pd
 from models import ExperimentResults
 
@@ -17,6 +24,63 @@ def create_connection(db: str):
     return con
 
 
+class ConnectionPool:
+    """Keeps one open connection to the database per thread, instead of connecting for every request.
+    The database file has to exist, it is switched to the WAL journal by `database_creation.py`, so readers and writers do not
+    block each other. The connections wait up to `db_busy_timeout` seconds for locks and get larger page caches and memory-mapped
+    I/O. Read-only pools are meant for the static tables (applicants, dice, shap, lime) and can't write by accident.
+    The connections are opened on first use, after a fork the child process opens its own connections.
+    Functions that change the row factory must do so on their cursor, because the connections are reused.
+    """
+
+    def __init__(self, db: str, read_only=False):
+        self.db = db
+        self.read_only = read_only
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._local = threading.local()
+        self._connections = []
+        self._pid = os.getpid()
+
+    def connection(self):
+        """Returns the connection of the calling thread."""
+        if self._pid != os.getpid():
+            self._reset()
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = self._connect()
+            self._local.con = con
+            with self._lock:
+                self._connections.append(con)
+        elif con.in_transaction:
+            # a previous request failed before it committed
+            con.rollback()
+        return con
+
+    def _connect(self):
+        # neither mode creates a missing database file
+        uri = f"file:{pathname2url(os.path.abspath(self.db))}?mode={'ro' if self.read_only else 'rw'}"
+        con = sql.connect(uri, uri=True, timeout=db_busy_timeout, check_same_thread=False)
+        if self.read_only:
+            con.execute("PRAGMA query_only = ON")
+        else:
+            # safe with WAL, the database can't be corrupted, only the last commits can be lost on a power failure
+            con.execute("PRAGMA synchronous = NORMAL")
+        con.execute(f"PRAGMA cache_size = -{db_cache_size_kib}")
+        con.execute(f"PRAGMA mmap_size = {db_mmap_size}")
+        con.execute("PRAGMA temp_store = MEMORY")
+        return con
+
+    def close(self):
+        """Closes all connections of this process."""
+        with self._lock:
+            for con in self._connections:
+                con.close()
+        self._reset()
+
+
 def get_applications(con, start: int, num=20):
     """Returns the applications with the ids from start to start + num
     Needs a connection con to the database.db (use create_connection) and a start value as int """
@@ -32,100 +96,281 @@ def get_application(con, ident: int, json_str=False):
     """Returns the application information for the application with the specified id.
     Needs a connection con to the database and the id.
     Result can be returned in json format."""
-    if json_str:
-        con.row_factory = sql.Row
     c = con.cursor()
-    query = f'SELECT * FROM applicants WHERE id = {ident}'
-    rows = c.execute(query).fetchall()
+    if json_str:
+        # only for this cursor, the connection may be shared
+        c.row_factory = sql.Row
+    query = 'SELECT * FROM applicants WHERE id = ?'
+    rows = c.execute(query, (ident,)).fetchall()
     if json_str:
         for ix in rows:
-            json_dump = json.dumps(dict(ix))
+            # the ordinal sort columns are not part of the application
+            json_dump = json.dumps({k: v for k, v in dict(ix).items() if k in table_columns})
     result = json.loads(json_dump)
     return result
 
 
+def get_all_applications(con):
+    """Returns all applications in json format, ordered by id."""
+    c = con.cursor()
+    c.row_factory = sql.Row
+    rows = c.execute('SELECT * FROM applicants ORDER BY id').fetchall()
+    return [{k: v for k, v in dict(row).items() if k in table_columns} for row in rows]
+
+
+def get_application_ids(con):
+    """Returns the ids of all applications in ascending order."""
+    return [row[0] for row in con.execute('SELECT id FROM applicants ORDER BY id').fetchall()]
+
+
+def get_data_version(con):
+    """Returns the version of the static tables (applicants, dice), which is stored in the header of the database file."""
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def bump_data_version(con):
+    """Increments the version of the static tables, must be called after they have been rebuilt (see InstanceCache)."""
+    con.execute(f"PRAGMA user_version = {get_data_version(con) + 1}")
+    con.commit()
+
+
 def get_applications_custom(con, start: int, attributes: List[str],  num=20, json_str=False, filters=None, sort="ident", sort_asc=True):
     """Returns a list of application data from the database that is connected via con. 
     Attributes is the list of chosen attributes, num the amount of applications that is requested, 
     filters a list of jsons with filter information, sort a String of the attribute name to be sorted by sort_desc allows to sort by descending order.
     Result can also be returned in json format."""
-    if json_str:
-        con.row_factory = sql.Row
     c = con.cursor()
-    view_query = 'CREATE VIEW custom AS '
-    # add customize values
-    chosen = AttributeNames.ident.value
-    if len(attributes) > 0:
-        chosen += ','
-        for i in range(0, len(attributes)):
-            chosen += str(attributes[i])
-            chosen += ','
-        chosen = chosen[:-1]
-    view_query += 'SELECT Row_Number() OVER '
-    view_query += create_order_query(sort)
-    if sort_asc == False:
-        view_query += ' DESC'
-    view_query += f') RowNum,{chosen} FROM applicants'
-    # add filters to query
-    if filters:
-        view_query += create_filter_query(filters)
-    c.execute(view_query)
-    con.commit()
-    end = start + num
-    query = f'SELECT {chosen} FROM custom WHERE RowNum > {start} AND RowNum <= {end}'
-    rows = c.execute(query).fetchall()
-    c.execute("DROP VIEW custom")
-    con.commit()
     if json_str:
-        rows = json.dumps([dict(ix) for ix in rows])
-        rows = json.loads(rows)
+        c.row_factory = sql.Row
+    rows = execute_table_query(c, lambda ordinals: compile_table_query(attributes, filters, sort, sort_asc, ordinals=ordinals),
+                               [num, start])
+    if json_str:
+        rows = [dict(ix) for ix in rows]
+        for row in rows:
+            del row[sort_key]
+    else:
+        rows = [row[:-1] for row in rows]
     return rows
 
 
-def create_filter_query(filters):
-    """Creates a string for the filter query in sql from a given list of filters in json format."""
-    filter_str = " WHERE "
-    for i in range(0, len(filters)):
-        filter_dict = vars(filters[i])
-        attribute = filter_dict[attr_name_abr]
+def get_applications_keyset(con, attributes: List[str], num=20, filters=None, sort="ident", sort_asc=True, start=0, cursor=None):
+    """Returns a page of application data in json format and the cursor of the next page (None on the last page).
+    Without a cursor the page starts at the offset start, with a cursor (see encode_cursor) it starts right after the
+    last application of the previous page. The seek on (sort key, id) costs the same for every page, while an offset
+    has to skip all previous rows. Raises a ValueError if the cursor does not belong to the given filters and sorting."""
+    c = con.cursor()
+    c.row_factory = sql.Row
+    filter_hash = filter_fingerprint(filters)
+    after = None
+    if cursor:
+        after = decode_cursor(cursor, sort, sort_asc, filter_hash)
+    page_params = [after[0], after[1], num] if after is not None else [num, start]
+    rows = execute_table_query(c, lambda ordinals: compile_table_query(attributes, filters, sort, sort_asc, seek=after is not None,
+                                                                         ordinals=ordinals), page_params)
+    rows = [dict(ix) for ix in rows]
+    next_cursor = None
+    if len(rows) == num and num > 0:
+        next_cursor = encode_cursor(sort, sort_asc, filter_hash, rows[-1][sort_key], rows[-1][AttributeNames.ident.value])
+    for row in rows:
+        del row[sort_key]
+    return rows, next_cursor
+
+
+def get_filtered_columns(con, columns: List[str], filters=None):
+    """Returns the given columns of all applications that match the filters as a dict column name -> NumPy array (single scan)."""
+    names = [table_column(col) for col in columns]
+    filter_shape, params = filter_parameters(filters) if filters else ((), [])
+    query = f'SELECT {",".join(names)} FROM applicants'
+    if filter_shape:
+        query += ' WHERE ' + create_filter_query(filter_shape)
+    rows = con.execute(query, params).fetchall()
+    return {name: np.array([row[i] for row in rows], dtype=object) for i, name in enumerate(names)}
+
+
+def table_column(attribute):
+    """Returns the column name of the applicants table for an attribute (AttributeNames or str).
+    Only these names are inserted into the queries, everything else raises a ValueError."""
+    name = attribute.value if isinstance(attribute, AttributeNames) else attribute
+    if name == "ident":
+        name = AttributeNames.ident.value
+    if name not in table_columns:
+        raise ValueError(f"{name} is not a column of the applicants table")
+    return name
+
+
+def execute_table_query(c, compile_query, page_params: list):
+    """Executes the table query returned by compile_query(ordinals) with the page parameters appended to the filter values.
+    Databases that have been created before the ordinal sort columns existed are queried with the sort expressions instead."""
+    query, params = compile_query(True)
+    try:
+        return c.execute(query, params + page_params).fetchall()
+    except sql.OperationalError as e:
+        if "no such column" not in str(e):
+            raise
+        query, params = compile_query(False)
+        return c.execute(query, params + page_params).fetchall()
+
+
+def compile_table_query(attributes: List[str], filters=None, sort="ident", sort_asc=True, seek=False, ordinals=True):
+    """Returns the read-only SELECT statement for a table request and the filter values that have to be bound to it.
+    The sort key of every row is selected as the last column. The last two placeholders are LIMIT and OFFSET,
+    or with seek the last sort key, the last id and LIMIT. With ordinals, categorical attributes are sorted by their ordinal columns.
+    The statement only depends on the shape of the request (chosen attributes, filtered attributes and their number of values,
+    sorting), so equal shapes result in the same statement text and sqlite can reuse the prepared statement of the connection."""
+    columns = tuple(table_column(attr) for attr in attributes)
+    filter_shape, params = filter_parameters(filters) if filters else ((), [])
+    return _table_query(columns, filter_shape, table_column(sort), bool(sort_asc), seek, ordinals), params
+
+
+@lru_cache(maxsize=256)
+def _table_query(columns: tuple, filter_shape: tuple, sort: str, sort_asc: bool, seek: bool, ordinals: bool):
+    chosen = ",".join((AttributeNames.ident.value,) + columns)
+    expression = sort_expression(sort, ordinals)
+    query = f'SELECT {chosen},{expression} AS {sort_key} FROM applicants'
+    conditions = [create_filter_query(filter_shape)] if filter_shape else []
+    if seek:
+        conditions.append(f"({expression},{AttributeNames.ident.value}) {'>' if sort_asc else '<'} (?,?)")
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ' + create_order_query(sort, sort_asc, ordinals)
+    query += ' LIMIT ?' if seek else ' LIMIT ? OFFSET ?'
+    return query
+
+
+def filter_parameters(filters):
+    """Splits a given list of filters in json format into the shape of the filter query and the values that are bound to it."""
+    shape = []
+    params = []
+    for filter_model in filters:
+        filter_dict = vars(filter_model)
+        attribute = table_column(filter_dict[attr_name_abr])
         if (values in filter_dict):
             # categorical filter
-            selected = filter_dict[values]
-            filter_str += "("
-            for j in range(0, len(selected)):
-                filter_str += f"{attribute} = '{selected[j]}'"
-                if j < len(selected) - 1:
-                    filter_str += " OR "
-            filter_str += ")"
+            shape.append((attribute, len(filter_dict[values])))
+            params.extend(filter_dict[values])
+        else:
+            # numerical
+            shape.append((attribute, None))
+            params.extend([filter_dict[lower_bound], filter_dict[upper_bound]])
+    return tuple(shape), params
+
+
+def filter_fingerprint(filters):
+    """Returns a short hash of the filters, a cursor is only valid for the filters it was created with."""
+    shape, params = filter_parameters(filters) if filters else ((), [])
+    return hashlib.sha256(json.dumps([shape, params]).encode("UTF-8")).hexdigest()[:16]
+
+
+def encode_cursor(sort: str, sort_asc: bool, filter_hash: str, last_key, last_id: int):
+    """Returns the opaque cursor for the page after the row with the given sort key and id."""
+    cursor = {"s": table_column(sort), "a": bool(sort_asc), "f": filter_hash, "k": last_key, "i": last_id}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("UTF-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, sort: str, sort_asc: bool, filter_hash: str):
+    """Returns the last sort key and id stored in the cursor. Raises a ValueError if the cursor is malformed
+    or has been created for another sorting or other filters."""
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        last = (decoded["k"], int(decoded["i"]))
+        valid = decoded["s"] == table_column(sort) and decoded["a"] == bool(sort_asc) and decoded["f"] == filter_hash
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Malformed cursor")
+    if not valid:
+        raise ValueError("The cursor belongs to another sorting or other filters")
+    return last
+
+
+def create_filter_query(filter_shape: tuple):
+    """Creates a string for the filter conditions in sql from the shape of the filters (see filter_parameters), the values are placeholders."""
+    conditions = []
+    for attribute, num_values in filter_shape:
+        if num_values is not None:
+            # categorical filter
+            conditions.append(f"({attribute} IN ({','.join(['?'] * num_values)}))")
         else:
             # numerical
-            filter_str += f"({attribute} >= {filter_dict[lower_bound]} AND {attribute} <= {filter_dict[upper_bound]})"
-        if i < len(filters) - 1:
-            filter_str += " AND "
-    return filter_str
+            conditions.append(f"({attribute} >= ? AND {attribute} <= ?)")
+    return " AND ".join(conditions)
 
 
-def create_order_query(sort: str):
-    """Creates a string for the ordering query in sql for a given attribute name as a string"""
-    query = '(ORDER BY '
-    attr_dict = {}
+def categorical_constraint(attribute: str):
+    """Returns the constraint of a categorical attribute or None for continuous attributes and the id."""
+    for constraint in attribute_constraints:
+        if constraint[attr_name] == attribute:
+            return constraint if constraint[const_type] == categorical else None
+    return None
+
+
+def ordinal_column(attribute: str):
+    """Returns the name of the precomputed ordinal sort column of a categorical attribute."""
+    return attribute + ordinal_suffix
+
+
+def ordinal_expression(attribute: str, attr_values: List[str]):
+    """Returns the CASE expression, that maps the values of a categorical attribute to their position in the constraints
+    (starting at 1, unknown values are 0)."""
+    expression = 'CASE'
+    count = 1
+    for entry in attr_values:
+        entry = entry.replace("'", "''")
+        expression += f" WHEN {attribute} = '{entry}' THEN {count}"
+        count += 1
+    return expression + ' ELSE 0 END'
+
+
+def sort_expression(sort: str, ordinals=True):
+    """Returns the sql expression of the sort key for a given attribute name.
+    Categorical attributes are sorted in the order of their values in the constraints, unknown values first.
+    With ordinals, the precomputed ordinal column is used instead of computing the position for every row."""
+    constraint = categorical_constraint(sort)
+    if constraint is None:
+        return sort
+    if ordinals:
+        return ordinal_column(sort)
+    return ordinal_expression(sort, constraint[values])
+
+
+def create_order_query(sort: str, sort_asc=True, ordinals=True):
+    """Creates a string for the ordering query in sql for a given attribute name as a string, ties are sorted by id."""
+    direction = '' if sort_asc else ' DESC'
+    query = 'ORDER BY ' + sort_expression(sort, ordinals) + direction
     if (sort == AttributeNames.ident.value):
-        query += sort
         return query
+    return query + f', {AttributeNames.ident.value}' + direction
+
+
+def create_ordinal_columns(con):
+    """Adds the integer column <attribute>_ord for every categorical attribute to the applicants table and fills it with
+    the position of the value in the constraints. Sorting by it gives the same order as the CASE expression of sort_expression,
+    but can use an index."""
+    existing = {row[1] for row in con.execute("PRAGMA table_info(applicants)").fetchall()}
     for constraint in attribute_constraints:
-        if constraint[attr_name] == sort:
-            attr_dict = constraint
-            break
-    if (attr_dict[const_type] == categorical):
-        query += 'CASE'
-        count = 1
-        for entry in attr_dict[values]:
-            query += f" WHEN {sort} = '{entry}' THEN {count}"
-            count += 1
-        query += ' END'
-    else:
-        query += sort
-    return query
+        if constraint[const_type] != categorical:
+            continue
+        attribute = constraint[attr_name].value
+        column = ordinal_column(attribute)
+        if column not in existing:
+            con.execute(f"ALTER TABLE applicants ADD COLUMN {column} INT")
+        con.execute(f"UPDATE applicants SET {column} = {ordinal_expression(attribute, constraint[values])}")
+    con.commit()
+
+
+def create_table_indexes(con):
+    """Creates the indexes for filtering and sorting the applicants table. Continuous attributes get an index on (attribute, id),
+    categorical attributes an index on the attribute for the filters and one on (ordinal column, id) for sorting.
+    Needs the ordinal columns (see create_ordinal_columns)."""
+    for constraint in attribute_constraints:
+        attribute = constraint[attr_name].value
+        if constraint[const_type] == categorical:
+            column = ordinal_column(attribute)
+            con.execute(f"CREATE INDEX IF NOT EXISTS applicants_{attribute} ON applicants ({attribute})")
+            con.execute(f"CREATE INDEX IF NOT EXISTS applicants_{column} ON applicants ({column}, {AttributeNames.ident.value})")
+        else:
+            con.execute(f"CREATE INDEX IF NOT EXISTS applicants_{attribute} ON applicants ({attribute}, {AttributeNames.ident.value})")
+    # statistics for the query planner
+    con.execute("ANALYZE")
+    con.commit()
 
 
 # for create_experiment
@@ -223,8 +468,8 @@ def export_results_to(con, format, exp_name=None):
     if exp_name:
         exp_name = exp_name.replace("'", "''")
         query += f" AND experiment_name =  '{exp_name}'"
-    con.row_factory = sql.Row
     c = con.cursor()
+    c.row_factory = sql.Row
     results = c.execute(query).fetchall()
     if results == []:
         if format == ExportFormat.comma_separated.value:
@@ -283,21 +528,41 @@ def delete_exp(con, exp_name: str):
         con.commit()
 
 
-def cf_response_format_db(con, path: str):
-    """Reading counterfactuals stored in a json from the given path, formatting them and adding them to the database."""
+def cf_response_format_db(con, path: str, predict=None):
+    """Reading counterfactuals stored in a json from the given path, formatting them and adding them to the database.
+    If a predict function is given (see add_cf_predictions), the AI prediction of every counterfactual is stored with it.
+    Needs the applicants table in that case."""
     c = con.cursor()
     with open(path, 'r') as file:
         cfs = json.load(file)
-    for key in cfs.keys():
-        instance = cfs[key]
-        cf = instance[counterfactuals]
+    cfs_by_instance = {int(key): cfs[key][counterfactuals] for key in cfs.keys()}
+    if predict is not None:
+        instances = {instance[AttributeNames.ident.value]: instance for instance in get_all_applications(con)}
+        add_cf_predictions(cfs_by_instance, instances, predict)
+    for key, cf in cfs_by_instance.items():
         cf_dict = {}
         cf_dict[counterfactuals] = cf
-        query = f"INSERT INTO dice (instance_id, counterfactuals) VALUES({key}, '{json.dumps(cf_dict)}');"
-        c.execute(query)
+        query = "INSERT INTO dice (instance_id, counterfactuals) VALUES(?, ?);"
+        c.execute(query, (key, json.dumps(cf_dict)))
     con.commit()
 
 
+def add_cf_predictions(cfs_by_instance: dict, instances: dict, predict):
+    """Adds NN_confidence and NN_recommendation to the counterfactuals (instance id -> list of counterfactuals) with a single call of
+    predict. The counterfactuals only contain the changed attributes, the others are taken from the instances (id -> instance dict).
+    :param predict: function list of complete attribute dicts -> list of (confidence, recommendation)
+    """
+    records = []
+    targets = []
+    for instance_id, cfs in cfs_by_instance.items():
+        for cf in cfs:
+            records.append({**instances[instance_id], **cf})
+            targets.append(cf)
+    for cf, (confidence, recommendation) in zip(targets, predict(records)):
+        cf[AttributeNames.NN_confidence.value] = confidence
+        cf[AttributeNames.NN_recommendation.value] = recommendation
+
+
 def get_cf(con, instance_id: int):
     """For that instance id the pregenerated counterfactuals are returned from the dice table if the id is
     between 0 and 999."""
@@ -311,6 +576,41 @@ def get_cf(con, instance_id: int):
         return res_json
 
 
+def create_explanation_tables(con):
+    """Creates the tables for the pregenerated SHAP and LIME explanations of the applicants if they do not exist yet."""
+    c = con.cursor()
+    for table in [shap_table, lime_table]:
+        c.execute(f'CREATE TABLE IF NOT EXISTS {table} (instance_id INT PRIMARY KEY REFERENCES applicants (id) ON DELETE CASCADE ON UPDATE CASCADE, explanation JSON);')
+    con.commit()
+
+
+def add_precomputed_explanation(con, exp_table: str, instance_id: int, explanation: str):
+    """Stores the explanation (response in json format) for the instance id in the table shap or lime."""
+    query = f"INSERT OR REPLACE INTO {exp_table} (instance_id, explanation) VALUES (?, ?)"
+    con.execute(query, (instance_id, explanation))
+    con.commit()
+
+
+def get_precomputed_ids(con, exp_table: str):
+    """Returns the set of instance ids that already have an explanation in the table shap or lime."""
+    query = f"SELECT instance_id FROM {exp_table}"
+    return {row[0] for row in con.execute(query).fetchall()}
+
+
+def get_precomputed_explanation(con, exp_table: str, instance_id: int):
+    """Returns the pregenerated explanation for the instance id from the table shap or lime as a json string.
+    Returns None if the explanation has not been generated (or the table does not exist)."""
+    query = f"SELECT explanation FROM {exp_table} WHERE instance_id = ?"
+    try:
+        results = con.execute(query, (instance_id,)).fetchall()
+    except sql.OperationalError:
+        # database was created before the explanation tables existed
+        return None
+    if len(results) == 0:
+        return None
+    return results[0][0]
+
+
 def check_exp_exists(con, exp_name: str):
     """Checks whether or not an experiment with the given name exists in the table `experiments`. Returns true if it exists."""
     exists_query = f"SELECT name FROM experiments WHERE name = '{exp_name}'"
@@ -0,0 +1,36 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from constants import db_threads, model_threads
+
+"""Executors for the blocking work of the API handlers. The handlers are `async def` and run on the single event loop of uvicorn,
+so sqlite queries and model calls are awaited in these thread pools instead of being called directly. A slow table query or
+prediction then only occupies a worker thread and cheap requests (e.g. the status polls of the explanations) are still answered.
+Both pools have a fixed number of threads (`DB_THREADS`, `MODEL_THREADS`), further calls wait in the queue of the pool.
+"""
+
+# sqlite releases the GIL while executing a query, the pooled connections are kept per thread (see ConnectionPool)
+db_executor = ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix="db")
+# the model is called by few threads, TensorFlow parallelizes every call itself
+model_executor = ThreadPoolExecutor(max_workers=model_threads, thread_name_prefix="model")
+
+
+async def run_db(fn, *args, **kwargs):
+    """Returns fn(*args, **kwargs), called in the database executor"""
+    return await asyncio.get_running_loop().run_in_executor(db_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run_query(pool, fn, *args, **kwargs):
+    """Returns fn(connection, *args, **kwargs), called in the database executor with the connection of the pool that belongs
+    to the executor thread. Used for the functions of database_req."""
+    return await run_db(lambda: fn(pool.connection(), *args, **kwargs))
+
+
+async def run_model(fn, *args, **kwargs):
+    """Returns fn(*args, **kwargs), called in the model executor"""
+    return await asyncio.get_running_loop().run_in_executor(model_executor, functools.partial(fn, *args, **kwargs))
+
+
+def call_model(fn, *args, **kwargs):
+    """Returns fn(*args, **kwargs), called in the model executor, for blocking code that runs outside of the event loop"""
+    return model_executor.submit(fn, *args, **kwargs).result()
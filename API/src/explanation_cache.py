@@ -0,0 +1,168 @@
+import json
+import time
+import hashlib
+import threading
+import sqlite3 as sql
+from collections import OrderedDict
+from typing import Optional
+from constants import ExplanationType, ResponseStatus, all_features, rename_dict, shap_background_mode, shap_background_size
+from models import ShapResponse, LimeResponse
+
+
+# shap and shap_orig (and lime and lime_orig) are computed the same way and share their cache entries
+cache_methods = {
+    ExplanationType.shap: "shap",
+    ExplanationType.shap_orig: "shap",
+    ExplanationType.lime: "lime",
+    ExplanationType.lime_orig: "lime"
+}
+cache_response_mapping = {
+    "shap": ShapResponse,
+    "lime": LimeResponse
+}
+
+
+def cache_key(instance, exp_method: ExplanationType, num_features: Optional[int]):
+    """Returns the canonical hash of an explanation request. It only depends on the 18 attribute values,
+    the explanation method and the number of features (LIME only) or the background of the KernelExplainer (SHAP only),
+    not on the id or the prediction of the instance. A persisted result of another background configuration is never returned."""
+    method = cache_methods[exp_method]
+    background = None
+    if method == "lime":
+        num_features = all_features if num_features is None else num_features
+    else:
+        num_features = None
+        background = [shap_background_mode, None if shap_background_mode == "full" else shap_background_size]
+    attributes = {}
+    for attr in rename_dict.values():
+        value = instance.__dict__[attr]
+        # 12 and 12.0 have to result in the same key
+        attributes[attr] = float(value) if isinstance(value, (int, float)) else value
+    canonical = json.dumps({"method": method, "num_features": num_features, "background": background, "attributes": attributes},
+                           sort_keys=True)
+    return method + ":" + hashlib.sha256(canonical.encode("UTF-8")).hexdigest()
+
+
+class ExplanationCache:
+    """Content-addressed cache for explanation results of the API process, the results of the explainer processes are resolved
+    by the collector thread of the JobTransport. The memory tier evicts the least recently used entries once it holds more than `max_entries`.
+    The optional disk tier is a SQLite file, that keeps about `max_disk_entries` results across restarts.
+    Concurrent identical requests are collapsed: only the first one (the leader) is computed, all others (followers)
+    receive the leader's result when it is resolved.
+    The disk tier is read and written outside the lock of the memory tier, so a slow disk never blocks the lookups.
+    """
+
+    def __init__(self, max_entries: int, disk_path: str = "", max_disk_entries: int = 10000):
+        """
+        :param max_entries: max. number of responses in memory
+        :param disk_path: path of the SQLite file for the disk tier, an empty string disables it
+        :param max_disk_entries: number of responses the disk tier keeps, it is trimmed in batches once it holds 10% more
+        """
+        self.entries = OrderedDict()  # cache key -> response, the least recently used first
+        self.inflight = {}  # cache key -> list of follower uuids of a job that is being computed
+        self.lock = threading.Lock()  # for the entries and inflight
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        self.max_disk_entries = max_disk_entries
+        self._disk_lock = threading.Lock()  # for the disk connection
+        self._con = None
+        self._disk_size = 0
+
+    def claim(self, key: str, uid):
+        """Looks up the key. Returns the cached response (or None) and whether the caller is the leader that has to compute it.
+        If the result is already being computed, the uid is registered as a follower and receives the result on `resolve`.
+        Can read the disk tier, so it is called in an executor."""
+        with self.lock:
+            response = self._get(key)
+            if response is not None:
+                return response, False
+        response = self._disk_get(key)
+        with self.lock:
+            if response is not None:
+                self._remember(key, response)
+                return response, False
+            if key in self.inflight:
+                self.inflight[key].append(uid)
+                return None, False
+            self.inflight[key] = []
+            return None, True
+
+    def resolve(self, key: str, response, results: dict):
+        """Writes the leader's response to the results of all followers and releases the key. Only terminated responses are
+        stored, after an error the next request computes the key again. Returns the follower uuids."""
+        with self.lock:
+            followers = self.inflight.pop(key, [])
+            for uid in followers:
+                results[uid] = response
+            if response.status == ResponseStatus.terminated:
+                self._remember(key, response)
+        if response.status == ResponseStatus.terminated:
+            self._disk_put(key, response)
+        return followers
+
+    def cancel(self, key: str, uid):
+        """Removes a cancelled request from the key. Returns True if the job computing the key can be aborted,
+        i.e. the uid is the leader and no follower waits for its result. Otherwise the leader keeps computing for its followers."""
+        with self.lock:
+            followers = self.inflight.get(key)
+            if followers is None:
+                return False
+            if uid in followers:
+                followers.remove(uid)
+                return False
+            if followers:
+                return False
+            del self.inflight[key]
+            return True
+
+    def _get(self, key: str):
+        # only called while holding the lock
+        response = self.entries.get(key)
+        if response is not None:
+            self.entries.move_to_end(key)
+        return response
+
+    def _remember(self, key: str, response):
+        # only called while holding the lock, the only place where the memory tier grows
+        self.entries[key] = response
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _disk_connection(self):
+        # only called while holding the disk lock
+        if self._con is None:
+            self._con = sql.connect(self.disk_path, timeout=10, check_same_thread=False)
+            self._con.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response JSON, last_used REAL)")
+            self._con.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+            self._con.commit()
+            self._disk_size = self._con.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return self._con
+
+    def _disk_get(self, key: str):
+        if not self.disk_path:
+            return None
+        with self._disk_lock:
+            con = self._disk_connection()
+            rows = con.execute("SELECT response FROM cache WHERE key = ?", (key,)).fetchall()
+            if len(rows) == 0:
+                return None
+            con.execute("UPDATE cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            con.commit()
+        method = key.split(":")[0]
+        return cache_response_mapping[method].parse_raw(rows[0][0])
+
+    def _disk_put(self, key: str, response):
+        if not self.disk_path:
+            return
+        with self._disk_lock:
+            con = self._disk_connection()
+            con.execute("INSERT OR REPLACE INTO cache (key, response, last_used) VALUES (?, ?, ?)",
+                        (key, response.json(by_alias=True), time.time()))
+            self._disk_size += 1  # replaced keys are counted too, they only make the next trim come earlier
+            if self._disk_size > self.max_disk_entries * 1.1:
+                # the least recently used entries are deleted in one batch, with the index on last_used
+                con.execute("DELETE FROM cache WHERE last_used < (SELECT last_used FROM cache ORDER BY last_used DESC LIMIT 1 OFFSET ?)",
+                            (self.max_disk_entries - 1,))
+                self._disk_size = con.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            con.commit()
@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import multiprocessing as mp
+from constants import *
+from resources import ResourceManager
+from database_req import create_connection, get_application, get_application_ids, create_explanation_tables, add_precomputed_explanation, \
+    get_precomputed_ids
+
+"""This script pregenerates the SHAP and LIME explanations of all loan applications in the applicants table
+and stores them in the shap and lime tables. Run it after database_creation.py.
+The explanations are computed in parallel (one process per core, can be changed with the first argument).
+Every explanation is committed as soon as it is computed, so an interrupted run can simply be restarted and
+only computes the missing explanations.
+"""
+
+explainers = None
+
+
+def init_worker(resources):
+    """Limits the threads of the pool process to its share of the cores and loads the explainers once per pool process"""
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+    from resources import apply_resources
+    apply_resources(resources)
+    global explainers
+    from task_gen import load_explainers
+    explainers = load_explainers()
+
+
+def explain_instance(task):
+    """Computes the missing explanations for one applicant. Returns the id and a dict table -> response in json format."""
+    from task_gen import shap_response, lime_response
+    from models import InstanceInfo
+    instance_id, tables = task
+    shap_explainer, cols, lh = explainers
+    con = create_connection(db_path)
+    instance = InstanceInfo.parse_obj(get_application(con, instance_id, json_str=True))
+    con.close()
+    out = {}
+    if shap_table in tables:
+        out[shap_table] = shap_response(instance, shap_explainer, cols).json(by_alias=True)
+    if lime_table in tables:
+        out[lime_table] = lime_response(instance, lh, all_features).json(by_alias=True)
+    return instance_id, out
+
+
+if __name__ == "__main__":
+    num_processes = int(sys.argv[1]) if len(sys.argv) > 1 else max(1, mp.cpu_count() - 1)
+
+    con = create_connection(db_path)
+    create_explanation_tables(con)
+    done = {table: get_precomputed_ids(con, table) for table in [shap_table, lime_table]}
+    # the ids of the applicants table, they are not necessarily 0..number_of_applications - 1
+    instance_ids = get_application_ids(con)
+    tasks = []
+    for instance_id in instance_ids:
+        missing = [table for table in [shap_table, lime_table] if instance_id not in done[table]]
+        if missing:
+            tasks.append((instance_id, missing))
+    print(f"\033[92mINFO:\033[0m {len(tasks)} of {len(instance_ids)} applications need explanations. Starting {num_processes} processes.")
+
+    start_time = time.time()
+    # all cores are used for the explanations, but every process only gets its share of them (see resources.py)
+    resources = ResourceManager(num_processes, worker_threads, worker_inter_op_threads, reserved_cores=0).acquire(0)
+    with mp.Pool(num_processes, initializer=init_worker, initargs=(resources,)) as pool:
+        for i, (instance_id, out) in enumerate(pool.imap_unordered(explain_instance, tasks)):
+            for table, explanation in out.items():
+                add_precomputed_explanation(con, table, instance_id, explanation)
+            print(f"      [{i + 1}/{len(tasks)}] stored explanations for application {instance_id} ({time.time() - start_time:.0f} s)")
+    con.close()
+    print("\033[92mINFO:\033[0m All explanations have been stored.")
@@ -0,0 +1,41 @@
+import json
+from fastapi.encoders import jsonable_encoder
+from pydantic import parse_obj_as
+from starlette.responses import JSONResponse
+from constants import fast_responses
+
+"""JSON encoding for the response path of the busiest endpoints (enabled with `FAST_RESPONSES=true`).
+The handlers return a `FastJSONResponse` with data that is already valid (rows of our own database, predictions, constant payloads),
+so FastAPI neither validates it against the response model again nor runs `jsonable_encoder` on it.
+The response models stay in the route decorators, the OpenAPI schema does not change.
+orjson is used if it is installed (`pip install orjson`), otherwise the standard library encoder.
+"""
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content) -> bytes:
+    """Encodes content (dicts, lists, str, int, float, bool, None) as compact UTF-8 JSON"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse that is encoded with `dumps`"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def model_response(model, content, exclude_none=False, headers=None):
+    """Returns the response for content with the response model (e.g. `List[InstanceInfo]`). Without FAST_RESPONSES, content is
+    validated and encoded like FastAPI does it for the response model of a route, otherwise it is encoded directly.
+    Large responses are created with this function in an executor, so the validation and encoding does not block the event loop.
+    """
+    if fast_responses:
+        return FastJSONResponse(content, headers=headers)
+    return JSONResponse(jsonable_encoder(parse_obj_as(model, content), by_alias=True, exclude_none=exclude_none), headers=headers)
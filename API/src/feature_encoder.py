@@ -0,0 +1,112 @@
+import threading
+import numpy as np
+from constants import attribute_constraints, attr_name, const_type, categorical, values, inv_rename
+
+
+class FeatureEncoder:
+    """Precompiled replacement for the transform of a fitted preprocessor (ColumnTransformer with a MinMaxScaler for the
+    numerical and a OneHotEncoder for the categorical attributes, like `preproc.pickle` or the preprocessors of the explainers).
+    The scale factors and the one-hot index tables are extracted once, afterwards a 2d array with raw or label-encoded values
+    is mapped straight into a float32 matrix without building a DataFrame or a sparse matrix.
+    Unknown categorical values are encoded as zeros, like `handle_unknown='ignore'`.
+    """
+
+    def __init__(self, preprocessor, input_columns: list):
+        """
+        :param preprocessor: the fitted ColumnTransformer
+        :param input_columns: the column names of the arrays that will be transformed, in their order
+        """
+        self.input_columns = list(input_columns)
+        self.num_indices = []
+        self.scale = np.empty(0)
+        self.offset = np.empty(0)
+        self.cat_tables = []  # (input column index, dict value -> output column, array code -> output column or None)
+        width = 0
+        for name, transformer, columns in preprocessor.transformers_:
+            if name == "remainder" or transformer == "drop":
+                continue
+            indices = [self.input_columns.index(col) for col in columns]
+            if hasattr(transformer, "categories_"):
+                for index, categories in zip(indices, transformer.categories_):
+                    self.cat_tables.append((index, *self._index_tables(categories, width)))
+                    width += len(categories)
+            else:
+                # MinMaxScaler: X * scale_ + min_
+                if width != 0:
+                    raise ValueError("The numerical attributes must be the first transformer")
+                self.num_indices = indices
+                self.scale = np.asarray(transformer.scale_, dtype=np.float64)
+                self.offset = np.asarray(transformer.min_, dtype=np.float64)
+                width += len(indices)
+        self.num_features = width
+        self._local = threading.local()
+
+    @staticmethod
+    def _index_tables(categories, start: int):
+        lookup = {category: start + i for i, category in enumerate(categories.tolist())}
+        code_table = None
+        if all(isinstance(c, (int, np.integer)) and c >= 0 for c in categories.tolist()):
+            # label-encoded categories can be looked up with an index array
+            code_table = np.full(max(categories.tolist()) + 1, -1, dtype=np.intp)
+            for category, column in lookup.items():
+                code_table[category] = column
+        return lookup, code_table
+
+    def _output(self, n: int):
+        """Returns a preallocated matrix of this thread for n rows"""
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None or len(buffer) < n:
+            buffer = np.empty((max(n, 1), self.num_features), dtype=np.float32)
+            self._local.buffer = buffer
+        return buffer[:n]
+
+    def _codes(self, column, lookup: dict, code_table):
+        if code_table is not None and column.dtype.kind in "fiu":
+            codes = column.astype(np.intp)
+            valid = (codes == column) & (codes >= 0) & (codes < len(code_table))
+            return np.where(valid, code_table[np.where(valid, codes, 0)], -1)
+        get = lookup.get
+        return np.array([get(v, -1) for v in column.tolist()], dtype=np.intp)
+
+    def transform(self, X, out=None):
+        """Encodes the rows of X (2d array with the columns in the order of `input_columns`, a single row may be 1d).
+        If no output matrix is passed, a preallocated matrix of the calling thread is used. It is overwritten by the next
+        call from the same thread, so the result must be consumed (e.g. predicted) before encoding again."""
+        X = np.asarray(X)
+        if X.ndim == 1:
+            X = X.reshape((1, -1))
+        n = len(X)
+        if out is None:
+            out = self._output(n)
+        num_width = len(self.num_indices)
+        if num_width > 0:
+            out[:, :num_width] = X[:, self.num_indices].astype(np.float64) * self.scale + self.offset
+        out[:, num_width:] = 0
+        rows = np.arange(n)
+        for index, lookup, code_table in self.cat_tables:
+            codes = self._codes(X[:, index], lookup, code_table)
+            known = codes >= 0
+            out[rows[known], codes[known]] = 1
+        return out
+
+    def unknown_values(self):
+        """Returns the values of `attribute_constraints` that have no one-hot column, i.e. that are ignored by the model.
+        Only attributes whose column names are in the input columns (raw or API names) are checked."""
+        unknown = {}
+        tables = {self.input_columns[index]: lookup for index, lookup, _ in self.cat_tables}
+        for constraint in attribute_constraints:
+            name = constraint[attr_name].value
+            if constraint[const_type] != categorical:
+                continue
+            lookup = tables.get(name, tables.get(inv_rename.get(name)))
+            if lookup is None:
+                continue
+            missing = [v for v in constraint[values] if v not in lookup]
+            if missing:
+                unknown[name] = missing
+        return unknown
+
+
+def records_to_array(records, columns: list):
+    """Builds the 2d input array for a FeatureEncoder from a list of dicts (e.g. instance attributes) in the given column order"""
+    return np.array([[record[col] for col in columns] for record in records], dtype=object)
@@ -0,0 +1,214 @@
+import os
+import json
+from abc import ABC, abstractmethod
+import numpy as np
+from constants import inference_backend, model_path, numpy_weights_path
+from feature_encoder import records_to_array
+
+"""Inference backends for the smote_ey model. All engines take the encoded matrix (see feature_encoder.py) and return
+the predicted probabilities for the label "Rejected" as a flat array. The backend is chosen at startup with `INFERENCE_BACKEND`:
+
+- keras: `model.predict` of the loaded SavedModel (large fixed overhead per call)
+- tf_function: the model traced once as a tf.function with a fixed input signature
+- numpy: a pure NumPy forward pass with the weights extracted from the SavedModel, does not import TensorFlow
+
+Run `python inference.py` to export the NumPy weights and to check the parity of all backends.
+"""
+
+
+class InferenceEngine(ABC):
+    """Base class for the inference backends"""
+    name = None
+
+    @abstractmethod
+    def predict(self, X) -> np.ndarray:
+        """Returns the predicted probabilities for the rows of the encoded matrix X as a flat array"""
+
+
+class KerasEngine(InferenceEngine):
+    name = "keras"
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, X):
+        return self.model.predict(X).reshape(-1)
+
+
+class TFFunctionEngine(InferenceEngine):
+    name = "tf_function"
+
+    def __init__(self, model):
+        import tensorflow as tf
+        self.model = model
+        num_features = model.input_shape[-1]
+        # fixed signature, so the function is only traced once for all batch sizes
+        self._fn = tf.function(lambda x: self.model(x, training=False),
+                               input_signature=[tf.TensorSpec(shape=[None, num_features], dtype=tf.float32)])
+
+    def predict(self, X):
+        return self._fn(np.asarray(X, dtype=np.float32)).numpy().reshape(-1)
+
+
+activations = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    "tanh": np.tanh,
+    "softmax": lambda x: np.exp(x - x.max(axis=1, keepdims=True)) / np.exp(x - x.max(axis=1, keepdims=True)).sum(axis=1, keepdims=True)
+}
+
+
+class NumpyEngine(InferenceEngine):
+    """Dense forward pass in NumPy. Supports Dense, Activation, Dropout (identity at inference) and BatchNormalization layers."""
+    name = "numpy"
+
+    def __init__(self, layers: list):
+        """
+        :param layers: list of (activation name, weight matrix, bias vector), batch normalizations are folded into
+        an affine layer with a diagonal weight vector
+        """
+        self.layers = [(activation, np.asarray(weights, dtype=np.float32), np.asarray(bias, dtype=np.float32))
+                       for activation, weights, bias in layers]
+        self.reference_inputs = None
+        self.reference_outputs = None
+
+    def predict(self, X):
+        out = np.asarray(X, dtype=np.float32)
+        for activation, weights, bias in self.layers:
+            out = (out @ weights if weights.ndim == 2 else out * weights) + bias
+            out = activations[activation](out)
+        return out.reshape(-1)
+
+    @classmethod
+    def from_keras(cls, model):
+        """Extracts the weights of the loaded SavedModel"""
+        layers = []
+        for layer in model.layers:
+            kind = type(layer).__name__
+            config = layer.get_config()
+            if kind == "Dense":
+                kernel, bias = layer.get_weights() if config["use_bias"] else (layer.get_weights()[0], None)
+                layers.append((config["activation"], kernel, bias if bias is not None else np.zeros(kernel.shape[1])))
+            elif kind == "BatchNormalization":
+                weights = dict(zip([w.name.split("/")[-1].split(":")[0] for w in layer.weights], layer.get_weights()))
+                std = np.sqrt(weights["moving_variance"] + config["epsilon"])
+                scale = weights.get("gamma", np.ones_like(std)) / std
+                layers.append(("linear", scale, weights.get("beta", np.zeros_like(std)) - weights["moving_mean"] * scale))
+            elif kind == "Activation":
+                layers.append((config["activation"], np.ones(1), np.zeros(1)))
+            elif kind in ["InputLayer", "Dropout"]:
+                continue
+            else:
+                raise ValueError(f"Layer type {kind} is not supported by the NumPy backend")
+        for activation, _, _ in layers:
+            if activation not in activations:
+                raise ValueError(f"Activation {activation} is not supported by the NumPy backend")
+        return cls(layers)
+
+    def save(self, path: str, reference_inputs=None, reference_outputs=None):
+        """Saves the weights (and optionally reference predictions of another backend for the parity check) as .npz"""
+        arrays = {"activations": np.array(json.dumps([activation for activation, _, _ in self.layers]))}
+        for i, (_, weights, bias) in enumerate(self.layers):
+            arrays[f"weights_{i}"] = weights
+            arrays[f"bias_{i}"] = bias
+        if reference_inputs is not None:
+            arrays["reference_inputs"] = reference_inputs
+            arrays["reference_outputs"] = reference_outputs
+        np.savez(path, **arrays)
+
+    @classmethod
+    def from_npz(cls, path: str):
+        stored = np.load(path)
+        layer_activations = json.loads(str(stored["activations"]))
+        engine = cls([(activation, stored[f"weights_{i}"], stored[f"bias_{i}"]) for i, activation in enumerate(layer_activations)])
+        if "reference_inputs" in stored:
+            engine.reference_inputs = stored["reference_inputs"]
+            engine.reference_outputs = stored["reference_outputs"]
+        return engine
+
+
+def check_parity(engine: InferenceEngine, X, expected, atol=1e-5):
+    """Compares the predictions of the engine for X with the expected predictions (e.g. of the keras backend).
+    Raises a ValueError if they differ by more than atol, otherwise returns the maximal absolute difference."""
+    difference = float(np.max(np.abs(engine.predict(X) - np.asarray(expected).reshape(-1))))
+    if difference > atol:
+        raise ValueError(f"The {engine.name} backend differs from the reference predictions by {difference}")
+    return difference
+
+
+def parity_inputs(num_features: int, n=256, seed=42):
+    """Random inputs in the value range of the encoded matrices (scaled numbers and one-hot values)"""
+    return np.random.RandomState(seed).uniform(0, 1, size=(n, num_features)).astype(np.float32)
+
+
+def export_numpy_weights(model, path: str = numpy_weights_path):
+    """Extracts the weights of the keras model and stores them together with keras reference predictions"""
+    engine = NumpyEngine.from_keras(model)
+    X = parity_inputs(model.input_shape[-1])
+    reference = model.predict(X).reshape(-1)
+    engine.save(path, X, reference)
+    engine.reference_inputs, engine.reference_outputs = X, reference
+    return engine
+
+
+def load_engine(backend: str = inference_backend, path: str = model_path, parity_check=True):
+    """Loads the model with the chosen backend. If parity_check is set, the predictions of the tf_function and numpy
+    backends are compared with the keras predictions (for numpy, with the reference predictions stored on export)."""
+    if backend == NumpyEngine.name:
+        if os.path.exists(numpy_weights_path):
+            engine = NumpyEngine.from_npz(numpy_weights_path)
+        else:
+            # TensorFlow is only needed once to extract the weights
+            from tensorflow.keras.models import load_model
+            engine = export_numpy_weights(load_model(path))
+        if parity_check and engine.reference_inputs is not None:
+            check_parity(engine, engine.reference_inputs, engine.reference_outputs)
+        return engine
+
+    from tensorflow.keras.models import load_model
+    model = load_model(path)
+    if backend == KerasEngine.name:
+        return KerasEngine(model)
+    if backend == TFFunctionEngine.name:
+        engine = TFFunctionEngine(model)
+        if parity_check:
+            X = parity_inputs(model.input_shape[-1])
+            check_parity(engine, X, model.predict(X))
+        return engine
+    raise ValueError(f"Unknown inference backend '{backend}'")
+
+
+def prediction_values(probability: float):
+    """Returns the NN_confidence and NN_recommendation for the predicted probability of the label "Rejected"."""
+    if probability < 0.5:
+        return 1 - probability, "Approve"
+    return probability, "Reject"
+
+
+def predict_records(engine: InferenceEngine, encoder, records: list, attributes: list):
+    """Returns the NN_confidence and NN_recommendation for every record (dict with the attribute values) with a single model call.
+    :param encoder: FeatureEncoder for the attributes
+    :param attributes: the names of the encoder's input columns in the records
+    """
+    if len(records) == 0:
+        return []
+    probabilities = engine.predict(encoder.transform(records_to_array(records, attributes)))
+    return [prediction_values(float(probability)) for probability in probabilities]
+
+
+if __name__ == "__main__":
+    import time
+    from tensorflow.keras.models import load_model
+    model = load_model(model_path)
+    export_numpy_weights(model)
+    print(f"\033[92mINFO:\033[0m NumPy weights exported to {numpy_weights_path}.")
+    X = parity_inputs(model.input_shape[-1])
+    reference = model.predict(X)
+    for backend in [KerasEngine.name, TFFunctionEngine.name, NumpyEngine.name]:
+        engine = load_engine(backend)
+        difference = check_parity(engine, X, reference)
+        start = time.time()
+        for _ in range(100):
+            engine.predict(X[:1])
+        print(f"      {backend:>12}: max. difference {difference:.2e}, {(time.time() - start) * 10:.3f} ms per single-row prediction")
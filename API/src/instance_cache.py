@@ -0,0 +1,105 @@
+import hashlib
+import threading
+from typing import Callable, Optional
+from starlette.responses import Response
+from starlette.status import HTTP_304_NOT_MODIFIED
+from database_req import ConnectionPool, get_all_applications, get_data_version
+from models import InstanceInfo, DiceCounterfactualResponse
+
+
+class CachedResponse:
+    """Prerendered JSON response with its strong ETag"""
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+    def response(self, if_none_match: Optional[str] = None):
+        """Returns 304 Not Modified if the client already has this version (If-None-Match header), otherwise the body."""
+        headers = {"ETag": self.etag, "Cache-Control": "no-cache"}
+        if if_none_match and matches(if_none_match, self.etag):
+            return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(content=self.body, media_type="application/json", headers=headers)
+
+
+def matches(if_none_match: str, etag: str):
+    """Checks the If-None-Match header against the ETag (weak comparison, as required for If-None-Match)"""
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+class InstanceCache:
+    """Immutable cache of the dataset instances and their DiCE responses. The instances are loaded at startup, the DiCE responses
+    when they are requested the first time. Both are kept as prerendered JSON with a strong ETag.
+    Nothing in the cache is ever changed. The applicants and dice tables are static, only `database_creation.py` rebuilds them and
+    bumps the data version of the database (see `bump_data_version`), then the whole cache is dropped and loaded again.
+    Writes to the other tables (e.g. the experiment results) don't affect the cache.
+    """
+
+    def __init__(self, pool: ConnectionPool, dice_loader: Callable):
+        """
+        :param pool: connection pool of the database (read-only is sufficient)
+        :param dice_loader: function (connection, instance id, instance dict) -> DiCE response dict of the instance
+        """
+        self.pool = pool
+        self.dice_loader = dice_loader
+        self._lock = threading.Lock()
+        self._version = None
+        self.load()
+
+    def load(self):
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        con = self.pool.connection()
+        version = get_data_version(con)
+        records = {}
+        instances = {}
+        for record in get_all_applications(con):
+            records[record["id"]] = record
+            instances[record["id"]] = CachedResponse(InstanceInfo.parse_obj(record).json(by_alias=True).encode("UTF-8"))
+        self._records = records
+        self._instances = instances
+        self._dice = {}
+        self._version = version
+
+    def _check(self):
+        # reads a value of the database header, much cheaper than a query of the tables
+        if get_data_version(self.pool.connection()) != self._version:
+            with self._lock:
+                if get_data_version(self.pool.connection()) != self._version:
+                    self._load()
+
+    def record(self, instance_id: int):
+        """Returns the instance attributes as a dict (must not be modified) or None if there is no such instance.
+        Doesn't check the data version, so it can be called on the event loop."""
+        return self._records.get(instance_id)
+
+    def instance(self, instance_id: int):
+        """Returns the CachedResponse of the instance or None if there is no such instance."""
+        self._check()
+        return self._instances.get(instance_id)
+
+    def dice(self, instance_id: int):
+        """Returns the CachedResponse with the counterfactuals of the instance or None if there is no such instance."""
+        self._check()
+        cached = self._dice.get(instance_id)
+        if cached is None:
+            record = self._records.get(instance_id)
+            if record is None:
+                return None
+            with self._lock:
+                cached = self._dice.get(instance_id)
+                if cached is None:
+                    response = DiceCounterfactualResponse.parse_obj(self.dice_loader(self.pool.connection(), instance_id, record))
+                    cached = CachedResponse(response.json(by_alias=True, exclude_none=True).encode("UTF-8"))
+                    self._dice[instance_id] = cached
+        return cached
@@ -0,0 +1,264 @@
+import time
+import heapq
+import itertools
+from collections import deque
+import threading
+import multiprocessing as mp
+from typing import Callable, List, Optional
+from constants import JobPriority
+from explanation_cache import cache_methods
+from task_gen import failed_response
+
+"""Transport of the explanation jobs between the API process and the explainer processes (see `explanation_worker` in task_gen.py).
+The explainers are split into a SHAP and a LIME pool, so slow SHAP jobs can't occupy every worker while LIME jobs are waiting.
+The queued jobs stay in one priority queue per pool in the API process: interactive jobs are dispatched before background jobs,
+jobs of the same class in the order they were submitted. An idle worker takes the next job of its own pool, if there is none,
+it takes over (steals) the next job of the other pool, as long as `steal_reserve` workers of its pool stay idle. A worker that steals
+loads the explainer of the other pool as well and keeps both in memory, the autoscaler reserves the memory for it (see autoscaler.py).
+Every explainer has its own `multiprocessing.Queue` (a pipe) and only gets a job when it is idle, so a queued job can still be
+cancelled or overtaken. Workers can be added and retired while the API is running (see autoscaler.py), a new worker only gets jobs
+once it has loaded its explainer. The finished responses come back through a shared queue.
+A collector thread of the API process writes them into the results, so the status polls are a local O(1) lookup by uid and
+no Manager process is involved. Every response is pickled exactly once, when the explainer sends it.
+`benchmark_job_transport.py` compares the overhead per job with the Manager queue and dict used before.
+"""
+
+priority_rank = {JobPriority.interactive: 0, JobPriority.background: 1}
+pool_names = ["shap", "lime"]
+# the explainer processes are spawned instead of forked: they start without the TensorFlow runtime and the thread pools of the
+# API process, so their thread limits (see resources.py) take effect. Their queues have to be created with the same context.
+mp_context = mp.get_context("spawn")
+
+
+def pool_layout(num_workers: int, shap_workers: Optional[int] = None, lime_workers: Optional[int] = None):
+    """Returns the pool of every explainer process. Without configured sizes a third of the workers (at least one) explain LIME jobs.
+    If both sizes are given, they determine the number of workers."""
+    if shap_workers is None and lime_workers is None:
+        lime_workers = max(1, num_workers // 3) if num_workers > 1 else 0
+    if shap_workers is None:
+        shap_workers = max(num_workers - lime_workers, 0)
+    if lime_workers is None:
+        lime_workers = max(num_workers - shap_workers, 0)
+    return ["shap"] * shap_workers + ["lime"] * lime_workers
+
+
+def job_pool(job):
+    """The pool whose workers explain the job"""
+    return cache_methods.get(job.exp_type, "shap")
+
+
+class JobTransport:
+    """Job queues and result channel of the explainer processes, owned by the API process"""
+
+    def __init__(self, results, on_result: Optional[Callable] = None, pools: List[str] = ("shap",), steal_reserve: int = 1):
+        """
+        :param results: dict uid -> response of the API process, receives the finished responses
+        :param on_result: called by the collector thread with (uid, response, cache key) after the response has been stored
+        :param pools: the pool ("shap" or "lime") of every explainer process, each one gets the arguments of `worker_args`
+        :param steal_reserve: number of idle workers a pool keeps for its own jobs, before it takes over jobs of the other pool
+        """
+        self.results = results
+        self.on_result = on_result
+        self.pools = list(pools)
+        self.steal_reserve = steal_reserve
+        self.jobs = [mp_context.Queue() for _ in self.pools]  # Job objects, one queue per explainer process
+        self.aborts = [mp_context.Value("q", -1, lock=False) for _ in self.pools]  # seq of the job the explainer has to abort
+        self.done = mp_context.Queue()  # (worker id, uid, response, cache key) tuples of the finished (or aborted) jobs
+        self._queues = {pool: [] for pool in pool_names}  # heaps of (priority rank, seq, job)
+        self._queued = {}  # uid -> seq of the jobs in the heaps, cancelled jobs are removed lazily
+        self._running = {}  # uid -> (worker id, job)
+        self._idle = {pool: [] for pool in pool_names}  # ids of the explainers without a job
+        self._sizes = {pool: self.pools.count(pool) for pool in pool_names}  # workers that haven't been retired
+        self._starting = set(range(len(self.pools)))  # ids of the explainers that haven't sent their ready message yet
+        self._retired = set()
+        self._loaded = [{pool} for pool in self.pools]  # pools whose explainer the worker has loaded (or will load for its job)
+        self._started = {}  # uid -> time.monotonic() when the job was handed to an explainer
+        self._service_times = {pool: deque(maxlen=32) for pool in pool_names}  # seconds of the last finished jobs
+        self._dropped = set()  # uids of cancelled or dropped running jobs, their responses are not stored
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._collector = None
+        self.cancelled = 0
+        self.stolen = 0
+
+    def worker_args(self, worker_id: int):
+        """The arguments of `explanation_worker` for the explainer with the given id"""
+        return self.jobs[worker_id], self.done, self.aborts[worker_id], worker_id, self.pools[worker_id]
+
+    def add_worker(self, pool: str):
+        """Adds a worker to the pool and returns its id, the explainer process has to be started with `worker_args(id)`.
+        It gets jobs once it has sent its ready message."""
+        with self._lock:
+            self.jobs.append(mp_context.Queue())
+            self.aborts.append(mp_context.Value("q", -1, lock=False))
+            self.pools.append(pool)
+            self._loaded.append({pool})
+            self._sizes[pool] += 1
+            worker_id = len(self.pools) - 1
+            self._starting.add(worker_id)
+            return worker_id
+
+    def retire_worker(self, pool: str):
+        """Stops an idle worker of the pool, the explainer process exits. Returns its id or None if no worker of the pool is idle."""
+        with self._lock:
+            if not self._idle[pool]:
+                return None
+            worker_id = self._idle[pool].pop(0)
+            self._sizes[pool] -= 1
+            self._retired.add(worker_id)
+            self.jobs[worker_id].put(None)
+            self.jobs[worker_id].close()
+            return worker_id
+
+    def worker_exited(self, worker_id: int):
+        """Removes a worker whose explainer process has exited without being retired (e.g. it crashed or ran out of memory).
+        Its running job fails with the error status, like a job whose explanation raised an exception.
+        Returns the uid of the failed job or None."""
+        with self._lock:
+            if worker_id in self._retired:
+                return None
+            pool = self.pools[worker_id]
+            self._retired.add(worker_id)
+            self._sizes[pool] -= 1
+            self._starting.discard(worker_id)
+            if worker_id in self._idle[pool]:
+                self._idle[pool].remove(worker_id)
+            uid = next((uid for uid, (w, job) in self._running.items() if w == worker_id), None)
+            if uid is not None:
+                worker_id, job = self._running.pop(uid)
+                self._started.pop(uid, None)
+                dropped = uid in self._dropped
+                self._dropped.discard(uid)
+            self._dispatch()  # the other pool takes over the queued jobs if this was the last worker of the pool
+        if uid is not None:
+            self._finish(uid, failed_response(job), job.cache_key, dropped)
+        return uid
+
+    def start(self):
+        """Starts the collector thread. The explainers announce themselves with a message without uid once they are ready."""
+        self._collector = threading.Thread(target=self._collect, name="job-collector", daemon=True)
+        self._collector.start()
+
+    def stop(self):
+        """Stops the collector thread after all responses that have been sent so far are stored."""
+        if self._collector is not None:
+            self.done.put(None)
+            self._collector.join()
+            self._collector = None
+
+    def submit(self, job):
+        """Queues the job by its pool and priority and hands it to an idle explainer process, if there is one"""
+        with self._lock:
+            job.seq = next(self._seq)
+            heapq.heappush(self._queues[job_pool(job)], (priority_rank[job.priority], job.seq, job))
+            self._queued[job.uid] = job.seq
+            self._dispatch()
+
+    def cancel(self, uid):
+        """Cancels the job: a queued job is removed, the explainer of a running job is signalled to abort it.
+        Returns "queued", "running" or None if the job is neither queued nor running."""
+        with self._lock:
+            if self._queued.pop(uid, None) is not None:
+                self.cancelled += 1
+                return "queued"
+            if uid in self._running:
+                worker_id, job = self._running[uid]
+                self._dropped.add(uid)
+                self.aborts[worker_id].value = job.seq
+                self.cancelled += 1
+                return "running"
+            return None
+
+    def drop(self, uid):
+        """The job is still computed, but its response is not stored in the results, only passed to `on_result`
+        (e.g. for the followers of a cancelled leader in the ExplanationCache)."""
+        with self._lock:
+            if uid in self._queued or uid in self._running:
+                self._dropped.add(uid)
+
+    def metrics(self):
+        """Returns per pool the number of workers (starting ones included), queued jobs per priority class, running jobs, idle
+        and starting workers, workers that have loaded both explainers and the mean duration of the last finished jobs (seconds),
+        and the number of cancelled and stolen jobs"""
+        with self._lock:
+            pools = {}
+            for pool in pool_names:
+                queued = {priority.value: 0 for priority in priority_rank}
+                for rank, seq, job in self._queues[pool]:
+                    if self._queued.get(job.uid) == seq:
+                        queued[job.priority.value] += 1
+                running = sum(1 for worker_id, job in self._running.values() if self.pools[worker_id] == pool)
+                starting = sum(1 for worker_id in self._starting if self.pools[worker_id] == pool)
+                both = sum(1 for worker_id, loaded in enumerate(self._loaded)
+                           if self.pools[worker_id] == pool and worker_id not in self._retired and len(loaded) > 1)
+                service_times = self._service_times[pool]
+                pools[pool] = {"workers": self._sizes[pool], "queued": queued, "running": running,
+                               "idle_workers": len(self._idle[pool]), "starting_workers": starting, "both_explainers": both,
+                               "service_seconds": sum(service_times) / len(service_times) if service_times else None}
+            return {"pools": pools, "cancelled": self.cancelled, "stolen": self.stolen}
+
+    def _peek(self, pool: str):
+        # only called while holding the lock, removes the cancelled jobs at the top of the heap
+        queue = self._queues[pool]
+        while queue and self._queued.get(queue[0][2].uid) != queue[0][1]:
+            heapq.heappop(queue)
+        return queue[0] if queue else None
+
+    def _start_job(self, pool: str, worker_id: int):
+        rank, seq, job = heapq.heappop(self._queues[pool])
+        del self._queued[job.uid]
+        self._running[job.uid] = (worker_id, job)
+        self._loaded[worker_id].add(pool)
+        self._started[job.uid] = time.monotonic()
+        self.jobs[worker_id].put(job)
+
+    def _dispatch(self):
+        # only called while holding the lock
+        for pool in pool_names:
+            while self._idle[pool] and self._peek(pool) is not None:
+                self._start_job(pool, self._idle[pool].pop())
+        # the remaining idle workers take over the most urgent job of the other pool
+        for pool in pool_names:
+            while self._idle[pool]:
+                candidates = [(self._peek(other), other) for other in pool_names if other != pool]
+                candidates = [(top, other) for top, other in candidates if top is not None
+                              and (len(self._idle[pool]) > self.steal_reserve or self._sizes[other] == 0)]
+                if not candidates:
+                    break
+                top, other = min(candidates, key=lambda candidate: candidate[0][:2])
+                self._start_job(other, self._idle[pool].pop())
+                if self._sizes[other] > 0:
+                    self.stolen += 1
+
+    def _collect(self):
+        while True:
+            item = self.done.get()
+            if item is None:
+                return
+            worker_id, uid, response, key = item
+            with self._lock:
+                if uid is not None and uid not in self._running:
+                    continue  # the job has already failed, its explainer has exited (see worker_exited)
+                dropped = uid in self._dropped
+                self._dropped.discard(uid)
+                self._running.pop(uid, None)
+                self._starting.discard(worker_id)
+                started = self._started.pop(uid, None)
+                if started is not None and response is not None:
+                    self._service_times[self.pools[worker_id]].append(time.monotonic() - started)
+                if worker_id not in self._retired:
+                    self._idle[self.pools[worker_id]].append(worker_id)
+                self._dispatch()
+            if uid is None:
+                continue  # the explainer is ready
+            if response is not None:
+                self._finish(uid, response, key, dropped)
+
+    def _finish(self, uid, response, key: Optional[str], dropped: bool):
+        if not dropped:
+            self.results[uid] = response
+        if self.on_result is not None:
+            try:
+                self.on_result(uid, response, key)
+            except Exception as e:
+                print(f"\033[93mWARNING:\033[0m Finishing the explanation with uuid {uid} failed: {e!r}")
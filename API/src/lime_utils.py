@@ -2,13 +2,14 @@ import pandas as pd
 import numpy as np
 import lime
 import lime.lime_tabular
-from tensorflow.keras.models import load_model
 from DataLoader_ey import data_loader 
 from sklearn.preprocessing import OneHotEncoder, MinMaxScaler
 from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import LabelEncoder
 from constants import rename_dict, AttributeNames, lime_exp_mapping, attr_name, influence
 import json
+from feature_encoder import FeatureEncoder
+from inference import load_engine
 
 class LimeHelper():
     """Class for Lime Explanations.
@@ -21,8 +22,8 @@ class LimeHelper():
         # Read credit data
         data = data_loader()
         self.data = data
-        # Load tensorflow model
-        self.model = load_model('smote_ey.tf')
+        # Load the model with the configured inference backend
+        self.model = load_engine()
         #steps from data_preprocess
         data.rename(columns=rename_dict, inplace=True)
         X_train = data.drop(columns='label')
@@ -48,6 +49,7 @@ class LimeHelper():
         preprocessor_le.fit(X_train)
         self.encoders = encoders
         self.prep = preprocessor_le
+        self.encoder = FeatureEncoder(preprocessor_le, feature_names)
         self.X_train = X_train
         self.explainer = lime.lime_tabular.LimeTabularExplainer(X_train.values, feature_names=feature_names,
                                                     class_names=['Approved', 'Rejected'],
@@ -62,11 +64,10 @@ class LimeHelper():
         """
         # Single data point has dimensions (18,) but (1, 18) is needed for preprocessing
         # Therefore, reshape input to (-1, 18)
-        X_df = pd.DataFrame(X.reshape((-1, 18)), columns=self.X_train.columns)
-        # Preprocess input and create nd-array
-        X_transformed = self.prep.transform(X_df).toarray()
-        # model.predict output has shape (n, 1) but (n,) is needed
-        prob = self.model.predict(X_transformed).reshape(-1, )
+        # Preprocess the label encoded input into a dense nd-array
+        X_transformed = self.encoder.transform(X.reshape((-1, 18)))
+        # the inference engines already return the shape (n,)
+        prob = self.model.predict(X_transformed)
         # Return predictions in correct format, dim = (n, 2), note that the first entry
         # has to represent P(y=0 | X)
         proba_predictions = np.array([1 - prob, prob]).transpose()
@@ -106,15 +107,16 @@ class LimeHelper():
         lime_exp = self.explainer.explain_instance(data_le, prediction_function, num_features=num_features)
         return lime_exp
     
-    def compute_response_lime(self,instance, num_features=6):
+    def compute_response_lime(self,instance, num_features=6, prediction_function=None):
         """
         Method that can be called by the API after initializing the LimeHelper
         :param instance: given Instance info, should be in json format
+        :param prediction_function: optional replacement for predict_fn, e.g. a StackedPredictor for batch jobs
         :return: a list of jsons with the keys attribute and influence
         """
         instance_df = pd.DataFrame(instance, index = [0])
         instance_df.drop(columns=["ident",AttributeNames.NN_recommendation.value,AttributeNames.NN_confidence.value], inplace=True) # TODO if pydantic model changes, this must change to!
-        exp = self.get_lime_exp(self.predict_fn, instance_df, num_features)
+        exp = self.get_lime_exp(prediction_function or self.predict_fn, instance_df, num_features)
         exp_dict = exp.__dict__
         #exp_dict also contains keys random_state,mode,domain_mapper,intercepts,score,local_pred,predict_proba, class_names,top_labels that are not needed
         local_exp = exp_dict['local_exp']
@@ -1,28 +1,43 @@
 import os
 import uvicorn
 import multiprocessing as mp
-from tensorflow.keras.models import load_model
+import threading
 import pandas as pd
 import pickle
 import psutil
 import hashlib
 
-from starlette.status import HTTP_202_ACCEPTED, HTTP_401_UNAUTHORIZED, HTTP_404_NOT_FOUND, HTTP_400_BAD_REQUEST
+from starlette.status import HTTP_202_ACCEPTED, HTTP_401_UNAUTHORIZED, HTTP_404_NOT_FOUND, HTTP_400_BAD_REQUEST, HTTP_422_UNPROCESSABLE_ENTITY
 from starlette.background import BackgroundTask
 import json
 
 from typing import Any, Optional, List, Union
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request, Response, Header
+from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError, parse_obj_as
 from fastapi.params import Body
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from task_gen import explanation_worker
 from task_gen import Job
+from explanation_cache import ExplanationCache, cache_key
+from job_transport import JobTransport, pool_layout, mp_context
+from autoscaler import WorkerSupervisor
+from resources import ResourceManager
+from result_store import ExpiringResultStore
+from result_waiters import ResultWaiters, wait_for
 from typing import Dict
 from uuid import UUID
 from constants import *
 from models import *
 from fastapi.middleware.cors import CORSMiddleware
 from database_req import *
+from feature_encoder import FeatureEncoder, records_to_array
+from inference import load_engine, prediction_values, predict_records
+from batching import PredictionBatcher
+from columnar_store import ColumnarStore, facet_counts
+from instance_cache import InstanceCache
+from fast_json import FastJSONResponse, dumps, model_response
+from executors import model_executor, run_db, run_query, run_model, call_model
 
 API_description = '''
 # TSE: Explainable Artificial Intelligence - API
@@ -55,20 +70,66 @@ tags_metadata = [
 
 app = FastAPI(description=API_description, openapi_tags=tags_metadata)
 
-manager = None
-num_processes = None
-process_ids = []
-task_queue = None  # tasks will be inputted here
-results: Dict[UUID, Any] = {}  # finished tasks will be inputted here
+# Modification
+# Add mapping for shap_orig
+response_mapping = {
+    ExplanationType.lime:      LimeResponse,
+    ExplanationType.lime_orig:      LimeResponse,
+    ExplanationType.shap:      ShapResponse,
+    ExplanationType.shap_orig: ShapResponse
+}
+
+transport: JobTransport = None  # tasks will be inputted here
+supervisor: WorkerSupervisor = None  # starts and stops the explainer processes
+resource_manager: ResourceManager = None  # thread budget and cores of the explainer processes
+# finished tasks will be inputted here (by the collector thread of the transport), they expire after timeout_seconds
+results = ExpiringResultStore(result_ttl_extend_on_read)
+waiters = ResultWaiters()  # long polls and event streams waiting for a result
+# jobs that are queued or computed (including the followers in the cache) and the latest job of every view, see cancel_job
+pending_jobs: Dict[UUID, Job] = {}
+view_jobs: Dict[str, UUID] = {}
+jobs_lock = threading.Lock()
 #os.chdir("c:/Users/D073188/Documents/GitHub/Interactive_xai/API/src")
-tf_model = load_model("./smote_ey.tf")
 
 # hash for admin password, not secure, idea is only to
 admin_pwd_hash = '5adfb2c0eca0935eede2af480a5d60b7481ee308ef8c0a14b4e0d367067d8842'
 
-# This preprocessor was pickled in python 3.8.12.
-# It follows the steps from data_loader_ey, except that the preprocessor is returned
-preprocessor = pickle.load(open("preproc.pickle", "rb"))
+# State of the API process. The spawned explainer processes import this module as __mp_main__ (see job_transport.py), they only
+# need explanation_worker and must not load the model, the databases and the caches of the API before their limits are set.
+if __name__ != "__mp_main__":
+    # explanation results by request content, the finished jobs are resolved by the collector thread
+    cache = ExplanationCache(explanation_cache_size, explanation_cache_path, explanation_cache_disk_size)
+    # smote_ey model with the inference backend chosen at startup (INFERENCE_BACKEND)
+    inference_engine = load_engine()
+
+    # This preprocessor was pickled in python 3.8.12.
+    # It follows the steps from data_loader_ey, except that the preprocessor is returned
+    preprocessor = pickle.load(open("preproc.pickle", "rb"))
+    # Precompiled version of the preprocessor for the attributes in the model order (API names)
+    encoder = FeatureEncoder(preprocessor, feature_names_model_ordered)
+    model_attributes = [rename_dict[col] for col in feature_names_model_ordered]
+
+    # concurrent /instance/predict requests are predicted together, the rows are encoded in the model executor
+    prediction_batcher = PredictionBatcher(lambda X: inference_engine.predict(encoder.transform(X)),
+                                           predict_batch_window_ms / 1000, predict_max_batch_size, model_executor)
+
+    # database connections are kept open per thread, the static tables are read with read-only connections
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(f"The database {db_path} does not exist, create it with database_creation.py")
+    db_pool = ConnectionPool(db_path)
+    read_pool = ConnectionPool(db_path, read_only=True)
+
+    # immutable instances and DiCE responses for /instance/{id} and /explanations/dice (the helper functions are defined below)
+    instance_cache = InstanceCache(read_pool, lambda con, instance_id, instance: dice_response(con, instance_id, instance))
+
+    # in-memory applicants table for /table (TABLE_ENGINE=columnar), otherwise the table is queried with SQL
+    columnar_store: ColumnarStore = None
+    if table_engine == "columnar":
+        columnar_store = ColumnarStore.from_database(read_pool.connection())
+
+    # the attribute information is constant, it is validated and encoded once
+    attribute_information_body = dumps(jsonable_encoder(
+        parse_obj_as(List[Union[CategoricalInformation, ContinuousInformation]], attribute_constraints), by_alias=True, exclude_none=True))
 
 # This is necessary for allowing access to the API from different origins
 app.add_middleware(
@@ -77,6 +138,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[next_cursor_header],
 )
 
 # api requests start here
@@ -85,29 +147,56 @@ app.add_middleware(
 # second parameter makes sure that unused stuff won't be included in the response
 @app.post("/table", response_model=List[InstanceInfo], response_model_exclude_none=True, tags=["Dataset"])
 async def table_view(request: TableRequest):
-    '''Returns a list of "limit" instances for the table view from a specific offset. Can have filters and chosen attributes, aswell as sorting.'''
-    con = create_connection(db_path)
+    '''Returns a list of "limit" instances for the table view from a specific offset. Can have filters and chosen attributes, aswell as sorting.
+    If there are more instances, the `X-Next-Cursor` header contains the cursor of the next page. Sending it as `cursor` (with the same filters
+    and sorting) returns the next page, which is faster than an offset for deep pages.'''
     attributes = []
     for i in request.attributes:
         attributes.append(i.value)
     attributes.append(AttributeNames.NN_recommendation.value)
     attributes.append(AttributeNames.NN_confidence.value)
-    table_Response = get_applications_custom(con, request.offset, attributes, request.limit,
-                                             json_str=True, filters=request.filter, sort=request.sort_by, sort_asc=request.sort_ascending)
-    con.close()
-    return table_Response
+
+    def table_page(con):
+        if columnar_store is not None:
+            table_Response, next_cursor = columnar_store.page(attributes, request.limit, filters=request.filter, sort=request.sort_by,
+                                                              sort_asc=request.sort_ascending, start=request.offset, cursor=request.cursor)
+        else:
+            table_Response, next_cursor = get_applications_keyset(con, attributes, request.limit, filters=request.filter, sort=request.sort_by,
+                                                                  sort_asc=request.sort_ascending, start=request.offset, cursor=request.cursor)
+        # with FAST_RESPONSES the rows from our own database are not validated against InstanceInfo again
+        return model_response(List[InstanceInfo], table_Response, exclude_none=True,
+                              headers={next_cursor_header: next_cursor} if next_cursor else None)
+
+    try:
+        # the page is queried and encoded in the database executor
+        return await run_query(read_pool, table_page)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@app.post("/table/facets", response_model=FacetResponse, tags=["Dataset"])
+async def table_facets(request: FacetRequest):
+    '''Returns the number of instances that match the filters, their counts per value of every categorical attribute
+    (including `NN_recommendation`) and histograms with "bins" bins between the bounds of every continuous attribute.'''
+    if columnar_store is not None:
+        facets = await run_db(columnar_store.facets, request.filter, request.num_bins)
+    else:
+        columns = [AttributeNames.ident.value] + [constraint[attr_name].value for constraint in attribute_constraints]
+        facets = await run_query(read_pool, lambda con: facet_counts(get_filtered_columns(con, columns, request.filter), request.num_bins))
+    if fast_responses:
+        return FastJSONResponse(facets)
+    return facets
 
 
 @app.get("/instance/{id}", response_model=InstanceInfo, tags=["Dataset"])
-async def entire_instance_by_id(id: int):
-    '''Returns the values for a loan application in the dataset, aswell as the corresponding AI recommendation and confidence provided by the `smote_ey` tensorflow model.'''
+async def entire_instance_by_id(id: int, if_none_match: Optional[str] = Header(None)):
+    '''Returns the values for a loan application in the dataset, aswell as the corresponding AI recommendation and confidence provided by the `smote_ey` tensorflow model.
+    The response has an `ETag`, requests with a matching `If-None-Match` header are answered with 304 Not Modified.'''
     if id > number_of_applications - 1 or id < 0:
         raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail={
                             "min": 0, "max": number_of_applications - 1})
-    con = create_connection("database.db")
-    output = get_application(con, id, json_str=True)
-    con.close()
-    return output
+    cached = await run_db(instance_cache.instance, id)
+    return cached.response(if_none_match)
 
 
 @app.post("/instance/predict", response_model=PredictionResponse, tags=["Dataset"])
@@ -117,30 +206,83 @@ async def predict_instance(instance: ModelInstanceInfo):
     # Checks if the provided categorical values are correctly specified, throws HTTP exception if not
     check_cat_values(instance)
 
-    data_dict = {col: [instance.__dict__[rename_dict[col]]]
-                 for col in feature_names_model_ordered}
     # Only works when all attributes are provided correctly
-    df = pd.DataFrame(data_dict)
-    data_to_predict = preprocessor.transform(df)
-    prediction = tf_model.predict(data_to_predict)[0][0]  # list in list
-    if prediction < 0.5:
-        confidence = 1 - prediction
-        recommendation = "Approve"
-    else:
-        confidence = prediction
-        recommendation = "Reject"
+    prediction = await prediction_batcher.predict(
+        records_to_array([instance.__dict__], model_attributes)[0])
+    confidence, recommendation = prediction_values(prediction)
 
     res = PredictionResponse(NN_confidence=confidence,
                              NN_recommendation=recommendation)
     return res
 
 
+@app.post("/instance/predict/batch", response_model=List[PredictionResponse], tags=["Dataset"],
+          openapi_extra={"requestBody": {"required": True, "content": {
+              "application/json": {"schema": {"oneOf": [
+                  {"type": "array", "items": {"$ref": "#/components/schemas/ModelInstanceInfo"}},
+                  {"type": "object", "additionalProperties": {"type": "array", "items": {}},
+                   "description": "columnar payload: attribute name -> list of values"}]}},
+              "application/x-ndjson": {"schema": {"type": "string", "description": "one ModelInstanceInfo JSON object per line"}}}}})
+async def predict_instances(request: Request):
+    """Predicts several loan applications with a single call of the `smote_ey` model. The applications can be sent as a JSON array of
+    `ModelInstanceInfo` objects, as a columnar JSON object (attribute name -> list of values) or as NDJSON (`Content-Type: application/x-ndjson`,
+    one object per line). Returns one `PredictionResponse` per application in the same order."""
+    body = await request.body()
+    ndjson = request.headers.get("content-type", "").startswith("application/x-ndjson")
+
+    def parse_body():
+        try:
+            if ndjson:
+                rows = [json.loads(line) for line in body.splitlines() if line.strip()]
+            else:
+                rows = json.loads(body)
+                if isinstance(rows, dict):
+                    # columnar payload
+                    if not all(isinstance(col, list) for col in rows.values()):
+                        raise HTTPException(HTTP_400_BAD_REQUEST, "Every column must be a list of values")
+                    lengths = {len(col) for col in rows.values()}
+                    if len(lengths) > 1:
+                        raise HTTPException(HTTP_400_BAD_REQUEST, "All columns must have the same length")
+                    rows = [dict(zip(rows.keys(), vals)) for vals in zip(*rows.values())]
+        except ValueError:
+            raise HTTPException(HTTP_400_BAD_REQUEST, "The request body must be JSON or NDJSON")
+        if not isinstance(rows, list) or len(rows) == 0:
+            raise HTTPException(HTTP_400_BAD_REQUEST, "Please provide at least one application")
+        if len(rows) > predict_batch_limit:
+            raise HTTPException(HTTP_400_BAD_REQUEST, f"At most {predict_batch_limit} applications can be predicted at once")
+
+        instances = []
+        errors = []
+        for i, row in enumerate(rows):
+            try:
+                instances.append(ModelInstanceInfo.parse_obj(row))
+            except ValidationError as e:
+                errors.append({"index": i, "errors": e.errors()})
+        if errors:
+            raise HTTPException(HTTP_422_UNPROCESSABLE_ENTITY, errors)
+        check_cat_values_bulk(instances)
+
+        return records_to_array([instance.__dict__ for instance in instances], model_attributes)
+
+    def render(predictions):
+        response = []
+        for prediction in predictions:
+            confidence, recommendation = prediction_values(prediction)
+            response.append({AttributeNames.NN_confidence.value: confidence,
+                             AttributeNames.NN_recommendation.value: recommendation})
+        return model_response(List[PredictionResponse], response)
+
+    # the rows are parsed, validated and rendered in the database executor, only the encoding and the model call occupy the
+    # model executor, so a large batch doesn't hold up the micro-batches of /instance/predict while it is validated
+    X = await run_db(parse_body)
+    predictions = await run_model(lambda: inference_engine.predict(encoder.transform(X)))
+    return await run_db(render, predictions)
+
+
 @app.get("/attributes/information", response_model=List[Union[CategoricalInformation, ContinuousInformation]], response_model_exclude_none=True, tags=["Dataset"])
 async def attribute_informations():
     '''Returns a JSON with the constraints, possible values and description for each attribute.'''
-    result = json.dumps(attribute_constraints)
-    result = json.loads(result)
-    return result
+    return Response(content=attribute_information_body, media_type="application/json")
 
 
 @app.post("/explanations/{exp_method}", response_model=ExplanationTaskScheduler, status_code=HTTP_202_ACCEPTED, tags=["Explanations"])
@@ -148,7 +290,11 @@ async def schedule_explanation_generation(
     instance: InstanceInfo,
     exp_method: ExplanationType,
     num_features: Optional[int] = Body(
-        None, description="<b>LIME</b>: the number of features for the lime computation")
+        None, description="<b>LIME</b>: the number of features for the lime computation"),
+    priority: JobPriority = Body(
+        JobPriority.interactive, description="Queued interactive jobs are computed before background jobs"),
+    view: Optional[str] = Body(
+        None, description="Client-side identifier of the view that shows the explanation, a newer request for the same view cancels this one")
 ):
     '''General scheduler for **LIME** or **SHAP** explanations. **DICE** counterfactuals are already generated in the database and cannot be
     generated using this request.
@@ -158,11 +304,15 @@ async def schedule_explanation_generation(
     Only attributes specific to the explanation method (`exp_method`) will be considered.
     The back-end will use the attributes in the request body to compute an explanation. It is vital that the request
     contains each instance-attribute's respective value. (`NN_recommendation`, `NN_confidence` and `id` will be ignored if passed in the request)
+    If the instance is an unmodified dataset instance (same `id` and values as in the database) and its explanation has been
+    pregenerated with `explanation_precompute.py`, the returned status is already `terminated` and the result can be fetched directly.
     ___
     <h2>LIME</h2>
 
     The query parameter `num_features` is optional and if provided, will execute the <b>LIME</b> explanation with the corresponding number of features.
     ___
+    A job that is no longer needed can be cancelled with `DELETE /explanations/{uid}`. If `view` is given, the request supersedes (cancels)
+    the previous job of the same view, so only the explanation that is still displayed is computed.
     '''
     # Modification
     # Add shap_orig and lime_orig as a valid explanations
@@ -172,30 +322,99 @@ async def schedule_explanation_generation(
 
     check_cat_values(instance)
 
-    job = Job(exp_type=exp_method, status=ResponseStatus.in_prog)
-    job.task = {"instance": instance, "num_features": num_features}
-    task_queue.put(job)
+    job = Job(exp_type=exp_method, status=ResponseStatus.in_prog, priority=priority, view=view)
 
-    # Modification
-    # Add mapping for shap_orig
-    response_mapping = {
-        ExplanationType.lime:      LimeResponse,
-        ExplanationType.lime_orig:      LimeResponse,
-        ExplanationType.shap:      ShapResponse,
-        ExplanationType.shap_orig: ShapResponse
-    }
+    # unmodified dataset instances have pregenerated explanations, these are returned directly
+    precomputed = await run_db(get_precomputed_response, instance, exp_method, num_features)
+    if precomputed is not None:
+        results.set(job.uid, precomputed, timeout_seconds)
+        supersede(job)
+        return ExplanationTaskScheduler(status=ResponseStatus.terminated, href=str(job.uid))
 
     results[job.uid] = response_mapping[exp_method](
         status=ResponseStatus.in_prog)  # Default response after subtask has started
 
+    # identical requests are only computed once, later ones get the cached result or wait for the running computation
+    key = cache_key(instance, exp_method, num_features)
+    cached, is_leader = await run_db(cache.claim, key, job.uid)
+    if cached is not None:
+        results.set(job.uid, cached, timeout_seconds)
+        supersede(job)
+        return ExplanationTaskScheduler(status=ResponseStatus.terminated, href=str(job.uid))
+    job.cache_key = key
+    with jobs_lock:
+        pending_jobs[job.uid] = job
+    # after the claim: if the previous job of the view computes the same key, this request is its follower and it keeps running
+    supersede(job)
+    if not is_leader:
+        return ExplanationTaskScheduler(status=ResponseStatus.in_prog, href=str(job.uid))
+
+    job.task = {"instance": instance, "num_features": num_features}
+    transport.submit(job)
+
+    return ExplanationTaskScheduler(status=ResponseStatus.in_prog, href=str(job.uid))
+
+
+@app.post("/explanations/{exp_method}/batch", response_model=ExplanationTaskScheduler, status_code=HTTP_202_ACCEPTED, tags=["Explanations"])
+async def schedule_batch_explanation_generation(exp_method: ExplanationType, request: BatchExplanationRequest):
+    '''Schedules **LIME** or **SHAP** explanations for several instances as one job. The instances can be passed directly
+    (`instances`) or referenced by their dataset id (`loan_ids`). The model calls of all instances are evaluated together,
+    which is considerably faster than scheduling one job per instance.
+    The results can be fetched with `/explanations/batch` and are returned in the order of the request (instances first, then loan ids).
+    '''
+    if exp_method not in [ExplanationType.shap, ExplanationType.shap_orig, ExplanationType.lime, ExplanationType.lime_orig]:
+        raise HTTPException(status_code=400, detail="Please use LIME or SHAP")
+
+    instances = list(request.instances or [])
+    if request.loan_ids:
+        if not set(request.loan_ids).issubset(set(range(number_of_applications))):
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
+                                detail="Please specify loan-ids in the correct range.")
+        for l_id in request.loan_ids:
+            instances.append(InstanceInfo.parse_obj(instance_cache.record(l_id)))
+    if len(instances) == 0:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
+                            detail="Please specify instances or loan-ids to explain")
+    for instance in instances:
+        check_cat_values(instance)
+
+    job = Job(exp_type=exp_method, status=ResponseStatus.in_prog, batch=True, priority=request.priority)
+    job.task = {"instances": instances, "num_features": request.num_features}
+    results[job.uid] = BatchExplanationResponse(status=ResponseStatus.in_prog)
+    with jobs_lock:
+        pending_jobs[job.uid] = job
+    transport.submit(job)
+
     return ExplanationTaskScheduler(status=ResponseStatus.in_prog, href=str(job.uid))
 
 
+@app.delete("/explanations/{uid}", response_model=ExplanationTaskScheduler, tags=["Explanations"])
+async def cancel_explanation(uid: UUID):
+    '''Cancels a scheduled <b>LIME</b>, <b>SHAP</b> or batch job: a queued job is removed, a running job is aborted by its explainer
+    process (unless identical requests wait for its result). Afterwards the status of the job is `cancelled`.
+    Jobs that have already finished can't be cancelled.'''
+    if not cancel_job(uid):
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND, detail="No queued or running explanation job with this uuid")
+    return ExplanationTaskScheduler(status=ResponseStatus.cancelled, href=str(uid))
+
+
+@app.get("/explanations/batch", response_model=BatchExplanationResponse, response_model_exclude_none=True, tags=["Explanations"])
+async def batch_explanation(uid: UUID):
+    '''Returns the results of a batch job or the status of its processing (`schedule_batch_explanation_generation`).'''
+    res = results.get(uid)
+    if res is not None:
+        if type(res) != BatchExplanationResponse:
+            return BatchExplanationResponse(status=ResponseStatus.wrong_method)
+        return res
+    else:
+        return BatchExplanationResponse(status=ResponseStatus.not_existing)
+
+
 @app.get("/explanations/lime", response_model=LimeResponse, response_model_exclude_none=True, tags=["Explanations"])
 async def lime_explanation(uid: UUID):
     '''Returns the <b>LIME</b> explanation results or the status of the processing of the original request (`schedule_explanation_generation`).'''
-    if uid in results.keys():
-        res = results[uid]
+    res = results.get(uid)
+    if res is not None:
         if type(res) != LimeResponse:
             return LimeResponse(status=ResponseStatus.wrong_method)
 
@@ -207,8 +426,8 @@ async def lime_explanation(uid: UUID):
 @app.get("/explanations/lime_orig", response_model=LimeResponse, response_model_exclude_none=True, tags=["Explanations"])
 async def lime_explanation(uid: UUID):
     '''Returns the <b>LIME</b> explanation results or the status of the processing of the original request (`schedule_explanation_generation`).'''
-    if uid in results.keys():
-        res = results[uid]
+    res = results.get(uid)
+    if res is not None:
         if type(res) != LimeResponse:
             return LimeResponse(status=ResponseStatus.wrong_method)
 
@@ -221,8 +440,8 @@ async def lime_explanation(uid: UUID):
 async def shap_explanation(uid: UUID):
     '''Returns the <b>SHAP</b> explanation results or the status of the processing of the original request (`schedule_explanation_generation`).'''
 
-    if uid in results.keys():
-        res = results[uid]
+    res = results.get(uid)
+    if res is not None:
         if type(res) != ShapResponse:
             return ShapResponse(status=ResponseStatus.wrong_method)
         return res
@@ -234,8 +453,8 @@ async def shap_explanation(uid: UUID):
 async def shap_explanation(uid: UUID):
     '''Returns the <b>SHAP</b> explanation results or the status of the processing of the original request (`schedule_explanation_generation`).'''
 
-    if uid in results.keys():
-        res = results[uid]
+    res = results.get(uid)
+    if res is not None:
         if type(res) != ShapResponse:
             return ShapResponse(status=ResponseStatus.wrong_method)
         return res
@@ -243,38 +462,60 @@ async def shap_explanation(uid: UUID):
         return ShapResponse(status=ResponseStatus.not_existing)
 
 
-@app.get("/explanations/dice", response_model=DiceCounterfactualResponse, response_model_exclude_none=True, tags=["Explanations"])
-async def dice_explanation(instance_id: int = Query(-1, ge=0, lt=1000)):
-    '''Returns the counterfactuals for the given loan application. Appends the AI prediction (`NN_recommendation`, `NN_confidence`)'''
-    con = create_connection(db_path)
-    cfs = get_cf(con, instance_id)
-    tmp_prediction_cf = get_application(con, instance_id, True)
-
-    for cf in cfs[counterfactuals]:
-        tmp = tmp_prediction_cf.copy()  # must be the same as in databse
-        for key in cf.keys():
-            tmp[key] = cf[key]
-
-        tmp_pred = {}
-        for key in feature_names_model_ordered:
-            tmp_pred[key] = tmp[rename_dict[key]]
-        df = pd.DataFrame(tmp_pred, index=[0])
-
-        data_to_predict = preprocessor.transform(df)
-        prediction = tf_model.predict(data_to_predict)[0][0]  # list in list
-        if prediction < 0.5:
-            confidence = 1 - prediction
-            recommendation = "Approve"
-        else:
-            confidence = prediction
-            recommendation = "Reject"
+@app.get("/explanations/{exp_method}/wait", response_model=Union[ShapResponse, LimeResponse], response_model_exclude_none=True, tags=["Explanations"])
+async def wait_explanation(exp_method: ExplanationType, uid: UUID,
+                           timeout: float = Query(long_poll_seconds, ge=0, le=long_poll_seconds)):
+    '''Long poll for the <b>LIME</b> or <b>SHAP</b> explanation results: answers as soon as the processing of the request
+    (`schedule_explanation_generation`) has finished, at the latest after `timeout` seconds with the current status.
+    Replaces the periodic requests of `/explanations/{exp_method}`.'''
+    response_class = explanation_response_class(exp_method)
+    future = waiters.register(uid)
+    try:
+        res = job_response(uid, response_class)
+        if res.status == ResponseStatus.in_prog and await wait_for(future, timeout):
+            res = job_response(uid, response_class)
+    finally:
+        waiters.unregister(uid, future)
+    return res
 
-        cf[AttributeNames.NN_confidence.value] = confidence
-        cf[AttributeNames.NN_recommendation.value] = recommendation
 
-    print(cfs)
-    con.close()
-    return cfs
+@app.get("/explanations/{exp_method}/stream", tags=["Explanations"],
+         responses={200: {"content": {"text/event-stream": {}},
+                          "description": "`status` events while the explanation is computed, then one `result` event with the response"}})
+async def stream_explanation(exp_method: ExplanationType, uid: UUID):
+    '''Server-Sent Events stream for the <b>LIME</b> or <b>SHAP</b> explanation results. Sends the current status as a `status` event,
+    and the `ShapResponse`/`LimeResponse` as a `result` event as soon as the processing of the request has finished, then the stream is closed.
+    Without changes, a comment is sent every few seconds to keep the connection open.'''
+    response_class = explanation_response_class(exp_method)
+
+    async def events():
+        last_status = None
+        while True:
+            future = waiters.register(uid)
+            try:
+                res = job_response(uid, response_class)
+                data = res.json(by_alias=True, exclude_none=True)
+                if res.status != ResponseStatus.in_prog:
+                    yield f"event: result\ndata: {data}\n\n"
+                    return
+                if res.status != last_status:
+                    last_status = res.status
+                    yield f"event: status\ndata: {data}\n\n"
+                if not await wait_for(future, stream_heartbeat_seconds):
+                    yield ": keep-alive\n\n"
+            finally:
+                waiters.unregister(uid, future)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/explanations/dice", response_model=DiceCounterfactualResponse, response_model_exclude_none=True, tags=["Explanations"])
+async def dice_explanation(instance_id: int = Query(-1, ge=0, lt=1000), if_none_match: Optional[str] = Header(None)):
+    '''Returns the counterfactuals for the given loan application. Appends the AI prediction (`NN_recommendation`, `NN_confidence`).
+    The response has an `ETag`, requests with a matching `If-None-Match` header are answered with 304 Not Modified.'''
+    # the counterfactuals are read (and predicted if necessary) when they are requested the first time
+    cached = await run_db(instance_cache.dice, instance_id)
+    return cached.response(if_none_match)
 
 
 @app.get("/processes", tags=["Debugging"])
@@ -282,10 +523,12 @@ async def process_information():
     """Returns information about the python processes that should be running."""
     return {
         "parent_process_id": os.getpid(),
-        # private variable, might not be supported for different versions
-        "manager_pid": manager._process.ident,
-        "num_exp_processes": num_processes,
-        "exp_pids": process_ids
+        "num_exp_processes": len(supervisor.processes) if supervisor is not None else 0,
+        "exp_pids": supervisor.pids() if supervisor is not None else [],
+        "exp_pools": {worker_id: transport.pools[worker_id] for worker_id in supervisor.processes} if supervisor is not None else {},
+        "jobs": transport.metrics() if transport is not None else None,
+        "autoscaler": supervisor.report() if supervisor is not None else None,
+        "resources": resource_manager.report() if resource_manager is not None else None
     }
 
 
@@ -293,7 +536,7 @@ async def process_information():
 async def process_status(p_id: int):
     """Returns the current status of a running process based on the process id.
     Will only return information about related python processes."""
-    if p_id not in [os.getpid(), manager._process.ident] + process_ids:
+    if p_id not in [os.getpid()] + (supervisor.pids() if supervisor is not None else []):
         return "Provided process id not related to this application."
     p = psutil.Process(p_id)
     return p.as_dict()
@@ -305,6 +548,13 @@ async def explanation_uids():
     return results.keys()
 
 
+@app.get("/result_uids/metrics", tags=["Debugging"])
+async def explanation_result_metrics():
+    """Returns the number of saved explanation results (and how many of them expire), the number of expired results so far
+    and the size of the deadline heap of the sweeper."""
+    return results.metrics()
+
+
 @app.post("/experiment/creation", status_code=HTTP_202_ACCEPTED, tags=["Experimentation"])
 async def create_experiment(exp_info: ExperimentInformation):
     """Create an experiment setup and save it to the database. What-if analysis is dependent on the modification menu.
@@ -324,26 +574,20 @@ async def create_experiment(exp_info: ExperimentInformation):
         raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
                             detail="Please specify loan-ids in the correct range.")
     exp = exp_info.json()
-    con = create_connection(db_path)
-    exp_creation(con, exp_info.experiment_name, exp)
-    con.close()
+    await run_query(db_pool, exp_creation, exp_info.experiment_name, exp)
 
 
 @app.get("/experiment/all", response_model=List[str], tags=["Experimentation"])
 async def experiment_list():
     """Returns a list of all experiment names, which can be used to access specific experiments."""
-    con = create_connection(db_path)
-    exp_list = get_all_exp(con)
-    con.close()
+    exp_list = await run_query(read_pool, get_all_exp)
     return exp_list
 
 
 @app.get("/experiment", response_model=ExperimentInformation, tags=["Experimentation"])
 async def experiment_by_name(name: str):
     """Returns the experiment setup associated to the experiment name."""
-    con = create_connection(db_path)
-    exp_info = get_exp_info(con, name)
-    con.close()
+    exp_info = await run_query(read_pool, get_exp_info, name)
     return exp_info
 
 
@@ -351,9 +595,7 @@ async def experiment_by_name(name: str):
 async def generate_client_id(gen: GenerateClientID):
     """Returns the next available client_id and adds that client_id to the results list. The client_id is a database reference to the
     actual user doing the experiment."""
-    con = create_connection(db_path)
-    return_id = create_id(con, gen.experiment_name)
-    con.close()
+    return_id = await run_query(db_pool, create_id, gen.experiment_name)
     # check for None response! If return_id dict is None, the experiment does no exist
     if return_id is None:
         raise HTTPException(
@@ -364,8 +606,7 @@ async def generate_client_id(gen: GenerateClientID):
 @app.post("/experiment/results", status_code=HTTP_202_ACCEPTED, tags=["Experimentation"])
 async def results_to_database(results: ExperimentResults):
     """Adds the user-generated experiment results mapped to the client_id to the `results` table in the database."""
-    con = create_connection(db_path)
-    exp = get_exp_info(con, results.experiment_name)
+    exp = await run_query(db_pool, get_exp_info, results.experiment_name)
     if not exp:  # {} is falsy and returned if experiment does not exist
         raise HTTPException(
             HTTP_404_NOT_FOUND, f"Experiment with name {results.experiment_name} not found")
@@ -379,26 +620,20 @@ async def results_to_database(results: ExperimentResults):
     if set(l_ids) != check_loan_ids:
         raise HTTPException(
             HTTP_400_BAD_REQUEST, "loan_ids in results are not same as in experiment info")
-    add_res(con, results.experiment_name, results.client_id, results.results)
-    con.close()
+    await run_query(db_pool, add_res, results.experiment_name, results.client_id, results.results)
 
 
 @app.get("/experiment/results/export", response_model=List[ExperimentResults], tags=["Experimentation"])
 async def export_results():
     """Returns all results for the chosen experiment in JSON format"""
-    con = create_connection(db_path)
-    result_json = export_results_to(con, ExportFormat.js_object_notation.value)
-    con.close()
+    result_json = await run_query(read_pool, export_results_to, ExportFormat.js_object_notation.value)
     return result_json
 
 
 @app.get("/single/experiment/results/export", response_model=List[ExperimentResults], tags=["Experimentation"])
 async def single_export_results(experiment_name: str):
     """Returns the results for the chosen experiment in json format"""
-    con = create_connection(db_path)
-    result_json = export_results_to(
-        con, ExportFormat.js_object_notation.value, experiment_name)
-    con.close()
+    result_json = await run_query(read_pool, export_results_to, ExportFormat.js_object_notation.value, experiment_name)
     return result_json
 
 
@@ -408,27 +643,20 @@ async def single_export_results_csv(experiment_name: str):
     and deleted after it has been returned."""
     def cleanup():
         os.remove(temp_file)
-    con = create_connection(db_path)
-    temp_file = export_results_to(
-        con, ExportFormat.comma_separated.value, experiment_name)
-    con.close()
+    temp_file = await run_query(read_pool, export_results_to, ExportFormat.comma_separated.value, experiment_name)
     return FileResponse(temp_file, background=BackgroundTask(cleanup))
 
 
 @app.post("/experiment/reset", tags=["Experimentation"])
 async def reset_experiment_results(experiment_name: str):
     """Deletes all results from the given experiment from the `results` table if that experiment exists."""
-    con = create_connection(db_path)
-    reset_exp_res(con, experiment_name)
-    con.close()
+    await run_query(db_pool, reset_exp_res, experiment_name)
 
 
 @app.post("/experiment/delete", tags=["Experimentation"])
 async def delete_experiment(experiment_name: str):
     """Deletes an experiment from the `experiments` table if it exists there."""
-    con = create_connection(db_path)
-    delete_exp(con, experiment_name)
-    con.close()
+    await run_query(db_pool, delete_exp, experiment_name)
 
 
 @app.get("/authenticate", tags=["Security"])
@@ -443,6 +671,111 @@ async def authenticate_admin(pwd: str):
 # Helper methods
 
 
+def finish_job(uid: UUID, response, key: Optional[str]):
+    """Called by the collector thread of the transport after the response of a job has been stored in the results."""
+    finished = [uid]
+    results.expire(uid, timeout_seconds)
+    waiters.notify(uid)
+    if key is not None:
+        # identical requests that arrived during the computation get the same result
+        for follower in cache.resolve(key, response, results):
+            results.expire(follower, timeout_seconds)
+            waiters.notify(follower)
+            finished.append(follower)
+    with jobs_lock:
+        for f_uid in finished:
+            job = pending_jobs.pop(f_uid, None)
+            if job is not None and job.view is not None and view_jobs.get(job.view) == f_uid:
+                del view_jobs[job.view]
+
+
+def supersede(job: Job):
+    """Makes the job the latest one of its view and cancels the previous job of the view."""
+    if job.view is None:
+        return
+    with jobs_lock:
+        previous = view_jobs.get(job.view)
+        view_jobs[job.view] = job.uid
+    if previous is not None:
+        cancel_job(previous)
+
+
+def cancel_job(uid: UUID):
+    """Cancels a queued or running job, its result gets the status cancelled. Returns False if the job isn't pending.
+    A job that computes the result of a cache key for identical requests (followers) keeps running, only its own result is dropped."""
+    with jobs_lock:
+        job = pending_jobs.pop(uid, None)
+        if job is None:
+            return False
+        if job.view is not None and view_jobs.get(job.view) == uid:
+            del view_jobs[job.view]
+    if job.cache_key is None or cache.cancel(job.cache_key, uid):
+        transport.cancel(uid)
+    else:
+        transport.drop(uid)
+    res = results.get(uid)
+    if res is not None and res.status == ResponseStatus.in_prog:
+        results.set(uid, type(res)(status=ResponseStatus.cancelled), timeout_seconds)
+    waiters.notify(uid)
+    return True
+
+
+def dice_response(con, instance_id: int, instance: dict):
+    """Returns the counterfactuals of the instance with the AI prediction for every counterfactual."""
+    cfs = get_cf(con, instance_id)
+    missing = [cf for cf in cfs[counterfactuals] if AttributeNames.NN_confidence.value not in cf]
+    if missing:
+        # the database was created before the predictions were stored with the counterfactuals
+        add_cf_predictions({instance_id: missing}, {instance_id: instance},
+                           lambda records: call_model(predict_records, inference_engine, encoder, records, model_attributes))
+    return cfs
+
+
+def get_precomputed_response(instance: InstanceInfo, exp_method: ExplanationType, num_features: Optional[int]):
+    """Returns the pregenerated explanation if the instance is exactly the dataset instance with the same id, otherwise None.
+    LIME explanations are only pregenerated with all features."""
+    if instance.ident < 0 or instance.ident >= number_of_applications:
+        return None
+    if exp_method in [ExplanationType.lime, ExplanationType.lime_orig] and num_features not in [None, all_features]:
+        return None
+    stored = instance_cache.record(instance.ident)
+    if stored is None or any(instance.__dict__[attr] != stored[attr] for attr in rename_dict.values()):
+        return None
+    explanation = get_precomputed_explanation(read_pool.connection(), precomputed_tables[exp_method], instance.ident)
+    if explanation is None:
+        return None
+    return response_mapping[exp_method].parse_raw(explanation)
+
+
+def explanation_response_class(exp_method: ExplanationType):
+    """Returns the response model of the explanation method, raises a HTTP exception for methods without jobs."""
+    if exp_method not in response_mapping:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Please use LIME or SHAP")
+    return response_mapping[exp_method]
+
+
+def job_response(uid: UUID, response_class):
+    """Returns the saved result of the job or a response of the given class with the status not_existing or wrong_method."""
+    res = results.get(uid)
+    if res is None:
+        return response_class(status=ResponseStatus.not_existing)
+    if type(res) != response_class:
+        return response_class(status=ResponseStatus.wrong_method)
+    return res
+
+
+def check_cat_values_bulk(instances: list):
+    """Checks the categorical values of all instances at once. Raises a HTTP exception that lists every wrong value."""
+    errors = []
+    for key, allowed in cat_attr_check.items():
+        allowed = set(allowed)
+        for i, instance in enumerate(instances):
+            if instance.__dict__[key] not in allowed:
+                errors.append({"index": i, "attribute": key})
+    if errors:
+        raise HTTPException(400, errors)
+
+
 def check_cat_values(instance):
     # check if the categorical values are correctly specified in the request
     for key in cat_attr_check.keys():
@@ -456,22 +789,39 @@ def check_cat_values(instance):
 if __name__ == "__main__":
 
     # will raise NotImplementedError if count cannot be determined
-    num_processes = mp.cpu_count() - 2
-    manager = mp.Manager()
-    results = manager.dict()
-    task_queue = manager.Queue()
+    if autoscale:
+        # the minimum layout is started now, the supervisor adds workers up to max_workers when the queues grow
+        pools = pool_layout(min_workers, shap_workers, lime_workers)
+        max_processes = max_workers or max(min_workers, mp.cpu_count() - 2)
+    else:
+        pools = pool_layout(mp.cpu_count() - 2, shap_workers, lime_workers)
+        max_processes = len(pools)
+    transport = JobTransport(results, finish_job, pools, steal_reserve)
+    # the budget is computed for the max. number of processes, so the cores are never oversubscribed
+    resource_manager = ResourceManager(max(max_processes, len(pools)), worker_threads, worker_inter_op_threads, pin_workers,
+                                       api_reserved_cores)
+
+    def start_explainer(worker_id: int):
+        process = mp_context.Process(target=explanation_worker,
+                             args=transport.worker_args(worker_id) + (resource_manager.acquire(worker_id),))
+        process.start()
+        return process
+
+    supervisor = WorkerSupervisor(transport, start_explainer, max_processes, autoscale_interval, autoscale_target_wait,
+                                  autoscale_idle_seconds, min_free_memory_mb, worker_memory_mb, resource_manager.release,
+                                  explainer_memory_mb)
 
     print(
-        f"\nMain process with id \033[96m{os.getpid()}\033[0m started succesfully. Starting {num_processes} explainer processes.\n")
-    processes: List[mp.Process] = [mp.Process(target=explanation_worker, args=(
-        task_queue, results)) for _ in range(num_processes)]
-    for process in processes:
-        process.start()
-        process_ids.append(process.pid)
+        f"\nMain process with id \033[96m{os.getpid()}\033[0m started succesfully. Starting {len(pools)} explainer processes \
+({pools.count('shap')} SHAP, {pools.count('lime')} LIME), at most {supervisor.max_workers}, \
+{resource_manager.threads} threads each.\n")
+    transport.start()
+    supervisor.start()
 
     uvicorn.run(app, host="0.0.0.0", port=8000)
 
-    for process in processes:
+    supervisor.stop()
+    for process in list(supervisor.processes.values()):
         pid = process.pid
         process.terminate()
         print(
@@ -1,6 +1,6 @@
 from fastapi.params import Body
 from pydantic import BaseModel, Field
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Dict
 
 from constants import *
 
@@ -134,6 +134,27 @@ class TableRequest(BaseModel):
     sort_ascending: bool = Field(True, alias=sort_ascending)
     limit: int = Field(row_limit, alias=limit)
     offset: int = Field(0, alias=offset)
+    cursor: Optional[str] = Field(None, alias=cursor, description="cursor of the next page from the X-Next-Cursor header of the previous response, replaces the offset")
+
+
+class FacetRequest(BaseModel):
+    '''Defines the JSON format for the facets of the table filters'''
+    filter: Optional[List[Union[ContinuousFilter, CategoricalFilter]]] = Field(
+        None, alias=filter)
+    num_bins: int = Field(10, ge=1, le=100, alias=num_bins)
+
+
+class Histogram(BaseModel):
+    bin_edges: List[float] = Field(alias=bin_edges)
+    counts: List[int] = Field(alias=bin_counts)
+
+
+class FacetResponse(BaseModel):
+    '''Number of applications that match the filters, their counts per value of every categorical attribute and
+    histograms of the continuous attributes (bins between the lower and upper bound of the constraints)'''
+    total: int = Field(alias=total_count)
+    categorical: Dict[str, Dict[str, int]] = Field(alias=categorical)
+    histograms: Dict[str, Histogram] = Field(alias=histograms)
 
 
 class CategoricalInformation(BaseModel):
@@ -197,6 +218,26 @@ class ShapResponse(BaseModel):
     #recommendation: Optional[str] = Field(alias=recommendation)
 
 
+class BatchExplanationRequest(BaseModel):
+    '''JSON format for a batch explanation request. Either the instances or the loan ids of dataset instances must be provided.'''
+    instances: Optional[List[InstanceInfo]] = Field(
+        None, description="The instances that should be explained, must contain all attributes.")
+    loan_ids: Optional[List[int]] = Field(
+        None, description="Ids of dataset instances that should be explained. Are appended to the instances.")
+    num_features: Optional[int] = Field(
+        None, alias=num_features, description="<b>LIME</b>: the number of features for the lime computation")
+    priority: JobPriority = Field(
+        JobPriority.background, description="Batch jobs are computed after the queued interactive jobs by default")
+
+
+class BatchExplanationResponse(BaseModel):
+    '''JSON format for the response of a batch explanation job. The results are in the same order as the requested instances
+    and are only returned if the process is terminated.'''
+    status: ResponseStatus = Field(alias=status)
+    results: Optional[List[Union[ShapResponse, LimeResponse]]] = Field(
+        None, description="One explanation per instance.\n`None`, when process has not terminated.")
+
+
 class DiceCounterfactualResponse(BaseModel):
     '''JSON format for `DICE` model response.
     The counterfactuals only contain changed attributes.'''
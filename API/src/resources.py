@@ -0,0 +1,114 @@
+import os
+import sys
+import threading
+from collections import Counter
+from typing import List, Optional
+import psutil
+from pydantic import BaseModel
+from constants import inference_backend, numpy_weights_path
+
+"""CPU budget of the explainer processes. Without limits, TensorFlow and the BLAS libraries of every explainer process start
+one thread per core, so N processes compete with N times the number of cores during SHAP bursts. The ResourceManager gives
+every explainer process a thread budget (the cores for the explainers divided by the max. number of explainer processes) and,
+if enabled, its own set of cores. `apply_resources` is called by the explainer process before it loads its explainer.
+The explainer processes are spawned (see job_transport.py), so they don't inherit the TensorFlow runtime of the API process and
+its thread pools can still be sized.
+`benchmark_thread_budget.py` measures the SHAP throughput of the process x thread combinations of a machine.
+"""
+
+# thread pools of numpy/scipy (OpenMP, OpenBLAS, MKL) and numexpr, read when the libraries are loaded
+thread_env_vars = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+
+class WorkerResources(BaseModel):
+    threads: int = 1  # intra-op threads of TensorFlow and threads of the BLAS libraries
+    inter_op_threads: int = 1  # inter-op threads of TensorFlow
+    cpus: Optional[List[int]] = None  # CPU affinity of the process, None = not pinned
+
+
+def available_cores():
+    """The cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ResourceManager:
+    """Assigns a thread budget and optionally a set of cores to every explainer process, owned by the API process"""
+
+    def __init__(self, max_workers: int, threads: int = 0, inter_op_threads: int = 1, pin: bool = False, reserved_cores: int = 2):
+        """
+        :param max_workers: max. number of explainer processes running at the same time
+        :param threads: threads per explainer process, 0 = the cores of the explainers divided by max_workers
+        :param pin: gives every explainer process its own cores (as long as there are enough), the API process keeps the reserved ones
+        :param reserved_cores: number of cores that are left to the API process, if there are more cores
+        """
+        cores = available_cores()
+        self.cores = cores[reserved_cores:] if len(cores) > reserved_cores else cores
+        self.threads = threads or max(1, len(self.cores) // max(max_workers, 1))
+        self.inter_op_threads = inter_op_threads
+        self.pin = pin
+        self.slots = max(1, len(self.cores) // self.threads)  # disjoint core sets
+        self._assigned = {}  # worker id -> slot
+        self._lock = threading.Lock()
+
+    def acquire(self, worker_id: int):
+        """Returns the resources of a new explainer process, pinned processes get the least used core set"""
+        cpus = None
+        if self.pin:
+            with self._lock:
+                used = Counter(self._assigned.values())
+                slot = min(range(self.slots), key=lambda s: used[s])
+                self._assigned[worker_id] = slot
+            cpus = self.cores[slot * self.threads:(slot + 1) * self.threads]
+        return WorkerResources(threads=self.threads, inter_op_threads=self.inter_op_threads, cpus=cpus)
+
+    def release(self, worker_id: int):
+        """Frees the cores of an explainer process that has exited"""
+        with self._lock:
+            self._assigned.pop(worker_id, None)
+
+    def report(self):
+        with self._lock:
+            assigned = dict(self._assigned)
+        return {
+            "threads_per_worker": self.threads,
+            "inter_op_threads": self.inter_op_threads,
+            "explainer_cores": self.cores,
+            "pinned": {worker_id: self.cores[slot * self.threads:(slot + 1) * self.threads] for worker_id, slot in assigned.items()}
+        }
+
+
+def apply_resources(resources: WorkerResources):
+    """Limits the threads (and cores) of the current process. Must be called before TensorFlow is used in the process."""
+    threads = str(resources.threads)
+    for var in thread_env_vars:
+        os.environ[var] = threads
+    os.environ["TF_NUM_INTRAOP_THREADS"] = threads
+    os.environ["TF_NUM_INTEROP_THREADS"] = str(resources.inter_op_threads)
+    if resources.cpus:
+        try:
+            psutil.Process().cpu_affinity(resources.cpus)
+        except (AttributeError, psutil.Error) as e:
+            # e.g. macOS doesn't support the affinity
+            print(f"\033[93mWARNING:\033[0m Pinning the explainer process to the cores {resources.cpus} failed: {e!r}")
+    try:
+        # the BLAS libraries of numpy are already loaded, their thread pools are resized directly
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(resources.threads)
+    except ImportError:
+        pass
+    if not tensorflow_needed():
+        return
+    import tensorflow as tf
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(resources.threads)
+        tf.config.threading.set_inter_op_parallelism_threads(resources.inter_op_threads)
+    except RuntimeError:
+        print("\033[93mWARNING:\033[0m TensorFlow has been initialized before the thread limits were applied, "
+              "its thread pools keep their size.")
+
+
+def tensorflow_needed():
+    """Whether the process uses TensorFlow: it is already loaded or the model can't be run with the exported numpy weights"""
+    return "tensorflow" in sys.modules or inference_backend != "numpy" or not os.path.exists(numpy_weights_path)
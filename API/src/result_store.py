@@ -0,0 +1,111 @@
+import time
+import heapq
+import threading
+from typing import Optional
+
+_missing = object()
+
+
+class ExpiringResultStore:
+    """Dict of the explanation results (uid -> response) in which every entry can have its own time to live.
+    A single sweeper thread per store removes the expired entries: the deadlines are kept in a heap and the thread sleeps until
+    the earliest one, so the number of threads does not grow with the number of results. Entries without a TTL (e.g. jobs
+    in progress) are kept until they get one or are removed. With `extend_on_read`, reading an entry restarts its TTL.
+    Must not be shared between processes, all methods are thread-safe.
+    """
+
+    def __init__(self, extend_on_read: bool = False):
+        self.extend_on_read = extend_on_read
+        self._values = {}
+        self._ttls = {}  # uid -> TTL in seconds, only entries that expire
+        self._deadlines = {}  # uid -> current deadline (time.monotonic)
+        self._heap = []  # (deadline, uid), outdated deadlines are skipped by the sweeper
+        self._cond = threading.Condition()
+        self._sweeper = None
+        self.evictions = 0
+
+    def __setitem__(self, uid, value):
+        """Stores the value, the TTL of the entry (if any) is kept"""
+        with self._cond:
+            self._values[uid] = value
+
+    def set(self, uid, value, ttl: Optional[float] = None):
+        """Stores the value and, if ttl is given, lets the entry expire ttl seconds from now"""
+        with self._cond:
+            self._values[uid] = value
+            if ttl is not None:
+                self._expire(uid, ttl)
+
+    def expire(self, uid, ttl: float):
+        """Lets the entry expire ttl seconds from now. Returns False if there is no such entry."""
+        with self._cond:
+            if uid not in self._values:
+                return False
+            self._expire(uid, ttl)
+            return True
+
+    def get(self, uid, default=None):
+        with self._cond:
+            value = self._values.get(uid, default)
+            if self.extend_on_read and uid in self._ttls:
+                self._expire(uid, self._ttls[uid])
+            return value
+
+    def __getitem__(self, uid):
+        value = self.get(uid, _missing)
+        if value is _missing:
+            raise KeyError(uid)
+        return value
+
+    def __contains__(self, uid):
+        return uid in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        with self._cond:
+            return list(self._values.keys())
+
+    def pop(self, uid, *default):
+        with self._cond:
+            self._ttls.pop(uid, None)
+            self._deadlines.pop(uid, None)
+            return self._values.pop(uid, *default)
+
+    def metrics(self):
+        """Returns the number of entries (with a TTL), the number of expired entries so far and the size of the heap"""
+        with self._cond:
+            return {"live_entries": len(self._values), "expiring_entries": len(self._ttls),
+                    "evictions": self.evictions, "heap_size": len(self._heap)}
+
+    def _expire(self, uid, ttl: float):
+        # only called while holding the lock
+        deadline = time.monotonic() + ttl
+        self._ttls[uid] = ttl
+        self._deadlines[uid] = deadline
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            # every extension leaves an outdated deadline in the heap, this keeps it proportional to the entries
+            self._heap = [(d, u) for u, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+        else:
+            heapq.heappush(self._heap, (deadline, uid))
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep, name="result-sweeper", daemon=True)
+            self._sweeper.start()
+        elif self._heap[0][1] == uid:
+            # the sweeper waits for a later deadline
+            self._cond.notify()
+
+    def _sweep(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, uid = heapq.heappop(self._heap)
+                    if self._deadlines.get(uid) == deadline:
+                        del self._deadlines[uid]
+                        del self._ttls[uid]
+                        del self._values[uid]
+                        self.evictions += 1
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
@@ -0,0 +1,52 @@
+import asyncio
+import threading
+
+
+class ResultWaiters:
+    """Wakes up the handlers that wait for the result of a job (long polls and event streams of the explanations).
+    The waiters are futures of the event loop, `notify` can be called from any thread, e.g. the collector thread of the JobTransport.
+    A waiter has to be registered before the result is checked, otherwise a result that arrives in between is missed.
+    """
+
+    def __init__(self):
+        self._waiters = {}  # uid -> list of (event loop, future)
+        self._lock = threading.Lock()
+
+    def register(self, uid):
+        """Returns a future that is done once `notify` is called for the uid. Must be called on the event loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._waiters.setdefault(uid, []).append((loop, future))
+        return future
+
+    def unregister(self, uid, future):
+        with self._lock:
+            waiters = self._waiters.get(uid)
+            if waiters is None:
+                return
+            waiters[:] = [(loop, f) for loop, f in waiters if f is not future]
+            if not waiters:
+                del self._waiters[uid]
+
+    def notify(self, uid):
+        """Wakes up all handlers that wait for the uid"""
+        with self._lock:
+            waiters = self._waiters.pop(uid, [])
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_set_done, future)
+
+    def __len__(self):
+        """Number of uids with waiting handlers"""
+        return len(self._waiters)
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def wait_for(future, timeout: float):
+    """Waits until the future is done or the timeout (seconds) has passed. Returns whether the future is done."""
+    done, _ = await asyncio.wait({future}, timeout=max(timeout, 0))
+    return len(done) > 0
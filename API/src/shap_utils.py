@@ -1,12 +1,15 @@
 import pandas as pd
 from constants import AttributeNames
 from DataLoader_ey import data_loader
-from tensorflow.keras.models import load_model
 from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import MinMaxScaler, OneHotEncoder
 from models import InstanceInfo
-from constants import inv_rename, rename_dict
+from constants import inv_rename, rename_dict, shap_background_mode, shap_background_size
+from feature_encoder import FeatureEncoder
+from inference import load_engine
+import numpy as np
 import shap
+from shap.utils._legacy import DenseData
 
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
@@ -14,7 +17,7 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 class ShapHelperV2: # TODO load model only once for each process (pass it to the explainers!)
     def __init__(self):
         """TODO"""
-        self.model = load_model("smote_ey.tf")
+        self.model = load_engine()
         self.data = data_loader()
         self.X_train = None
         self.train_data = None
@@ -22,6 +25,7 @@ class ShapHelperV2: # TODO load model only once for each process (pass it to the
         self.X_train = None
         self.X_test = None
         self.preprocessor = None
+        self.encoder = None
 
     def prepare_shap(self):
         """TODO mainly taken from explanation_utils_ey"""
@@ -44,28 +48,74 @@ class ShapHelperV2: # TODO load model only once for each process (pass it to the
         )
         preprocessor.fit(X_train)
         self.preprocessor = preprocessor
+        self.encoder = FeatureEncoder(preprocessor, self.X_train.columns.to_list())
 
     def get_pred_fn(self):
         """TODO"""
 
         def predict_fn(X):
-            X_df = pd.DataFrame(X.reshape((-1, 18)), columns=self.X_train.columns)
-            X_transformed = self.preprocessor.transform(X_df).toarray()
+            X_transformed = self.encoder.transform(X.reshape((-1, 18)))
             result = self.model.predict(X_transformed).flatten()
             return result
         
         return predict_fn
     
     def predict_shap(self, X): # TODO rename
-        X_df = pd.DataFrame(X.reshape((-1, 18)), columns=self.X_train.columns)
-        X_transformed = self.preprocessor.transform(X_df).toarray()
+        X_transformed = self.encoder.transform(X.reshape((-1, 18)))
         result = self.model.predict(X_transformed).flatten()
         return result
 
+def summarize_background(helper: ShapHelperV2, mode=shap_background_mode, size=shap_background_size, random_state=42):
+    """Returns the background data for the KernelExplainer. The cost of every SHAP explanation grows linearly with the
+    number of background rows, therefore the ~800 rows of the training split can be summarized into `size` weighted rows.
+    Every summarized row is a real applicant, so the categorical attributes keep values the model knows.
+
+    Params:
+    -------
+    :param helper: a prepared ShapHelperV2 (`prepare_shap` must have been called)
+    :param mode: "full" (whole training split), "kmedoids" (k-means on the encoded data, the applicant closest to each
+    centroid is used and weighted by the cluster size), "stratified" (sample by label) or "sample" (uniform sample)
+    :param size: the number of background rows if the mode summarizes the data
+    :return: the training split as a dataframe for "full", otherwise a weighted DenseData object
+    """
+    X = helper.X_train
+    if mode == "full" or size >= len(X):
+        return X
+    rng = np.random.RandomState(random_state)
+    if mode == "kmedoids":
+        from sklearn.cluster import KMeans
+        encoded = helper.preprocessor.transform(X)
+        encoded = encoded.toarray() if hasattr(encoded, "toarray") else encoded
+        kmeans = KMeans(n_clusters=size, random_state=random_state, n_init=10).fit(encoded)
+        rows, weights = [], []
+        for cluster in range(size):
+            members = np.where(kmeans.labels_ == cluster)[0]
+            if len(members) == 0:
+                continue
+            distances = np.linalg.norm(encoded[members] - kmeans.cluster_centers_[cluster], axis=1)
+            rows.append(members[np.argmin(distances)])
+            weights.append(len(members))
+    elif mode == "stratified":
+        labels = helper.train_data['label'].values
+        rows, weights = [], []
+        for label in np.unique(labels):
+            members = np.where(labels == label)[0]
+            n = max(1, int(round(size * len(members) / len(labels))))
+            chosen = rng.choice(members, size=min(n, len(members)), replace=False)
+            rows.extend(chosen)
+            weights.extend([len(members) / len(chosen)] * len(chosen))
+    elif mode == "sample":
+        rows = rng.choice(len(X), size=size, replace=False)
+        weights = np.ones(size)
+    else:
+        raise ValueError(f"Unknown SHAP background mode '{mode}'")
+    # DenseData normalizes the weights, group names are the feature names
+    return DenseData(X.values[np.array(rows)], X.columns.to_list(), None, np.array(weights, dtype=float))
+
+
 def get_pred_fn_helper(helper: ShapHelperV2):
     def predict_fn(X):
-        X_df = pd.DataFrame(X.reshape((-1, 18)), columns=helper.X_train.columns)
-        X_transformed = helper.preprocessor.transform(X_df).toarray()
+        X_transformed = helper.encoder.transform(X.reshape((-1, 18)))
         result = helper.model.predict(X_transformed).flatten()
         return result
     return predict_fn
@@ -90,6 +140,7 @@ def compute_response_shap(instance : InstanceInfo, explainer : shap.KernelExplai
 # Do not Use
 class OLD_ShapHelper:
     def __init__(self):
+        from tensorflow.keras.models import load_model
         # load dataset
         data = data_loader()
         data = data.drop(columns="label")
@@ -1,12 +1,17 @@
 from queue import Queue
-import threading
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from pydantic import BaseModel, Field
-from models import ShapResponse, LimeResponse
+from models import ShapResponse, LimeResponse, BatchExplanationResponse
 from shap_utils import compute_response_shap
-from constants import ResponseStatus, ExplanationType, all_features, timeout_seconds
+from batching import StackedPredictor
+from resources import WorkerResources, apply_resources
+from constants import ResponseStatus, ExplanationType, JobPriority, all_features, shap_background_mode, shap_background_size, batch_stack_size, cancel_check_rows
 from typing import Optional
 from uuid import UUID, uuid4
 import time
+import traceback
 
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
@@ -16,92 +21,254 @@ class Job(BaseModel):
     uid : UUID = Field(default_factory=uuid4)
     task : dict = {} # instance attributes with values & arguments necessary for computation
     status : str = Field(ResponseStatus)
+    batch : bool = False # task contains a list of "instances" instead of a single "instance"
+    cache_key : Optional[str] = None # set if the job is the leader (or a follower) for this key in the ExplanationCache
+    priority : JobPriority = JobPriority.interactive
+    view : Optional[str] = None # newer jobs of the same view supersede this one
+    seq : int = 0 # assigned by the JobTransport, identifies the job in the abort flag of the worker
 
-def explanation_worker(in_queue : Queue, res_out : dict):
+
+class JobCancelled(Exception):
+    """Raised in the prediction functions of a job that has been cancelled by the API process"""
+
+
+def explanation_worker(in_queue : Queue, out_queue : Queue, abort, worker_id : int, pool : str = "shap",
+                       resources : Optional[WorkerResources] = None):
     """Takes one element (a job) out of the input queue (TODO BLOCKING), solves the task
     with the explanation function which takes in the args.
     The result is returned in the output queue.
     
     Params:
     -------
-    :param in_queue: the multiprocessing.Manager Queue used for shared memory between processes. Tasks are in here.
-    :param res_out: the Manager dict used to store the results of the computations with respect to the Job uuid
+    :param in_queue: the job queue of this worker in the JobTransport (job_transport.py). Tasks are in here.
+    :param out_queue: the `done` queue of the JobTransport, receives (worker id, uuid, response, cache key) of every finished job.
+    Every message tells the transport that the worker is idle, the response is None if the job has been cancelled.
+    :param abort: shared integer, the seq of the job that has to be aborted
+    :param worker_id: the index of the worker in the JobTransport
+    :param pool: "shap" or "lime", only this explainer is loaded at startup. Jobs of the other method (taken over when
+    this pool is idle) load the other explainer on first use.
+    :param resources: thread budget and cores of the process (see resources.py), applied before the explainers are loaded
 
     TODO """
     import os
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' 
     # imports for explainers
     # Need to happen in the worker, because pickle can't serialize the necessary objects for child processes
+    if resources is not None:
+        apply_resources(resources)
 
-    #Shap
-    import shap
-    from shap_utils import ShapHelperV2
-    sh = ShapHelperV2()
-    sh.prepare_shap()
-    pred_fn = sh.predict_shap
-
-
-    shap_explainer = shap.KernelExplainer(pred_fn, sh.X_train)
-    cols = sh.X_train.columns.to_list()
+    explainers = LazyExplainers()
+    explainers.load(pool)
 
-    #Lime
-    from lime_utils import LimeHelper
-    lh = LimeHelper()
-
-    print(f"\033[92mINFO:\033[0m Explainer process with id \033[96m{os.getpid()}\033[0m started succesfully. Explainers loaded and ready.")
+    print(f"\033[92mINFO:\033[0m Explainer process with id \033[96m{os.getpid()}\033[0m started succesfully. \033[1m{pool.upper()}\033[0m explainer loaded and ready.")
     
+    out_queue.put((worker_id, None, None, None)) # ready for the first job
     while True: # repeat the process
         print(f"\033[92mINFO:\033[0m Explainer process with id \033[96m{os.getpid()}\033[0m is waiting for the next task.")
         job : Job = in_queue.get(block=True) # explicitely wait until a job is available
+        if job is None: # the worker has been retired (see autoscaler.py)
+            print(f"\033[92mINFO:\033[0m Explainer process with id \033[96m{os.getpid()}\033[0m retired.")
+            return
         start_time = time.time()
         print(f"\033[92mINFO:\033[0m Explainer process with id \033[96m{os.getpid()}\033[0m starting exlanation computation. \
             \n      Explanation type: \033[1m{job.exp_type.value}\033[0m")
 
+        def cancelled(seq=job.seq):
+            return abort.value == seq
 
-        if job.exp_type in [ExplanationType.shap, ExplanationType.shap_orig]:
-            # Modification Backup
-            # Add sh to parameter to compute prediction
-            #shap_bval, shap_vals, pred_proba, recommendation  = compute_response_shap(job.task["instance"], shap_explainer, cols, sh)
-            shap_bval, shap_vals, = compute_response_shap(job.task["instance"], shap_explainer, cols)
-
-            shap_attributes = [{"attribute" : cols[i], "influence" : shap_vals[0][i]} for i in range(len(cols))] # prepare format for response
-
-            #out = ShapResponse(status=ResponseStatus.terminated, base_value=shap_bval, values=shap_attributes, pred_proba=pred_proba, recommendation=recommendation)
-            out = ShapResponse(status=ResponseStatus.terminated, base_value=shap_bval, values=shap_attributes)
-            res_out[job.uid] = out
-        elif job.exp_type in [ExplanationType.lime, ExplanationType.lime_orig]:
-            if job.task["num_features"] is not None:
-                num_features = job.task["num_features"]
+        try:
+            if cancelled():
+                raise JobCancelled()
+            if job.batch and job.exp_type in [ExplanationType.shap, ExplanationType.shap_orig, ExplanationType.lime, ExplanationType.lime_orig]:
+                out = batch_response(job, explainers, cancelled)
+            elif job.exp_type in [ExplanationType.shap, ExplanationType.shap_orig]:
+                shap_explainer, cols = explainers.shap()
+                out = shap_response(job.task["instance"], cancellable_explainer(shap_explainer, cancelled), cols)
+            elif job.exp_type in [ExplanationType.lime, ExplanationType.lime_orig]:
+                lh = explainers.lime()
+                out = lime_response(job.task["instance"], lh, job.task["num_features"], cancellable(lh.predict_fn, cancelled))
             else:
-                num_features = all_features
-            # Modification
-            # Add base value
-            lime_vals, lime_bval = lh.compute_response_lime(job.task["instance"].__dict__, num_features) #pass the instance in the required format
-            #lh_res = lh.compute_response_lime(job.task["instance"].__dict__, num_features) #pass the instance in the required format
-            out = LimeResponse(status=ResponseStatus.terminated, base_value=lime_bval, values=lime_vals)
-            #out = lh_res
-            #res_out[job.uid] = LimeResponse(status=ResponseStatus.terminated, values=lh_res)
-            res_out[job.uid] = out
-        else:
-            print(f"\033[93mWARNING:\033[0m \033[1m{job.exp_type.value}\033[0m is invalid for explanation with uuid {job.uid}. Fetching new job.")
-            continue
+                print(f"\033[93mWARNING:\033[0m \033[1m{job.exp_type.value}\033[0m is invalid for explanation with uuid {job.uid}. Fetching new job.")
+                out = failed_response(job)
+        except JobCancelled:
+            print(f"\033[92mINFO:\033[0m Explainer process with id \033[96m{os.getpid()}\033[0m aborted the cancelled explanation with uuid {job.uid}.")
+            out = None
+        except Exception:
+            # the process keeps running, the API process gets the error status and releases the followers of the cache key
+            print(f"\033[93mWARNING:\033[0m Explanation with uuid {job.uid} failed:\n{traceback.format_exc()}")
+            out = failed_response(job)
 
+        # the API process stores the result, starts its timeout and resolves the cache key (see JobTransport)
+        out_queue.put((worker_id, job.uid, out, job.cache_key))
+        if out is None or out.status == ResponseStatus.error:
+            continue
         end_time = time.time()
 
         print(f"\033[92mINFO:\033[0m Explainer process with id \033[96m{os.getpid()}\033[0m finished \033[1m{job.exp_type.value}\033[0m computation.\n      Time taken: {end_time-start_time} seconds.")
-        print(f"      Result saved with uuid {job.uid}.")
+        print(f"      Result sent with uuid {job.uid}.")
+
+
+def failed_response(job: Job):
+    """The response with the error status for a job that could not be explained"""
+    if job.batch:
+        return BatchExplanationResponse(status=ResponseStatus.error)
+    if job.exp_type in [ExplanationType.lime, ExplanationType.lime_orig]:
+        return LimeResponse(status=ResponseStatus.error)
+    return ShapResponse(status=ResponseStatus.error)
+
+
+class LazyExplainers:
+    """The explainers of a worker process, each one is loaded when it is used the first time"""
+
+    def __init__(self):
+        self._shap = None
+        self._lime = None
+
+    def load(self, method: str):
+        """Loads the explainer of the method ("shap" or "lime") in advance"""
+        self.shap() if method == "shap" else self.lime()
+
+    def shap(self):
+        """Returns the KernelExplainer and the attribute names in the order used by SHAP"""
+        if self._shap is None:
+            self._shap = load_shap_explainer()
+            print(f"      SHAP background: \033[1m{shap_background_mode}\033[0m with {len(self._shap[0].data.weights)} rows.")
+        return self._shap
+
+    def lime(self):
+        """Returns the LimeHelper"""
+        if self._lime is None:
+            self._lime = load_lime_explainer()
+        return self._lime
+
+
+def load_explainers():
+    """Loads the SHAP and LIME explainers. Returns the KernelExplainer, the attribute names in the order used by SHAP and the LimeHelper."""
+    shap_explainer, cols = load_shap_explainer()
+    return shap_explainer, cols, load_lime_explainer()
+
+
+def load_shap_explainer():
+    """Loads the SHAP KernelExplainer. Returns it with the attribute names in the order used by SHAP."""
+    import shap
+    from shap_utils import ShapHelperV2, summarize_background
+    sh = ShapHelperV2()
+    sh.prepare_shap()
+    pred_fn = sh.predict_shap
+
+    # the background is summarized once per worker, its size determines the cost of each explanation
+    background = summarize_background(sh, shap_background_mode, shap_background_size)
+    shap_explainer = shap.KernelExplainer(pred_fn, background)
+    cols = sh.X_train.columns.to_list()
+    return shap_explainer, cols
+
+
+def load_lime_explainer():
+    """Loads the LimeHelper"""
+    from lime_utils import LimeHelper
+    return LimeHelper()
+
+
+def shap_response(instance, explainer, cols: list):
+    """Computes the SHAP explanation for one instance and returns it in the response format"""
+    # Modification Backup
+    # Add sh to parameter to compute prediction
+    #shap_bval, shap_vals, pred_proba, recommendation  = compute_response_shap(job.task["instance"], shap_explainer, cols, sh)
+    shap_bval, shap_vals, = compute_response_shap(instance, explainer, cols)
+
+    shap_attributes = [{"attribute" : cols[i], "influence" : shap_vals[0][i]} for i in range(len(cols))] # prepare format for response
+
+    #out = ShapResponse(status=ResponseStatus.terminated, base_value=shap_bval, values=shap_attributes, pred_proba=pred_proba, recommendation=recommendation)
+    return ShapResponse(status=ResponseStatus.terminated, base_value=shap_bval, values=shap_attributes)
+
+
+def seeded_lime_helper(lh, seed: int):
+    """Shallow copy of the LimeHelper whose explainer draws its samples from a new RandomState with the given seed.
+    LIME samples from the random state of the explainer, its LimeBase and its discretizer, threads sharing them would
+    interleave their draws and the explanations of a batch would depend on the thread scheduling."""
+    random_state = np.random.RandomState(seed)
+    explainer = copy.copy(lh.explainer)
+    explainer.random_state = random_state
+    explainer.base = copy.copy(explainer.base)
+    explainer.base.random_state = random_state
+    if explainer.discretizer is not None:
+        explainer.discretizer = copy.copy(explainer.discretizer)
+        explainer.discretizer.random_state = random_state
+    helper = copy.copy(lh)
+    helper.explainer = explainer
+    return helper
+
+
+def lime_response(instance, lh, num_features: Optional[int], prediction_function=None):
+    """Computes the LIME explanation for one instance and returns it in the response format"""
+    if num_features is None:
+        num_features = all_features
+    # Modification
+    # Add base value
+    lime_vals, lime_bval = lh.compute_response_lime(instance.__dict__, num_features, prediction_function) #pass the instance in the required format
+    return LimeResponse(status=ResponseStatus.terminated, base_value=lime_bval, values=lime_vals)
+
+
+def cancellable(predict_fn, cancelled):
+    """Wraps the prediction function of an explainer so that the explanation of a cancelled job is aborted:
+    the rows are predicted in chunks of `cancel_check_rows` and JobCancelled is raised between the chunks."""
+    def predict(x):
+        if cancelled():
+            raise JobCancelled()
+        if len(x) <= cancel_check_rows:
+            return predict_fn(x)
+        out = []
+        for start in range(0, len(x), cancel_check_rows):
+            if cancelled():
+                raise JobCancelled()
+            out.append(predict_fn(x[start:start + cancel_check_rows]))
+        return np.concatenate(out)
+    return predict
+
+
+def cancellable_explainer(shap_explainer, cancelled):
+    """Returns a (shallow) copy of the KernelExplainer whose model calls check whether the job has been cancelled"""
+    from shap.utils._legacy import Model
+    explainer = copy.copy(shap_explainer)
+    explainer.model = Model(cancellable(shap_explainer.model.f, cancelled), None)
+    return explainer
+
+
+def batch_response(job: Job, explainers: LazyExplainers, cancelled=lambda: False):
+    """Explains all instances of a batch job. The instances are split between up to `batch_stack_size` threads,
+    whose model calls are stacked into a single model call by a StackedPredictor."""
+    instances = job.task["instances"]
+    num_threads = min(batch_stack_size, len(instances))
+    results = [None] * len(instances)
+
+    if job.exp_type in [ExplanationType.shap, ExplanationType.shap_orig]:
+        from shap.utils._legacy import Model
+        shap_explainer, cols = explainers.shap()
+        predictor = StackedPredictor(cancellable(shap_explainer.model.f, cancelled), num_threads)
+
+        def explain(i):
+            # the explainer keeps the state of the current explanation, so every thread needs its own (shallow) copy
+            explainer = copy.copy(shap_explainer)
+            explainer.model = Model(predictor.predict, None)
+            return shap_response(instances[i], explainer, cols)
+    else:
+        lh = explainers.lime()
+        predictor = StackedPredictor(cancellable(lh.predict_fn, cancelled), num_threads)
 
-        threading.Thread(target=timeout_explanation, args=(job.uid, res_out, timeout_seconds)).start()
-        print(f"      Timeout for explanation {job.uid} has begun. Deletion in {timeout_seconds} seconds.")
+        def explain(i):
+            # the samples of every instance are drawn from its own random state, seeded with its position in the batch
+            return lime_response(instances[i], seeded_lime_helper(lh, i), job.task["num_features"], predictor.predict)
 
+    def run(indices):
+        try:
+            for i in indices:
+                results[i] = explain(i)
+        finally:
+            predictor.leave()
 
-def timeout_explanation(uid: UUID, results_dict: dict, timeout_seconds: int):
-    '''Will remove the generated explanation a certain amount of time after its generation. This method should only be used after the explanation has been generated.'''
-    time.sleep(timeout_seconds)
-    try:
-        results_dict.pop(uid)
-    except KeyError:
-        # Could have been deleted otherwise
-        print(f"\033[92mINFO:\033[0m Explanation with uuid {uid} couldn't be deleted. Key does not exist.")
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for future in [executor.submit(run, range(t, len(instances), num_threads)) for t in range(num_threads)]:
+            future.result()
 
-    print(f"\033[92mINFO:\033[0m Explanation with uuid {uid} has been deleted due to timeout.")   
\ No newline at end of file
+    print(f"      Batch of {len(instances)} instances explained with {predictor.num_model_calls} model calls.")
+    return BatchExplanationResponse(status=ResponseStatus.terminated, results=results)
@@ -11,6 +11,7 @@ from starlette.status import (
     HTTP_202_ACCEPTED,
     HTTP_400_BAD_REQUEST,
 )
+import json
 import time
 import numpy as np
 from tqdm import tqdm
@@ -57,6 +58,16 @@ def test_get_instance_by_id():
     res = r_get("instance/124asghla")  # gibberish query
     assert res.status_code == HTTP_422_UNPROCESSABLE_ENTITY
 
+def test_instance_etag():
+    for path in ["instance/5", "explanations/dice?instance_id=5"]:
+        res = r_get(path)
+        assert res.status_code == 200
+        etag = res.headers["ETag"]
+        res_cached = requests.get(route(path), headers={"If-None-Match": etag})
+        assert res_cached.status_code == 304 and res_cached.content == b""
+        assert res_cached.headers["ETag"] == etag
+        assert requests.get(route(path), headers={"If-None-Match": '"other"'}).json() == res.json()
+
 
 def test_table_bad_request():
     request_data = {
@@ -119,6 +130,63 @@ def test_table_false_values():
     res = r_post("table", request_data)
     assert res.status_code == 200
 
+def test_concurrent_table():
+    # concurrent table requests with different sortings must not interfere with each other
+    requests_data = [{"attributes": ["balance", "amount"], "sort_by": sort_by, "sort_ascending": asc, "limit": 50, "offset": 100}
+                     for sort_by in ["id", "amount", "balance", "age"] for asc in [True, False]]
+    expected = [r_post("table", request_data).json() for request_data in requests_data]
+    responses = [None] * len(requests_data) * 4
+
+    def thread_worker(i):
+        responses[i] = r_post("table", requests_data[i % len(requests_data)]).json()
+
+    threads = [threading.Thread(target=thread_worker, args=(i,)) for i in range(len(responses))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i, res in enumerate(responses):
+        assert res == expected[i % len(requests_data)]
+
+def test_table_cursor():
+    # paging with the cursors must return the same instances as paging with offsets
+    request_data = {
+        "filter": [{"attribute": "amount", "lower_bound": 1000, "upper_bound": 5000}],
+        "attributes": ["balance", "amount"],
+        "sort_by": "balance",
+        "sort_ascending": False,
+        "limit": 50,
+    }
+    by_offset = []
+    by_cursor = []
+    next_cursor = None
+    for page in range(5):
+        by_offset += r_post("table", {**request_data, "offset": page * 50}).json()
+        res = r_post("table", {**request_data, "cursor": next_cursor} if next_cursor else request_data)
+        assert res.status_code == 200
+        by_cursor += res.json()
+        next_cursor = res.headers["X-Next-Cursor"]
+    assert [inst["id"] for inst in by_cursor] == [inst["id"] for inst in by_offset]
+
+    # a cursor is only valid for the sorting and filters it was created with
+    res = r_post("table", {**request_data, "sort_by": "amount", "cursor": next_cursor})
+    assert res.status_code == HTTP_400_BAD_REQUEST
+
+def test_table_facets():
+    filters = [
+        {"attribute": "assets", "values": ["car", "real estate"]},
+        {"attribute": "amount", "lower_bound": 1140, "upper_bound": 8612},
+    ]
+    res = r_post("table/facets", {"filter": filters, "bins": 5})
+    assert res.status_code == 200
+    facets = res.json()
+    instances = r_post("table", {"filter": filters, "attributes": ["amount"], "limit": 1000}).json()
+    assert facets["total"] == len(instances)
+    assert sum(facets["categorical"]["NN_recommendation"].values()) == len(instances)
+    assert facets["categorical"]["assets"]["life insurance"] == 0
+    assert len(facets["histograms"]["amount"]["counts"]) == 5
+    assert sum(facets["histograms"]["amount"]["counts"]) == len(instances)
+
 
 def test_time_table():
     request_data = {
@@ -150,6 +218,81 @@ def test_time_table():
     assert np.mean(times) < 50  # assert less than 50 milliseconds per request on average
     assert len(res.json()) > 0
 
+def test_concurrent_predict():
+    # concurrent predictions are batched into one model call, every request must still get its own result
+    instances = [r_get(f"instance/{i}").json() for i in range(20)]
+    responses = [None] * len(instances)
+
+    def thread_worker(i):
+        model_instance = {k: v for k, v in instances[i].items() if k not in ["id", "NN_recommendation", "NN_confidence"]}
+        responses[i] = r_post("instance/predict", model_instance).json()
+
+    threads = [threading.Thread(target=thread_worker, args=(i,)) for i in range(len(instances))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for instance, res in zip(instances, responses):
+        assert res["NN_recommendation"] == instance["NN_recommendation"]
+        assert abs(res["NN_confidence"] - instance["NN_confidence"]) < 1e-5
+
+def test_batch_predict():
+    instances = [r_get(f"instance/{i}").json() for i in range(20)]
+    model_instances = [{k: v for k, v in inst.items() if k not in ["id", "NN_recommendation", "NN_confidence"]} for inst in instances]
+    columnar = {k: [inst[k] for inst in model_instances] for k in model_instances[0].keys()}
+    ndjson = "\n".join(json.dumps(inst) for inst in model_instances)
+    for res in [r_post("instance/predict/batch", model_instances),
+                r_post("instance/predict/batch", columnar),
+                requests.post(route("instance/predict/batch"), data=ndjson, headers={"Content-Type": "application/x-ndjson"})]:
+        assert res.status_code == 200
+        assert len(res.json()) == len(instances)
+        for instance, prediction in zip(instances, res.json()):
+            assert prediction["NN_recommendation"] == instance["NN_recommendation"]
+            assert abs(prediction["NN_confidence"] - instance["NN_confidence"]) < 1e-5
+
+    # wrong rows are reported with their index
+    faulty = model_instances[:3]
+    faulty[1] = {**faulty[1], "balance": "not a balance"}
+    res = r_post("instance/predict/batch", faulty)
+    assert res.status_code == 400 and res.json()["detail"] == [{"index": 1, "attribute": "balance"}]
+
+    # columnar payloads need a list of the same length per attribute
+    assert r_post("instance/predict/batch", {**columnar, "age": 5}).status_code == 400
+    assert r_post("instance/predict/batch", {**columnar, "age": columnar["age"][:5]}).status_code == 400
+
+def test_explanation_under_load():
+    # database queries and model calls run in executors, the event loop keeps answering the explanation status polls and
+    # delivers the result of an explanation while heavy table and batch requests are in flight
+    all_attributes = [attr for attr in r_get("instance/0").json().keys() if attr not in ["id", "NN_recommendation", "NN_confidence"]]
+    heavy_table = {"attributes": all_attributes, "sort_by": "purpose", "limit": 1000}
+    instance = {k: v for k, v in r_get("instance/0").json().items() if k in all_attributes}
+    heavy_batch = {k: [v] * 10000 for k, v in instance.items()}
+    # the bodies are encoded once, so the clients do not compete with the polls for the GIL of this process
+    bodies = [("table", json.dumps(heavy_table)), ("instance/predict/batch", json.dumps(heavy_batch))]
+    stop = threading.Event()
+
+    def heavy_worker(i):
+        path, body = bodies[i % 2]
+        while not stop.is_set():
+            requests.post(route(path), data=body, headers={"Content-Type": "application/json"})
+
+    threads = [threading.Thread(target=heavy_worker, args=(i,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    try:
+        time.sleep(0.5)
+        explained = r_get("instance/7").json()
+        explained["amount"] = explained["amount"] + 1  # modified, so there is no pregenerated explanation
+        uid = r_post("explanations/lime", {"instance": explained, "num_features": 18}).json()["href"]
+        assert r_get(f"explanations/lime?uid={uid}").json()["status"] in ["in progress", "terminated"]
+        # the long poll is answered with the result, not with the current status after its timeout
+        res = r_get(f"explanations/lime/wait?uid={uid}").json()
+        assert res["status"] == "terminated" and len(res["values"]) == 18
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
 
 def test_exp_generation_lime():
     request_data = {
@@ -240,6 +383,82 @@ def test_multiple_lime():
     # Making sure the results are all saved in the dictionary
     assert len(r_get("result_uids").json()) == num_trials + 1
 
+def test_precomputed_shap():
+    # unmodified dataset instances are answered from the pregenerated explanations if the shap table has been filled
+    instance = r_get("instance/0").json()
+    res = r_post("explanations/shap", {"instance": instance})
+    assert res.status_code == HTTP_202_ACCEPTED
+    if res.json()["status"] == "terminated":
+        res = r_get(f"explanations/shap?uid={res.json()['href']}").json()
+        assert res["status"] == "terminated"
+        assert len(res["values"]) == 18
+
+def test_cached_lime():
+    instance = r_get("instance/3").json()
+    instance["amount"] = instance["amount"] + 1  # modified, so there is no pregenerated explanation
+    request_data = {"instance": instance, "num_features": 18}
+    uid = r_post("explanations/lime", request_data).json()["href"]
+    first = r_get(f"explanations/lime?uid={uid}").json()
+    while first["status"] == "in progress":
+        first = r_get(f"explanations/lime?uid={uid}").json()
+
+    # the identical request is answered from the cache
+    res = r_post("explanations/lime", request_data).json()
+    assert res["status"] == "terminated"
+    second = r_get(f"explanations/lime?uid={res['href']}").json()
+    assert second["values"] == first["values"]
+
+def test_wait_and_stream_shap():
+    instance = r_get("instance/4").json()
+    instance["duration"] = instance["duration"] + 1  # modified, so there is no pregenerated explanation
+    uid = r_post("explanations/shap", {"instance": instance}).json()["href"]
+    # the long poll is answered when the result is ready, the SHAP computation takes less than the max. waiting time
+    res = r_get(f"explanations/shap/wait?uid={uid}").json()
+    assert res["status"] == "terminated" and len(res["values"]) == 18
+    assert r_get(f"explanations/lime/wait?uid={uid}").json()["status"] == "Uuid corresponds to antoher explanation method"
+
+    instance["duration"] = instance["duration"] + 1
+    uid = r_post("explanations/shap", {"instance": instance}).json()["href"]
+    res = requests.get(route(f"explanations/shap/stream?uid={uid}"), stream=True)
+    assert res.headers["content-type"].startswith("text/event-stream")
+    events = [line for line in res.iter_lines(decode_unicode=True) if line.startswith("event:")]
+    assert events == ["event: status", "event: result"]
+
+def test_cancel_and_supersede_shap():
+    instance = r_get("instance/6").json()
+    instance["duration"] = instance["duration"] + 3  # modified, so there is no pregenerated explanation
+    first = r_post("explanations/shap", {"instance": instance, "view": "test:shap"}).json()["href"]
+    instance["duration"] = instance["duration"] + 1
+    second = r_post("explanations/shap", {"instance": instance, "view": "test:shap"}).json()["href"]
+    # the newer request of the same view cancels the first one
+    assert r_get(f"explanations/shap?uid={first}").json()["status"] == "cancelled"
+
+    res = requests.delete(route(f"explanations/{second}"))
+    assert res.status_code == 200 and res.json()["status"] == "cancelled"
+    assert r_get(f"explanations/shap/wait?uid={second}").json()["status"] == "cancelled"
+    assert requests.delete(route(f"explanations/{second}")).status_code == HTTP_404_NOT_FOUND
+
+    instance["duration"] = instance["duration"] + 1
+    background = r_post("explanations/shap", {"instance": instance, "priority": "background"}).json()["href"]
+    assert r_get(f"explanations/shap/wait?uid={background}").json()["status"] == "terminated"
+
+def test_batch_lime():
+    request_data = {"loan_ids": [0, 12, 100], "num_features": 18}
+    res = r_post("explanations/lime/batch", request_data)
+    assert res.status_code == HTTP_202_ACCEPTED
+    uid = res.json()["href"]
+
+    res = r_get(f"explanations/batch?uid={uid}").json()
+    while res["status"] == "in progress":
+        res = r_get(f"explanations/batch?uid={uid}").json()
+    assert res["status"] == "terminated"
+    assert len(res["results"]) == 3
+    for exp in res["results"]:
+        assert len(exp["values"]) == 18
+
+    res = r_post("explanations/lime/batch", {"loan_ids": [1000]})
+    assert res.status_code == HTTP_400_BAD_REQUEST
+
 @pytest.mark.skip(reason="Takes too long.")
 def test_multiple_shap():
     uids = []
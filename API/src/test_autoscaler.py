@@ -0,0 +1,114 @@
+# Tests of the scale decisions of the WorkerSupervisor.
+# To run these tests, cd to the API/src folder and run pytest test_autoscaler.py (the API does not need to be running)
+# The explainer processes are simulated, their ready messages are put on the `done` queue of the transport directly.
+
+import os
+import math
+from types import SimpleNamespace
+
+import autoscaler
+from autoscaler import WorkerSupervisor, expected_wait
+from constants import ExplanationType, ResponseStatus
+from job_transport import JobTransport
+from task_gen import Job
+from test_job_transport import wait_until
+
+
+class FakeProcess:
+    def __init__(self, transport, worker_id):
+        self.pid = os.getpid()
+        self.exitcode = None
+        transport.done.put((worker_id, None, None, None))  # ready
+
+    def is_alive(self):
+        return self.exitcode is None
+
+    def join(self):
+        pass
+
+
+def supervisor(max_workers, on_result=None, **kwargs):
+    transport = JobTransport({}, on_result, ["shap", "lime"], steal_reserve=1)
+    transport.start()
+    sv = WorkerSupervisor(transport, lambda worker_id: FakeProcess(transport, worker_id), max_workers, **kwargs)
+    sv.start()
+    sv.stop()  # the steps are made by the test
+    wait_until(lambda: transport.metrics()["pools"]["shap"]["idle_workers"] == 1)
+    return sv, transport
+
+
+def test_expected_wait():
+    assert expected_wait({"workers": 2, "service_seconds": None}, 1) == 0
+    assert expected_wait({"workers": 2, "service_seconds": None}, 2) == math.inf
+    assert expected_wait({"workers": 2, "service_seconds": 4.0}, 3) == 6.0
+
+
+def test_grows_up_to_the_bound_and_shrinks_to_the_layout():
+    sv, transport = supervisor(3, target_wait=1, idle_seconds=0, min_free_memory_mb=0, worker_memory_mb=0, explainer_memory_mb=0)
+    for _ in range(4):
+        transport.submit(Job(exp_type=ExplanationType.shap, status=ResponseStatus.in_prog))
+    sv.step()
+    sv.step()  # max_workers is reached
+    assert [d["action"] for d in sv.decisions] == ["start"]
+    assert transport.metrics()["pools"]["shap"]["workers"] == 2
+    wait_until(lambda: transport.metrics()["pools"]["shap"]["running"] == 2)
+
+    # the jobs are finished, the added worker is retired again, the minimum layout stays
+    for worker_id in [0, 2]:
+        uid = next(uid for uid, (w, job) in transport._running.items() if w == worker_id)
+        transport.done.put((worker_id, uid, "result", None))
+    wait_until(lambda: transport.metrics()["pools"]["shap"]["queued"]["interactive"] == 0)
+    for worker_id in [0, 2]:
+        uid = next(uid for uid, (w, job) in transport._running.items() if w == worker_id)
+        transport.done.put((worker_id, uid, "result", None))
+    wait_until(lambda: transport.metrics()["pools"]["shap"]["idle_workers"] == 2)
+    sv.step()
+    sv.step()
+    assert [d["action"] for d in sv.decisions] == ["start", "retire"]
+    assert transport.metrics()["pools"]["shap"]["workers"] == 1
+    transport.stop()
+
+
+def test_holds_without_memory():
+    sv, transport = supervisor(4, target_wait=1, min_free_memory_mb=10 ** 9)
+    for _ in range(3):
+        transport.submit(Job(exp_type=ExplanationType.shap, status=ResponseStatus.in_prog))
+    sv.step()
+    sv.step()
+    assert [d["action"] for d in sv.decisions] == ["hold"]
+    assert transport.metrics()["pools"]["shap"]["workers"] == 1
+    transport.stop()
+
+
+def test_keeps_memory_for_the_second_explainers(monkeypatch):
+    sv, transport = supervisor(4, target_wait=1, min_free_memory_mb=0, explainer_memory_mb=1000)
+    monkeypatch.setattr(sv, "measured_worker_memory", lambda: 1000)
+    available = {"mb": 3500}
+    monkeypatch.setattr(autoscaler.psutil, "virtual_memory", lambda: SimpleNamespace(available=available["mb"] * 2 ** 20))
+    for _ in range(3):
+        transport.submit(Job(exp_type=ExplanationType.shap, status=ResponseStatus.in_prog))
+    # the new worker needs 1000 MB and 1000 MB for its second explainer, both running workers can grow by 1000 MB
+    sv.step()
+    assert [d["action"] for d in sv.decisions] == ["hold"]
+    available["mb"] = 4000
+    sv.step()
+    assert [d["action"] for d in sv.decisions] == ["hold", "start"]
+    transport.stop()
+
+
+def test_replaces_a_crashed_worker():
+    finished = []
+    sv, transport = supervisor(2, on_result=lambda uid, response, key: finished.append((uid, response.status, key)))
+    crashing = Job(exp_type=ExplanationType.shap, status=ResponseStatus.in_prog, cache_key="key")
+    transport.submit(crashing)
+    wait_until(lambda: transport.metrics()["pools"]["shap"]["running"] == 1)
+    sv.processes[0].exitcode = -9
+    sv.step()
+    # the running job fails, so the API releases its cache key, and the pool gets a new worker
+    assert finished == [(crashing.uid, ResponseStatus.error, "key")]
+    assert transport.results[crashing.uid].status == ResponseStatus.error
+    assert [d["action"] for d in sv.decisions] == ["exited", "start"]
+    assert sorted(sv.processes) == [1, 2] and transport.pools[2] == "shap"
+    wait_until(lambda: transport.metrics()["pools"]["shap"]["idle_workers"] == 1)
+    assert transport.metrics()["pools"]["shap"]["workers"] == 1
+    transport.stop()
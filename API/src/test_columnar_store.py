@@ -0,0 +1,66 @@
+# Parity tests of the ColumnarStore against the SQL queries of the table view (the `con` fixture in conftest.py).
+# To run these tests, cd to the API/src folder and run pytest test_columnar_store.py (the API does not need to be running)
+
+import pytest
+
+from constants import AttributeNames, attribute_constraints, attr_name
+from database_req import get_applications_keyset, get_filtered_columns
+from columnar_store import ColumnarStore, facet_counts
+from models import TableRequest
+
+
+@pytest.fixture(scope="module")
+def store(con):
+    return ColumnarStore.from_database(con)
+
+
+requests_data = [
+    {"attributes": ["balance", "amount"]},
+    {"filter": [{"attribute": "assets", "values": ["car", "real estate"]},
+                {"attribute": "housing", "values": ["for free", "own"]},
+                {"attribute": "amount", "lower_bound": 1140, "upper_bound": 8612}],
+     "attributes": ["balance", "duration", "amount", "age", "savings"]},
+    {"filter": [{"attribute": "employment", "values": []}], "attributes": ["age"]},
+    # continuous filter on a categorical attribute, sqlite returns nothing
+    {"filter": [{"attribute": "balance", "lower_bound": 2000, "upper_bound": 5000}], "attributes": ["amount"]},
+    {"filter": [{"attribute": "amount", "values": ["1169", "not a number"]}], "attributes": ["amount"]},
+]
+
+
+@pytest.mark.parametrize("request_data", requests_data)
+@pytest.mark.parametrize("sort", ["id", "balance", "amount", "purpose", "NN_confidence", "NN_recommendation"])
+def test_pages_identical_to_sql(con, store, request_data, sort):
+    for sort_asc in [True, False]:
+        for offset, limit in [(0, 20), (35, 50), (990, 20), (0, 0), (-5, 10)]:
+            request = TableRequest.parse_obj({**request_data, "sort_by": sort, "sort_ascending": sort_asc, "offset": offset, "limit": limit})
+            attributes = [attr.value for attr in request.attributes] + [AttributeNames.NN_recommendation.value]
+            args = (attributes, request.limit, request.filter, request.sort_by, request.sort_ascending, request.offset)
+            assert store.page(*args) == get_applications_keyset(con, *args)
+
+
+@pytest.mark.parametrize("sort", ["id", "employment", "age", "NN_confidence"])
+def test_cursors_identical_to_sql(con, store, sort):
+    request = TableRequest.parse_obj({**requests_data[1], "sort_by": sort, "sort_ascending": sort == "age", "limit": 30})
+    args = (["amount"], request.limit, request.filter, request.sort_by, request.sort_ascending)
+    next_cursor = None
+    pages = 0
+    while True:
+        rows, next_cursor_sql = get_applications_keyset(con, *args, cursor=next_cursor)
+        assert store.page(*args, cursor=next_cursor) == (rows, next_cursor_sql)
+        next_cursor = next_cursor_sql
+        pages += 1
+        if next_cursor is None:
+            break
+    assert pages > 1
+
+
+@pytest.mark.parametrize("request_data", requests_data)
+def test_facets_identical_to_sql(con, store, request_data):
+    request = TableRequest.parse_obj(request_data)
+    columns = [AttributeNames.ident.value] + [constraint[attr_name].value for constraint in attribute_constraints]
+    facets = store.facets(request.filter, 7)
+    assert facets == facet_counts(get_filtered_columns(con, columns, request.filter), 7)
+    rows, _ = get_applications_keyset(con, ["age"], -1, request.filter)
+    assert facets["total"] == len(rows)
+    assert sum(facets["categorical"]["balance"].values()) == len(rows)
+    assert sum(facets["histograms"]["age"]["counts"]) == len([row for row in rows if 19 <= row["age"] <= 75])
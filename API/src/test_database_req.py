@@ -0,0 +1,79 @@
+# Tests of the table queries on an in-memory copy of the applicants table (the `con` fixture in conftest.py).
+# To run these tests, cd to the API/src folder and run pytest test_database_req.py (the API does not need to be running)
+
+import sqlite3 as sql
+import pytest
+
+from database_req import compile_table_query, execute_table_query, get_application_ids, get_applications_custom
+from models import TableRequest
+
+
+def query_plan(con, query: str):
+    return " | ".join(row[3] for row in con.execute("EXPLAIN QUERY PLAN " + query, [1] * query.count("?")).fetchall())
+
+
+def filters(filter_list):
+    return TableRequest.parse_obj({"filter": filter_list}).filter
+
+
+@pytest.mark.parametrize("sort", ["balance", "employment", "purpose"])
+def test_categorical_sort_uses_ordinal_index(con, sort):
+    for sort_asc in [True, False]:
+        query, _ = compile_table_query(["amount"], sort=sort, sort_asc=sort_asc)
+        plan = query_plan(con, query)
+        assert f"INDEX applicants_{sort}_ord" in plan
+        assert "TEMP B-TREE" not in plan
+
+
+@pytest.mark.parametrize("sort", ["amount", "age", "duration", "NN_confidence"])
+def test_continuous_sort_uses_index(con, sort):
+    query, _ = compile_table_query(["amount"], sort=sort, sort_asc=False)
+    plan = query_plan(con, query)
+    assert f"INDEX applicants_{sort}" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def test_seek_uses_index(con):
+    query, _ = compile_table_query(["amount"], sort="housing", seek=True)
+    assert "SEARCH applicants USING INDEX applicants_housing_ord" in query_plan(con, query)
+
+
+def test_range_filter_uses_index(con):
+    query, _ = compile_table_query(["amount"], filters([{"attribute": "age", "lower_bound": 20, "upper_bound": 25}]))
+    assert "SEARCH applicants USING INDEX applicants_age" in query_plan(con, query)
+
+
+def test_ordinal_columns_sort_like_expressions(con):
+    request_filters = filters([{"attribute": "assets", "values": ["car", "real estate"]},
+                               {"attribute": "amount", "lower_bound": 1140, "upper_bound": 8612}])
+    for sort in ["balance", "savings", "NN_recommendation"]:
+        for sort_asc in [True, False]:
+            rows = get_applications_custom(con, 0, ["amount"], 1000, filters=request_filters, sort=sort, sort_asc=sort_asc)
+            query, params = compile_table_query(["amount"], request_filters, sort, sort_asc, ordinals=False)
+            expected = [row[:-1] for row in con.execute(query, params + [1000, 0]).fetchall()]
+            assert rows == expected
+
+
+def test_only_missing_ordinal_columns_fall_back_to_expressions(con):
+    # a database created before the ordinal columns existed
+    old = sql.connect(":memory:")
+    old.execute("CREATE TABLE applicants (id INTEGER, amount INTEGER, balance TEXT)")
+    old.executemany("INSERT INTO applicants VALUES (?,?,?)", con.execute("SELECT id, amount, balance FROM applicants").fetchall())
+    compile_query = lambda ordinals: compile_table_query(["amount"], sort="balance", ordinals=ordinals)
+    assert execute_table_query(old, compile_query, [5, 0]) == execute_table_query(con, compile_query, [5, 0])
+    # other errors are raised without querying the expressions
+    compiled = []
+    with pytest.raises(sql.OperationalError, match="no such table"):
+        execute_table_query(con, lambda ordinals: compiled.append(ordinals) or ("SELECT id FROM missing LIMIT ? OFFSET ?", []), [5, 0])
+    assert compiled == [True]
+    old.close()
+
+
+def test_application_ids_come_from_the_table(con):
+    # the ids of a copy with deleted applicants have gaps
+    copy = sql.connect(":memory:")
+    copy.execute("CREATE TABLE applicants (id INTEGER, amount INTEGER)")
+    copy.executemany("INSERT INTO applicants VALUES (?,?)", con.execute("SELECT id, amount FROM applicants WHERE id % 3 != 1").fetchall())
+    ids = get_application_ids(copy)
+    assert ids == sorted(ids) and 1 not in ids and len(ids) == copy.execute("SELECT COUNT(*) FROM applicants").fetchone()[0]
+    copy.close()
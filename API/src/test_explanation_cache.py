@@ -0,0 +1,55 @@
+# Tests of the memory and disk tiers of the ExplanationCache and the collapsing of identical requests.
+# To run these tests, cd to the API/src folder and run pytest test_explanation_cache.py (the API does not need to be running)
+
+import sqlite3 as sql
+
+from constants import ResponseStatus
+from explanation_cache import ExplanationCache
+from models import ShapResponse
+
+
+def response(base_value=0.5):
+    return ShapResponse(status=ResponseStatus.terminated, base_value=base_value)
+
+
+def test_leader_and_followers():
+    cache = ExplanationCache(10)
+    assert cache.claim("shap:a", 1) == (None, True)
+    assert cache.claim("shap:a", 2) == (None, False)
+    results = {}
+    assert cache.resolve("shap:a", response(), results) == [2]
+    assert results[2].base_value == 0.5
+    assert cache.claim("shap:a", 3)[0].base_value == 0.5
+
+
+def test_errors_are_not_cached():
+    cache = ExplanationCache(10)
+    cache.claim("shap:a", 1)
+    cache.resolve("shap:a", ShapResponse(status=ResponseStatus.error), {})
+    assert cache.claim("shap:a", 2) == (None, True)
+
+
+def test_disk_hits_are_evicted_from_memory(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ExplanationCache(2, path)
+    for i in range(4):
+        cache.claim(f"shap:{i}", i)
+        cache.resolve(f"shap:{i}", response(i), {})
+    assert list(cache.entries) == ["shap:2", "shap:3"]
+    # a new process only has the disk tier, its hits are kept in the bounded memory tier
+    restarted = ExplanationCache(2, path)
+    for i in range(4):
+        assert restarted.claim(f"shap:{i}", i)[0].base_value == i
+    assert list(restarted.entries) == ["shap:2", "shap:3"]
+
+
+def test_disk_tier_is_trimmed_in_batches(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ExplanationCache(1, path, max_disk_entries=10)
+    count = lambda: sql.connect(path).execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+    for i in range(11):
+        cache.resolve(f"shap:{i}", response(i), {})
+    assert count() == 11  # below the batch threshold
+    cache.resolve("shap:11", response(11), {})
+    assert count() == 10
+    assert cache.claim("shap:0", 0) == (None, True) and cache.claim("shap:11", 0)[0].base_value == 11
@@ -0,0 +1,83 @@
+# Parity tests of the FeatureEncoder against the sklearn preprocessors.
+# To run these tests, cd to the API/src folder and run pytest test_feature_encoder.py (the API does not need to be running)
+
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.compose import ColumnTransformer
+from sklearn.preprocessing import LabelEncoder, MinMaxScaler, OneHotEncoder
+
+from constants import feature_names_model_ordered, rename_dict
+from DataLoader_ey import data_loader
+from feature_encoder import FeatureEncoder, records_to_array
+
+
+@pytest.fixture(scope="module")
+def preprocessor():
+    return pickle.load(open("preproc.pickle", "rb"))
+
+
+@pytest.fixture(scope="module")
+def data():
+    return data_loader().drop(columns="label")[feature_names_model_ordered]
+
+
+def dense(matrix):
+    return matrix.toarray() if hasattr(matrix, "toarray") else matrix
+
+
+def test_parity_preproc_pickle(preprocessor, data):
+    encoder = FeatureEncoder(preprocessor, feature_names_model_ordered)
+    expected = dense(preprocessor.transform(data))
+    result = encoder.transform(data.values)
+    assert result.dtype == np.float32
+    assert result.shape == expected.shape
+    assert np.allclose(result, expected, atol=1e-6)
+
+
+def test_parity_single_row_and_unknown_value(preprocessor, data):
+    encoder = FeatureEncoder(preprocessor, feature_names_model_ordered)
+    row = data.iloc[[0]].copy()
+    row["balance_"] = "not a known balance"
+    expected = dense(preprocessor.transform(row))
+    assert np.allclose(encoder.transform(row.values[0]), expected, atol=1e-6)
+
+
+def test_records_in_api_names(preprocessor, data):
+    api_columns = [rename_dict[col] for col in feature_names_model_ordered]
+    encoder = FeatureEncoder(preprocessor, feature_names_model_ordered)
+    records = data.rename(columns=rename_dict).head(50).to_dict("records")
+    expected = dense(preprocessor.transform(data.head(50)))
+    assert np.allclose(encoder.transform(records_to_array(records, api_columns)), expected, atol=1e-6)
+
+
+def test_output_buffer_is_reused(preprocessor, data):
+    encoder = FeatureEncoder(preprocessor, feature_names_model_ordered)
+    first = encoder.transform(data.values[:10])
+    second = encoder.transform(data.values[10:15])
+    assert np.shares_memory(first, second)
+    out = np.empty((10, encoder.num_features), dtype=np.float32)
+    assert encoder.transform(data.values[:10], out=out) is out
+
+
+def test_parity_label_encoded(data):
+    # same steps as in LimeHelper
+    X = data.rename(columns=rename_dict)
+    cat_cols = X.select_dtypes(include=['object', 'category']).columns.to_list()
+    num_cols = X.select_dtypes(include=['int64', 'float64']).columns.to_list()
+    for col in cat_cols:
+        X[col] = LabelEncoder().fit_transform(X[col])
+    X[cat_cols] = X[cat_cols].astype(object)
+    prep = ColumnTransformer(transformers=[('num', MinMaxScaler(), num_cols),
+                                           ('cat', OneHotEncoder(handle_unknown='ignore'), cat_cols)])
+    prep.fit(X)
+    encoder = FeatureEncoder(prep, X.columns.to_list())
+    perturbed = X.values.astype(float)
+    perturbed[0, X.columns.get_loc(cat_cols[0])] = 99  # unknown code
+    expected = dense(prep.transform(pd.DataFrame(perturbed, columns=X.columns).astype(object)))
+    assert np.allclose(encoder.transform(perturbed), expected, atol=1e-6)
+
+
+def test_attribute_constraints_known_by_model(preprocessor):
+    assert FeatureEncoder(preprocessor, feature_names_model_ordered).unknown_values() == {}
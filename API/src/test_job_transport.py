@@ -0,0 +1,101 @@
+# Tests of the scheduling of the JobTransport (pools, priorities, work stealing and cancellation).
+# To run these tests, cd to the API/src folder and run pytest test_job_transport.py (the API does not need to be running)
+# The explainer processes are simulated by putting their messages on the `done` queue directly.
+
+import time
+import queue
+
+from constants import ExplanationType, JobPriority, ResponseStatus
+from job_transport import JobTransport, pool_layout
+from task_gen import Job, failed_response
+
+
+def started_transport(pools, steal_reserve=1):
+    results = {}
+    transport = JobTransport(results, None, pools, steal_reserve)
+    transport.start()
+    for worker_id in range(len(pools)):
+        transport.done.put((worker_id, None, None, None))  # ready
+    wait_until(lambda: sum(pool["idle_workers"] for pool in transport.metrics()["pools"].values()) == len(pools))
+    return transport, results
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def job(exp_type=ExplanationType.shap, priority=JobPriority.interactive):
+    return Job(exp_type=exp_type, status=ResponseStatus.in_prog, priority=priority)
+
+
+def received(transport, worker_id):
+    try:
+        return transport.jobs[worker_id].get(timeout=0.2)
+    except queue.Empty:
+        return None
+
+
+def test_pool_layout():
+    assert pool_layout(1) == ["shap"]
+    assert pool_layout(2) == ["shap", "lime"]
+    assert pool_layout(6) == ["shap"] * 4 + ["lime"] * 2
+    assert pool_layout(6, shap_workers=5) == ["shap"] * 5 + ["lime"]
+    assert pool_layout(6, shap_workers=1, lime_workers=1) == ["shap", "lime"]
+
+
+def test_pools_and_priorities():
+    transport, results = started_transport(["shap", "lime"])
+    running = job()
+    transport.submit(running)
+    assert received(transport, 0).uid == running.uid
+    background, interactive, lime = job(priority=JobPriority.background), job(), job(ExplanationType.lime)
+    for j in [background, interactive, lime]:
+        transport.submit(j)
+    # the LIME job doesn't wait for the SHAP jobs, the LIME worker keeps its reserve and doesn't take SHAP jobs
+    assert received(transport, 1).uid == lime.uid
+    transport.done.put((1, lime.uid, "lime result", None))
+    assert received(transport, 1) is None
+    # the interactive job overtakes the background job
+    transport.done.put((0, running.uid, "shap result", None))
+    assert received(transport, 0).uid == interactive.uid
+    wait_until(lambda: results.get(running.uid) == "shap result")
+    assert transport.metrics()["pools"]["shap"]["queued"] == {"interactive": 0, "background": 1}
+    transport.stop()
+
+
+def test_work_stealing_and_cancellation():
+    transport, results = started_transport(["shap", "lime"], steal_reserve=0)
+    first, second, third = job(), job(), job()
+    for j in [first, second, third]:
+        transport.submit(j)
+    assert received(transport, 0).uid == first.uid
+    assert received(transport, 1).uid == second.uid  # stolen by the idle LIME worker
+    assert transport.cancel(third.uid) == "queued"
+    assert transport.cancel(second.uid) == "running"
+    assert transport.aborts[1].value == second.seq
+    transport.done.put((1, second.uid, "late result", None))
+    assert received(transport, 1) is None
+    time.sleep(0.05)
+    assert second.uid not in results
+    metrics = transport.metrics()
+    assert metrics["stolen"] == 1 and metrics["cancelled"] == 2
+    # the LIME worker has loaded the SHAP explainer for the stolen job
+    assert metrics["pools"]["lime"]["both_explainers"] == 1 and metrics["pools"]["shap"]["both_explainers"] == 0
+    transport.stop()
+
+
+def test_failed_job_keeps_the_worker():
+    transport, results = started_transport(["shap"])
+    failing, next_job = job(), job()
+    transport.submit(failing)
+    transport.submit(next_job)
+    assert received(transport, 0).uid == failing.uid
+    transport.done.put((0, failing.uid, failed_response(failing), None))
+    # the error status is stored like a result and the worker gets the next job
+    assert received(transport, 0).uid == next_job.uid
+    wait_until(lambda: failing.uid in results)
+    assert results[failing.uid].status == ResponseStatus.error
+    transport.stop()
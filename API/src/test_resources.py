@@ -0,0 +1,41 @@
+# Tests of the thread budgets and core sets of the ResourceManager.
+# To run these tests, cd to the API/src folder and run pytest test_resources.py (the API does not need to be running)
+
+import sys
+
+import resources
+from resources import ResourceManager
+
+
+def test_budget_divides_the_cores(monkeypatch):
+    monkeypatch.setattr(resources, "available_cores", lambda: list(range(16)))
+    manager = ResourceManager(7, reserved_cores=2)
+    assert manager.cores == list(range(2, 16)) and manager.threads == 2
+    assert manager.acquire(0).cpus is None
+    assert ResourceManager(4, threads=3).threads == 3
+    # more processes than cores, one thread each
+    assert ResourceManager(64).threads == 1
+
+
+def test_pinned_workers_get_the_least_used_core_set(monkeypatch):
+    monkeypatch.setattr(resources, "available_cores", lambda: list(range(8)))
+    manager = ResourceManager(3, pin=True, reserved_cores=2)
+    assert manager.threads == 2
+    assert [manager.acquire(i).cpus for i in range(3)] == [[2, 3], [4, 5], [6, 7]]
+    manager.release(1)
+    assert manager.acquire(3).cpus == [4, 5]
+    assert manager.report()["pinned"] == {0: [2, 3], 2: [6, 7], 3: [4, 5]}
+    # the core sets are shared once there are more workers than sets
+    assert manager.acquire(4).cpus == [2, 3]
+
+
+def test_tensorflow_is_only_configured_when_needed(monkeypatch):
+    monkeypatch.delitem(sys.modules, "tensorflow", raising=False)
+    monkeypatch.setattr(resources, "inference_backend", "numpy")
+    monkeypatch.setattr(resources, "numpy_weights_path", __file__)  # the exported weights exist
+    assert not resources.tensorflow_needed()
+    monkeypatch.setattr(resources, "numpy_weights_path", "missing.npz")
+    assert resources.tensorflow_needed()
+    monkeypatch.setattr(resources, "inference_backend", "keras")
+    monkeypatch.setattr(resources, "numpy_weights_path", __file__)
+    assert resources.tensorflow_needed()
@@ -0,0 +1,76 @@
+# Tests of the ExpiringResultStore that keeps the explanation results.
+# To run these tests, cd to the API/src folder and run pytest test_result_store.py (the API does not need to be running)
+
+import time
+import threading
+
+from result_store import ExpiringResultStore
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_entries_expire_after_their_ttl():
+    store = ExpiringResultStore()
+    store["in_progress"] = 0
+    store.set("short", 1, ttl=0.05)
+    store.set("long", 2, ttl=0.5)
+    assert store["short"] == 1 and len(store) == 3
+    wait_until(lambda: "short" not in store)
+    assert store.get("long") == 2
+    wait_until(lambda: "long" not in store)
+    # entries without a TTL stay
+    assert store.keys() == ["in_progress"]
+    assert store.metrics() == {"live_entries": 1, "expiring_entries": 0, "evictions": 2, "heap_size": 0}
+
+
+def test_overwriting_keeps_the_ttl_and_expire_restarts_it():
+    store = ExpiringResultStore()
+    store["job"] = "in progress"
+    assert store.expire("job", 0.3)
+    assert not store.expire("unknown", 0.3)
+    store["job"] = "terminated"
+    store.expire("job", 0.3)
+    time.sleep(0.15)
+    store.expire("job", 0.3)
+    time.sleep(0.2)
+    assert store.get("job") == "terminated"
+    wait_until(lambda: "job" not in store)
+
+
+def test_extend_on_read():
+    store = ExpiringResultStore(extend_on_read=True)
+    store.set("polled", 1, ttl=0.2)
+    store.set("forgotten", 2, ttl=0.2)
+    for _ in range(6):
+        time.sleep(0.05)
+        assert store.get("polled") == 1
+    assert "forgotten" not in store
+    wait_until(lambda: "polled" not in store)
+
+
+def test_pop_and_earlier_deadline_wakes_the_sweeper():
+    store = ExpiringResultStore()
+    store.set("late", 1, ttl=60)
+    store.set("removed", 2, ttl=0.05)
+    assert store.pop("removed") == 2
+    assert store.pop("removed", None) is None
+    store.set("early", 3, ttl=0.05)
+    wait_until(lambda: "early" not in store)
+    assert store.metrics()["evictions"] == 1 and "late" in store
+
+
+def test_bounded_threads_and_heap():
+    store = ExpiringResultStore(extend_on_read=True)
+    threads_before = threading.active_count()
+    for i in range(2000):
+        store.set(i, i, ttl=60)
+    for _ in range(10):
+        for i in range(2000):
+            store.get(i)
+    assert threading.active_count() <= threads_before + 1
+    assert store.metrics()["heap_size"] <= 2 * 2000 + 65
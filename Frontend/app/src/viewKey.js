@@ -0,0 +1,13 @@
+/**
+ * Returns the key of an explanation view of this browser tab, it is sent with the explanation requests.
+ * The API cancels the previous request of the same key, so only the explanation that is still displayed is computed.
+ * @param id - The id of the explanation component
+ */
+export function viewKey(id) {
+  let tab = sessionStorage.getItem("viewTab");
+  if (!tab) {
+    tab = Math.random().toString(36).slice(2) + Date.now().toString(36);
+    sessionStorage.setItem("viewTab", tab);
+  }
+  return tab + ":" + id;
+}